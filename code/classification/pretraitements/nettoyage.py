@@ -0,0 +1,230 @@
+######
+#
+# Nettoyage des textes des fanfictions (étape « Nettoyage des textes » de
+# 02_nettoyage_taille.ipynb), par lots et sur plusieurs processus.
+#
+# Usage - python nettoyage.py fanfics_complet.csv fanfics_nettoye.csv [--processus N] [--taille-lot 200]
+#
+# Le CSV est lu ligne à ligne et envoyé par lots de --taille-lot fanfictions
+# à --processus processus (par défaut un par cœur) : il n'est jamais chargé
+# en entier. Les lignes dont le texte (--colonne, body par défaut) est vide
+# sont supprimées, comme dans le notebook, et le texte nettoyé est ajouté
+# dans la colonne body_clean. Les lignes sont écrites dans l'ordre d'entrée.
+#
+# nettoyer_fanfiction donne exactement le même résultat que la fonction du
+# notebook (gardée ici sous le nom nettoyer_fanfiction_reference), mais ne
+# fait que les étapes qui ont quelque chose à changer, ce qu'une simple
+# recherche de sous-chaîne suffit à savoir :
+#   - un texte sans '<' ni '&' ne contient ni balise ni entité : l'analyse
+#     HTML (BeautifulSoup) et html.unescape sont sautées ;
+#   - les urls ne sont cherchées que dans les textes contenant 'http' ou 'www.' ;
+#   - NFKC n'est appliqué qu'aux textes qui ne sont pas en ASCII pur ;
+#   - les sauts de ligne multiples sont fusionnés par split/join plutôt que
+#     par une expression régulière (un remplacement par paragraphe).
+#
+# python nettoyage.py fanfics_complet.csv --verifier compare les deux
+# fonctions sur tout le fichier et affiche les textes qui diffèrent.
+#
+#######
+import argparse
+import csv
+import html
+import io
+import os
+import re
+import sys
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup
+
+TAILLE_LOT = 200
+MOTIF_URLS = r'http[s]?://\S+|www\.\S+'
+
+_urls = re.compile(MOTIF_URLS)
+_retours_ligne = re.compile(r'\n+')
+
+
+# Étapes du notebook 02_nettoyage_taille.ipynb
+
+def supprimer_urls(texte):
+    return _urls.sub('', texte)
+
+
+def supprimer_html(texte):
+    return BeautifulSoup(texte, "html.parser").get_text()
+
+
+def normaliser_caracteres(texte):
+    return unicodedata.normalize("NFKC", texte)
+
+
+def remplacer_entites_html(texte):
+    return html.unescape(texte)
+
+
+def nettoyer_retours_ligne(texte):
+    # Remplace plusieurs sauts de ligne par un seul
+    return _retours_ligne.sub('\n', texte).strip()
+
+
+def nettoyer_fanfiction_reference(texte):
+    '''
+    la fonction récapitulative du notebook, étape par étape
+    '''
+    texte = supprimer_urls(texte)
+    texte = supprimer_html(texte)
+    texte = normaliser_caracteres(texte)
+    texte = remplacer_entites_html(texte)
+    texte = nettoyer_retours_ligne(texte)
+    return texte
+
+
+def nettoyer_fanfiction(texte):
+    '''
+    même résultat que nettoyer_fanfiction_reference, en sautant les étapes sans effet
+    '''
+    if 'http' in texte or 'www.' in texte:
+        texte = supprimer_urls(texte)
+    # sans balise ni entité, get_text rend le texte tel quel (aux espaces près, que strip enlève)
+    if '<' in texte or '&' in texte:
+        texte = supprimer_html(texte)
+    if not texte.isascii():
+        texte = normaliser_caracteres(texte)
+    # get_text a décodé les entités une première fois, NFKC peut faire apparaître un '&'
+    if '&' in texte:
+        texte = remplacer_entites_html(texte)
+    if '\n\n' in texte:
+        # les morceaux vides sont les sauts de ligne en trop (et ceux des bords, que strip enlève)
+        texte = '\n'.join([morceau for morceau in texte.split('\n') if morceau])
+    return texte.strip()
+
+
+def nettoyer_lot(lot, colonne, colonne_propre, champs):
+    '''
+    nettoie les textes d'un lot de lignes et renvoie ces lignes au format CSV
+    (exécuté dans les processus de nettoyage : l'écriture du CSV, qui coûte
+    plus que le nettoyage lui-même, est elle aussi répartie)
+    '''
+    for ligne in lot:
+        ligne[colonne_propre] = nettoyer_fanfiction(ligne[colonne])
+    sortie = io.StringIO()
+    csv.DictWriter(sortie, fieldnames=champs).writerows(lot)
+    return sortie.getvalue()
+
+
+def augmenter_limite_champs():
+    # les textes dépassent de loin la taille maximale d'un champ du module csv
+    limite = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(limite)
+            return
+        except OverflowError:
+            limite //= 10
+
+
+def lire_lots(lecteur, colonne, taille_lot, compteurs):
+    '''
+    lots de lignes non vides du CSV, sans jamais tout lire
+    '''
+    lot = []
+    for ligne in lecteur:
+        compteurs['lues'] += 1
+        if not ligne.get(colonne, '').strip():
+            compteurs['vides'] += 1
+            continue
+        lot.append(ligne)
+        if len(lot) >= taille_lot:
+            yield lot
+            lot = []
+    if lot:
+        yield lot
+
+
+def nettoyer_csv(entree, sortie, colonne='body', colonne_propre='body_clean', processus=None, taille_lot=TAILLE_LOT):
+    '''
+    nettoie la colonne de chaque ligne du CSV d'entrée et écrit les lignes non vides,
+    avec le texte nettoyé, dans le CSV de sortie. renvoie les compteurs de lignes.
+    '''
+    augmenter_limite_champs()
+    processus = processus or os.cpu_count() or 1
+    compteurs = {'lues': 0, 'vides': 0, 'ecrites': 0}
+    with open(entree, newline='', encoding='utf-8') as f_in, open(sortie, 'w', newline='', encoding='utf-8') as f_out:
+        lecteur = csv.DictReader(f_in)
+        if colonne not in (lecteur.fieldnames or []):
+            raise ValueError(f"la colonne {colonne} est absente de {entree}")
+        champs = lecteur.fieldnames + [colonne_propre]
+        csv.DictWriter(f_out, fieldnames=champs).writeheader()
+        lots = lire_lots(lecteur, colonne, taille_lot, compteurs)
+
+        if processus <= 1:
+            for lot in lots:
+                f_out.write(nettoyer_lot(lot, colonne, colonne_propre, champs))
+                compteurs['ecrites'] += len(lot)
+            return compteurs
+
+        # au plus deux lots par processus en mémoire, écrits dans l'ordre de lecture
+        with ProcessPoolExecutor(max_workers=processus) as pool:
+            en_cours = deque()
+            for lot in lots:
+                en_cours.append((len(lot), pool.submit(nettoyer_lot, lot, colonne, colonne_propre, champs)))
+                while en_cours and (len(en_cours) >= 2 * processus or en_cours[0][1].done()):
+                    taille, futur = en_cours.popleft()
+                    f_out.write(futur.result())
+                    compteurs['ecrites'] += taille
+            while en_cours:
+                taille, futur = en_cours.popleft()
+                f_out.write(futur.result())
+                compteurs['ecrites'] += taille
+    return compteurs
+
+
+def verifier(entree, colonne='body', limite=10):
+    '''
+    compare nettoyer_fanfiction à la fonction du notebook sur chaque texte du CSV,
+    renvoie le nombre de textes différents (les premiers sont affichés)
+    '''
+    augmenter_limite_champs()
+    differences = 0
+    with open(entree, newline='', encoding='utf-8') as f_in:
+        for ligne in csv.DictReader(f_in):
+            texte = ligne.get(colonne, '')
+            if nettoyer_fanfiction(texte) != nettoyer_fanfiction_reference(texte):
+                differences += 1
+                if differences <= limite:
+                    print(f"Différence pour la ligne {ligne.get('work_id', '?')} : {texte[:200]!r}")
+    return differences
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Nettoie les textes des fanfictions d\'un CSV, par lots et en parallèle.')
+    parser.add_argument('entree', help='CSV des fanfictions (colonne body)')
+    parser.add_argument('sortie', nargs='?', default='', help='CSV écrit avec la colonne body_clean')
+    parser.add_argument('--colonne', default='body', help='colonne contenant les textes')
+    parser.add_argument('--processus', type=int, default=0, help='nombre de processus (par défaut : un par cœur)')
+    parser.add_argument('--taille-lot', type=int, default=TAILLE_LOT, help='nombre de fanfictions par lot envoyé à un processus')
+    parser.add_argument('--verifier', action='store_true', help='compare le résultat à celui de la fonction du notebook au lieu de nettoyer')
+    args = parser.parse_args()
+    if not args.verifier and not args.sortie:
+        parser.error('le CSV de sortie est obligatoire (sauf avec --verifier)')
+    return args
+
+
+def main():
+    args = get_args()
+    debut = time.monotonic()
+    if args.verifier:
+        differences = verifier(args.entree, args.colonne)
+        print(f"{differences} texte(s) différent(s) en {time.monotonic() - debut:.1f} s")
+        sys.exit(1 if differences else 0)
+    compteurs = nettoyer_csv(args.entree, args.sortie, args.colonne, processus=args.processus or None, taille_lot=max(1, args.taille_lot))
+    print(f"{compteurs['lues']} fanfictions lues, {compteurs['vides']} vides supprimées, "
+          f"{compteurs['ecrites']} nettoyées dans {args.sortie} en {time.monotonic() - debut:.1f} s")
+
+
+# la garde évite que les processus de nettoyage relancent main() avec la méthode 'spawn'
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+######
+#
+# The scrapers as a library, for running many searches and batches of works
+# in one process (e.g. from a job runner) instead of one command per tag.
+#
+#   from ao3_api import Harvester, Fetcher
+#   harvester = Harvester(rps=0.2, lang='Francais')
+#   ids = harvester.harvest([fluff_url, angst_url], out_csv='work_ids')
+#   fetcher = Fetcher(rps=0.2, workers=4)
+#   processed, failed = fetcher.fetch_many([work_id for work_id, _ in ids], csv_out='fanfics.csv')
+#   harvester.close()
+#   fetcher.close()
+#
+# A Harvester (ids of searches, as ao3_ids_modif.py) and a Fetcher (works, as
+# ao3_get_fanfic_modif.py) each hold their session, rate limiter and dedupe
+# state: the ids already seen for a Harvester (its id stores stay open between
+# calls, so a csv of ids is read once), the journals of its outputs for a
+# Fetcher. Both can be given the session and limiter of another object to
+# share a single politeness budget, as ao3_pipeline.py does.
+#
+# Every call hands the state of its object to the functions of the scripts as a
+# context (ao3_ids_modif.HarvestContext, ao3_get_fanfic_modif.FetchContext): the
+# module globals, which are only the state of the command line, are never read
+# nor touched, so several Harvesters and Fetchers can run at the same time in
+# several threads.
+#
+#######
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import ao3_ids_modif as ids_script
+import ao3_get_fanfic_modif as fics_script
+from ao3_limiter import AdaptiveLimiter
+from ao3_session import create_session
+from ao3_idstore import IdStore
+from ao3_journal import Journal, journal_path, DONE
+from ao3_bookmarks import BookmarkCache
+from ao3_chapters import ChapterStore
+from ao3_columnar import ParquetShardWriter, pa
+from ao3_parse import default_backend
+from ao3_shards import PAGE_CAP
+from ao3_writer import BackgroundWriter, RotatingCsvWriter, FLUSH_ROWS, FLUSH_SECONDS
+
+class Harvester:
+    '''
+    collects the work ids of AO3 searches, like ao3_ids_modif.py.
+    the ids are deduplicated across every harvest() of the object: in memory, or
+    with an out_csv, against that csv (its id store is opened once and kept open).
+    '''
+
+    def __init__(self, rps=1.0 / 5, workers=4, header='', lang='', language_id='', shard=False, page_cap=PAGE_CAP,
+                 metadata=False, bloom=False, pool_size=0, session=None, limiter=None):
+        self.workers = max(1, workers)
+        self.header = header
+        self.lang = lang
+        self.language_id = language_id
+        self.shard = shard
+        self.page_cap = max(1, page_cap)
+        self.metadata = metadata
+        self.bloom = bloom
+        self.session = session if session is not None else create_session(pool_size if pool_size > 0 else self.workers)
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(rps)
+        self.seen_ids = set()
+        self.stores = {}
+
+    def _seen(self, out_csv):
+        if not out_csv:
+            return self.seen_ids
+        if out_csv not in self.stores:
+            self.stores[out_csv] = IdStore(out_csv + ".ids", out_csv + ".csv", bloom=self.bloom)
+        return self.stores[out_csv]
+
+    def _context(self, out_csv='', limit=-1, on_id=None):
+        return ids_script.HarvestContext(self.session, self.limiter, self.workers, self.lang, self.metadata, self.shard,
+                                         self.page_cap, csv_name=out_csv, num_requested_fic=limit,
+                                         seen_ids=self._seen(out_csv), on_id=on_id)
+
+    def search_url(self, search_url, tag=''):
+        '''
+        the search url with the language filter of this harvester, restricted to tag if given
+        '''
+        if self.language_id:
+            search_url = ids_script.set_language_id(search_url, self.language_id)
+        if tag:
+            search_url = ids_script.tag_url(tag, context=ids_script.HarvestContext(self.session, self.limiter, base_url=search_url))
+        return search_url
+
+    def harvest(self, urls, out_csv='', limit=-1, on_id=None):
+        '''
+        crawls the searches (pages of several searches are downloaded at the same time)
+        and returns the [(id, language)] of the works not seen before, in search order.
+        out_csv (name without .csv) also appends them to <out_csv>.csv, as the script does;
+        limit is the number of ids wanted per search (-1: all); on_id(id, language) is
+        called for every id as soon as its page is read.
+        '''
+        found = []
+
+        def collect(work_id, language):
+            found.append((work_id, language))
+            if on_id is not None:
+                on_id(work_id, language)
+
+        searches = [self.search_url(url) for url in urls]
+        context = self._context(out_csv, limit, collect)
+        if self.shard:
+            searches = ids_script.plan_searches(searches, self.header, context=context)
+        ids_script.process_for_ids(searches, self.header, context=context)
+        return found
+
+    def close(self):
+        '''
+        saves the id stores of the csvs written
+        '''
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+
+class Fetcher:
+    '''
+    downloads works, like ao3_get_fanfic_modif.py. fetch_many() skips the works the
+    journal of its output reports as done; the journals stay open between calls.
+    '''
+
+    def __init__(self, rps=1.0 / 5, workers=4, header='', first_chapter=False, metadata_only=False, lang=False,
+                 parser=None, parse_workers=0, bookmarks=False, bookmarks_dir='', chapters_dir='',
+                 pool_size=0, session=None, limiter=None):
+        self.workers = max(1, workers)
+        self.header = header
+        self.first_chapter = first_chapter or metadata_only
+        self.metadata_only = metadata_only
+        self.lang = lang
+        self.parser = parser or default_backend()
+        self.parse_workers = max(0, parse_workers)
+        self.bookmarks = bookmarks
+        self.session = session if session is not None else create_session(pool_size if pool_size > 0 else self.workers + 2)
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(rps)
+        self.bookmark_cache = BookmarkCache(bookmarks_dir) if bookmarks and bookmarks_dir else None
+        self.bookmark_pool = ThreadPoolExecutor(max_workers=self.workers) if bookmarks else None
+        self.chapter_store = ChapterStore(chapters_dir) if chapters_dir else None
+        self.journals = {}
+
+    def journal(self, path):
+        if path not in self.journals:
+            self.journals[path] = Journal(path)
+        return self.journals[path]
+
+    def _context(self, journal=None):
+        return fics_script.FetchContext(self.session, self.limiter, self.parser, journal=journal, bookmark_cache=self.bookmark_cache,
+                                        bookmark_pool=self.bookmark_pool, chapter_store=self.chapter_store)
+
+    def fetch(self, fic_id):
+        '''
+        downloads and parses one work, without writing it anywhere.
+        returns (status, (result, fields)) as ao3_parse.parse_work, (status, None) when the download failed
+        '''
+        context = self._context()
+        if self.chapter_store is not None and not self.first_chapter:
+            return fics_script.fetch_fic_chapters(fic_id, self.lang, self.header, context=context)
+        status, html = fics_script.fetch_fic(fic_id, self.first_chapter, self.metadata_only, self.header, context=context)
+        if html is None:
+            return status, None
+        return status, fics_script.parse_page(html, self.metadata_only, self.lang, context=context)
+
+    def fetch_many(self, ids, csv_out='fanfics.csv', parquet_dir='', journal_file='', skip_failed=False,
+                   shard_rows=0, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS):
+        '''
+        downloads the works of ids that the journal (default journal_<csv_out>) does not report
+        as done, and writes them to csv_out (or to parquet_dir). returns (processed, failed)
+        '''
+        if parquet_dir and pa is None:
+            raise RuntimeError("a parquet output needs pyarrow")
+        output_directory = os.path.dirname(csv_out)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        journal = self.journal(journal_file or journal_path(csv_out))
+
+        context = self._context(journal)
+        todo = fics_script.load_fic_ids([str(fic_id) for fic_id in ids], False, '', skip_failed, context=context)
+        with open(os.path.join(output_directory, "errors_" + os.path.basename(csv_out)), 'a', newline="") as e_out:
+            sink = ParquetShardWriter(parquet_dir) if parquet_dir else RotatingCsvWriter(csv_out, shard_rows)
+            writer = BackgroundWriter(sink, e_out, flush_rows, flush_seconds)
+            try:
+                return fics_script.scrape_fics(todo, len(todo), self.workers, self.parse_workers, self.first_chapter, self.lang,
+                                               self.bookmarks, self.metadata_only, writer, writer.errorwriter, self.header,
+                                               context=context)
+            finally:
+                for done_id in writer.close():
+                    fics_script.mark(done_id, DONE, context=context)
+
+    def close(self):
+        '''
+        closes the journals and stops the bookmark threads
+        '''
+        for journal in self.journals.values():
+            journal.close()
+        self.journals = {}
+        if self.bookmark_pool is not None:
+            self.bookmark_pool.shutdown()
@@ -0,0 +1,184 @@
+######
+#
+# Content-addressed archive of the raw HTML pages fetched from AO3.
+#
+# Every page is compressed (zstd when the zstandard module is installed,
+# gzip otherwise) and stored once under the sha256 of its content:
+#   <root>/blobs/ab/abcdef....html.zst
+# An append-only index, <root>/index.csv, records for every fetch
+#   work_id, url, fetched_at, status, sha256, codec
+# so the same page fetched twice only costs one more index row.
+#
+# With the index, the scraper can replay the whole parse/write pipeline
+# from disk without sending a single request.
+#
+#######
+import csv
+import datetime
+import gzip
+import hashlib
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_HEADER = ['work_id', 'url', 'fetched_at', 'status', 'sha256', 'codec']
+
+
+def _compress(data, codec):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _decompress(data, codec):
+    if codec == 'zst':
+        if zstandard is None:
+            raise RuntimeError("this archive contains zstd blobs, please install the zstandard module")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class HtmlArchive:
+    '''
+    on-disk store of fetched pages, safe to share between fetch threads.
+    lookups are by url and return the most recent fetch of that url.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.codec = 'zst' if zstandard is not None else 'gz'
+        self.index_path = os.path.join(root, 'index.csv')
+        self.lock = threading.Lock()
+        self.latest = {}
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            with open(self.index_path, 'w', newline="") as f:
+                csv.writer(f).writerow(INDEX_HEADER)
+            return
+        with open(self.index_path, 'r', newline="") as f:
+            for row in csv.DictReader(f):
+                # rows are in fetch order, so the last one wins
+                self.latest[row['url']] = row
+
+    def _blob_path(self, sha, codec):
+        return os.path.join(self.root, 'blobs', sha[:2], sha + '.html.' + codec)
+
+    def __len__(self):
+        return len(self.latest)
+
+    def __contains__(self, url):
+        return url in self.latest
+
+    def store(self, work_id, url, status, html):
+        '''
+        compresses and writes the page (unless the same content is already stored),
+        then appends a row to the index
+        '''
+        data = html.encode('utf-8') if isinstance(html, str) else html
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha, self.codec)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp.' + str(threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(_compress(data, self.codec))
+            os.replace(tmp, path)
+
+        self._index(work_id, url, status, sha)
+        return sha
+
+    def _index(self, work_id, url, status, sha):
+        row = {
+            'work_id': work_id,
+            'url': url,
+            'fetched_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'status': status,
+            'sha256': sha,
+            'codec': self.codec,
+        }
+        with self.lock:
+            with open(self.index_path, 'a', newline="") as f:
+                csv.writer(f).writerow([row[key] for key in INDEX_HEADER])
+            self.latest[url] = row
+
+    def open_writer(self, work_id, url, status):
+        '''
+        returns a file-like object to archive a page chunk by chunk (streaming mode).
+        the page is indexed when the writer is closed, dropped if it is aborted.
+        '''
+        return _BlobWriter(self, work_id, url, status)
+
+    def open(self, url):
+        '''
+        returns (status, file) where file streams the decompressed bytes of the
+        latest fetch of url, or (None, None) if it was never archived
+        '''
+        row = self.latest.get(url)
+        if row is None:
+            return None, None
+        path = self._blob_path(row['sha256'], row['codec'])
+        if row['codec'] == 'zst':
+            if zstandard is None:
+                raise RuntimeError("this archive contains zstd blobs, please install the zstandard module")
+            return int(row['status']), zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return int(row['status']), gzip.open(path, 'rb')
+
+    def load(self, url):
+        '''
+        returns (status, html) of the latest fetch of url, or (None, None) if it was never archived.
+        html is the raw bytes of the page, as they were downloaded.
+        '''
+        row = self.latest.get(url)
+        if row is None:
+            return None, None
+        with open(self._blob_path(row['sha256'], row['codec']), 'rb') as f:
+            data = _decompress(f.read(), row['codec'])
+        return int(row['status']), data
+
+
+class _BlobWriter:
+    '''
+    compresses and hashes a page while it is being downloaded
+    '''
+
+    def __init__(self, archive, work_id, url, status):
+        self.archive = archive
+        self.work_id = work_id
+        self.url = url
+        self.status = status
+        self.sha = hashlib.sha256()
+        self.tmp = os.path.join(archive.root, 'blobs', 'tmp.' + str(threading.get_ident()) + '.' + str(id(self)))
+        self.raw = open(self.tmp, 'wb')
+        if archive.codec == 'zst':
+            self.out = zstandard.ZstdCompressor(level=10).stream_writer(self.raw, closefd=False)
+        else:
+            self.out = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+
+    def write(self, chunk):
+        self.sha.update(chunk)
+        self.out.write(chunk)
+
+    def abort(self):
+        self.out.close()
+        self.raw.close()
+        os.remove(self.tmp)
+
+    def close(self):
+        self.out.close()
+        self.raw.close()
+        sha = self.sha.hexdigest()
+        path = self.archive._blob_path(sha, self.archive.codec)
+        if os.path.exists(path):
+            os.remove(self.tmp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp, path)
+        self.archive._index(self.work_id, self.url, self.status, sha)
+        return sha
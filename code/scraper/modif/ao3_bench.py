@@ -0,0 +1,182 @@
+######
+#
+# Offline benchmark of the scrapers, against the local mock AO3 (ao3_mock.py).
+#
+# Usage - python ao3_bench.py [--works 200] [--words 2000] [--chapters 3] [--error-rate 0.02] [options]
+#
+# Starts the mock in this process, then runs each scenario as a subprocess
+# with AO3_BASE_URL pointing at it, in a temporary directory:
+#   ids             ao3_ids_modif.py on a search of the whole mock archive
+#   fics            ao3_get_fanfic_modif.py on the ids csv written by 'ids'
+#                   (full works: view_full_work=true)
+#   fics-chapters   the same with --chapters (first chapter page + one page per chapter)
+#   fics-bookmarks  the same with --bookmarks (+ the bookmark pages)
+#   fics-metadata   the same with --metadata-only
+# (--scenarios picks some of them; the fics scenarios always run 'ids' first.)
+# For each scenario it reports the wall time, the items per second (ids found
+# or works written), the CPU time (user + system) and the peak RSS of the
+# scraper process, the requests it sent, the errors the mock injected and the
+# retries the scraper reports (read from its --metrics-jsonl export).
+#
+# --rps is set high by default so that the limiter does not hide the cost of
+# the scraper itself; --error-rate shows how the retries and the adaptive
+# limiter (Retry-After of --retry-after seconds) slow a run down.
+# --save writes the results as json, --compare prints the change from a saved run.
+#
+#######
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from ao3_mock import add_mock_args, mock_from_args
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ['ids', 'fics', 'fics-chapters', 'fics-bookmarks', 'fics-metadata']
+FIC_OPTIONS = {'fics': [], 'fics-chapters': ['--chapters', 'chapters'],
+               'fics-bookmarks': ['--bookmarks'], 'fics-metadata': ['--metadata-only']}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the AO3 scrapers against a local mock archive.')
+    add_mock_args(parser)
+    parser.set_defaults(works=200)
+    parser.add_argument(
+        '--scenarios', default=','.join(SCENARIOS),
+        help='comma-separated scenarios to run, among ' + ', '.join(SCENARIOS))
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='--workers of both scrapers')
+    parser.add_argument(
+        '--rps', type=float, default=500.0,
+        help='--rps of both scrapers')
+    parser.add_argument(
+        '--extra', default='',
+        help='more options for ao3_get_fanfic_modif.py, e.g. "--parser bs4 --parse-workers 0"')
+    parser.add_argument(
+        '--keep', default='',
+        help='run in this directory and keep the outputs (default: a temporary directory)')
+    parser.add_argument(
+        '--save', default='',
+        help='write the results to this json file')
+    parser.add_argument(
+        '--compare', default='',
+        help='json file of an earlier --save to compare with')
+    args = parser.parse_args()
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(unknown))
+    return args, scenarios
+
+
+def last_snapshot(path):
+    '''
+    last line of a --metrics-jsonl export (None when the file is missing or empty)
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def counter(snapshot, name, **labels):
+    if snapshot is None:
+        return 0
+    return sum(c['value'] for c in snapshot['counters']
+               if c['name'] == name and all(c['labels'].get(k) == v for k, v in labels.items()))
+
+
+def run(name, command, workdir, mock, env):
+    '''
+    runs one scenario, returns its measures
+    '''
+    before = dict(mock.stats['statuses']), mock.stats['requests']
+    log_path = os.path.join(workdir, name + '.log')
+    start = time.monotonic()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable] + command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # the rusage of this child only (RUSAGE_CHILDREN would add up every scenario)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    exit_code = process.returncode = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        print(f"⚠️  {name} : code de sortie {exit_code}, voir {log_path}")
+
+    statuses = {code: n - before[0].get(code, 0) for code, n in mock.stats['statuses'].items()}
+    snapshot = last_snapshot(os.path.join(workdir, name + '.jsonl'))
+    items = counter(snapshot, 'ids', outcome='new') if name == 'ids' else counter(snapshot, 'works', state='done')
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        'scenario': name,
+        'exit_code': exit_code,
+        'items': items,
+        'wall_seconds': round(wall, 3),
+        'items_per_second': round(items / wall, 2) if wall > 0 else 0.0,
+        'cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_item': round(1000 * cpu / items, 2) if items else None,
+        # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        'peak_rss_mb': round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        'requests': mock.stats['requests'] - before[1],
+        'injected_errors': sum(n for code, n in statuses.items() if code in ('429', '503')),
+        'retries': counter(snapshot, 'retries'),
+        'statuses': {code: n for code, n in statuses.items() if n},
+    }
+
+
+def report(results, baseline=None):
+    old = {r['scenario']: r for r in baseline or []}
+    print(f"\n{'scénario':<16}{'éléments':>9}{'durée s':>9}{'élém./s':>9}{'CPU s':>8}{'ms CPU/élém.':>13}{'RSS Mo':>8}{'requêtes':>9}{'erreurs':>8}{'retries':>8}")
+    for r in results:
+        per_item = f"{r['cpu_ms_per_item']:.2f}" if r['cpu_ms_per_item'] is not None else '-'
+        print(f"{r['scenario']:<16}{r['items']:>9}{r['wall_seconds']:>9.2f}{r['items_per_second']:>9.1f}{r['cpu_seconds']:>8.2f}"
+              f"{per_item:>13}{r['peak_rss_mb']:>8.1f}{r['requests']:>9}{r['injected_errors']:>8}{r['retries']:>8}")
+        previous = old.get(r['scenario'])
+        if previous and previous['items_per_second'] and previous['cpu_ms_per_item'] and r['cpu_ms_per_item']:
+            print(f"{'':<16}vs référence : élém./s x{r['items_per_second'] / previous['items_per_second']:.2f}, "
+                  f"ms CPU/élém. x{r['cpu_ms_per_item'] / previous['cpu_ms_per_item']:.2f}, "
+                  f"RSS x{r['peak_rss_mb'] / previous['peak_rss_mb']:.2f}")
+
+
+def main():
+    args, scenarios = get_args()
+    mock = mock_from_args(args)
+    server = mock.serve()
+    host, port = server.server_address
+    base = f'http://{host}:{port}'
+    env = dict(os.environ, AO3_BASE_URL=base, PYTHONUNBUFFERED='1')
+    common = ['--workers', str(args.workers), '--rps', str(args.rps)]
+    print(f"Faux AO3 sur {base} : {args.works} fanfictions de {args.words} mots en {args.chapters} chapitres, "
+          f"{args.error_rate:.1%} d'erreurs injectées")
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='ao3_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    if 'ids' in scenarios or any(s in FIC_OPTIONS for s in scenarios):
+        results.append(run('ids', [os.path.join(HERE, 'ao3_ids_modif.py'), f'{base}/tags/Fluff/works', '--out_csv', 'work_ids',
+                                   '--metrics_jsonl', 'ids.jsonl', '--metrics_interval', '0'] + common, workdir, mock, env))
+    for name in (s for s in scenarios if s in FIC_OPTIONS):
+        results.append(run(name, [os.path.join(HERE, 'ao3_get_fanfic_modif.py'), 'work_ids.csv', '--csv', f'{name}.csv',
+                                  '--metrics-jsonl', f'{name}.jsonl', '--metrics-interval', '0']
+                           + FIC_OPTIONS[name] + common + args.extra.split(), workdir, mock, env))
+    server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f"\nRésultats enregistrés dans {args.save}")
+    if not args.keep:
+        print(f"Sorties : {workdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+######
+#
+# Incremental collection of the users who bookmarked a work.
+#
+# AO3 lists the bookmarks of a work newest first, 20 per page, with a
+# pagination block giving the number of pages. The list of each work is
+# cached as a small json file (<cache>/<work_id>.json). On the next run
+# only the first pages are downloaded, as many as the number of pages
+# added since the cached run (plus page 1), and the new bookmarks found
+# before the newest cached one are put in front of the cached list.
+# When the two lists do not overlap (many bookmarks deleted, cache too
+# old...) every page is downloaded again.
+#
+# The pages themselves are fetched concurrently by the caller, every
+# request still taking its token from the shared rate limiter.
+#
+#######
+import datetime
+import json
+import os
+import threading
+
+from bs4 import BeautifulSoup
+
+# number of users of the cached list that must be found, in order, in the new pages
+OVERLAP = 3
+
+
+def bookmark_page_url(url, page):
+    return url if page == 1 else url + '?page=' + str(page)
+
+
+def get_users(meta):
+    '''
+    users of the h5.byline.heading tags of a bookmarks page
+    '''
+    users = []
+    for tag in meta:
+        user = tag.findChildren("a", recursive=False)[0].contents[0]
+        users.append(user)
+
+    return users
+
+
+def parse_bookmark_page(html):
+    '''
+    returns (users, max_pages) for a page of bookmarks;
+    max_pages is 1 when the page has no pagination block
+    '''
+    soup = BeautifulSoup(html or '', 'html.parser')
+    users = get_users(soup.findAll('h5', class_='byline heading'))
+    pagination = soup.find('ol', class_='pagination actions')
+    if not pagination:
+        return users, 1
+    pages = pagination.findChildren("li", recursive=False)
+    return users, int(pages[-2].contents[0].contents[0])
+
+
+def merge_bookmarks(fresh, cached):
+    '''
+    fresh holds the users of the first pages, newest first, cached the list of the
+    previous run. returns the merged list, or None if fresh does not reach the cached list
+    '''
+    if not cached:
+        return None
+    anchor = cached[:OVERLAP]
+    for i in range(len(fresh) - len(anchor) + 1):
+        if fresh[i:i + len(anchor)] == anchor:
+            return fresh[:i] + cached
+    return None
+
+
+class BookmarkCache:
+    '''
+    one json file per work: {"pages": ..., "users": [...], "fetched_at": ...}
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, work_id):
+        return os.path.join(self.root, str(work_id) + '.json')
+
+    def get(self, work_id):
+        '''
+        returns the cached entry of a work, None if there is none (or it is unreadable)
+        '''
+        try:
+            with open(self._path(work_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, work_id, users, pages):
+        entry = {
+            'pages': pages,
+            'users': users,
+            'fetched_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        path = self._path(work_id)
+        tmp = path + '.tmp.' + str(threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
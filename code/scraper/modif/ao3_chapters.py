@@ -0,0 +1,95 @@
+######
+#
+# Chapter-level cache of the text of multichapter works.
+#
+# The text of every chapter is stored once, compressed, under
+#   <root>/<work_id>/<chapter_id>.txt.gz
+# so that an update run on works in progress only downloads the first
+# chapter page (which carries the metadata, the text of chapter 1 and the
+# list of chapters) plus the chapters that are not in the cache yet,
+# instead of the whole view_full_work page. The body is then rebuilt
+# from the cached chapters, in the order of the chapter list.
+#
+# Chapters already cached are not downloaded again, so later edits of
+# an old chapter are not picked up (except for chapter 1).
+#
+#######
+import gzip
+import os
+import threading
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from ao3_session import BASE_URL
+
+
+def chapter_url(work_id, chapter_id):
+    return f'{BASE_URL}/works/{work_id}/chapters/{chapter_id}?view_adult=true'
+
+
+def navigate_url(work_id):
+    return f'{BASE_URL}/works/{work_id}/navigate?view_adult=true'
+
+
+def chapter_ids(html):
+    '''
+    ids of the chapters of a work, in order, read from the chapter menu of a chapter page.
+    empty for single-chapter works (the page has no menu).
+    '''
+    soup = BeautifulSoup(html or '', 'html.parser', parse_only=SoupStrainer('select', id='selected_id'))
+    return [option['value'] for option in soup.find_all('option') if option.get('value')]
+
+
+def navigate_ids(html):
+    '''
+    ids of the chapters of a work, in order, read from its /navigate page
+    '''
+    # recent bs4 versions match a strainer's class against the whole attribute
+    # ('chapter index group'), so the class is checked once parsed
+    soup = BeautifulSoup(html or '', 'html.parser', parse_only=SoupStrainer('ol'))
+    ids = []
+    for link in (a for ol in soup.find_all('ol', class_='chapter') for a in ol.find_all('a', href=True)):
+        parts = link['href'].split('/chapters/')
+        if len(parts) == 2:
+            ids.append(parts[1].split('?')[0])
+    return ids
+
+
+def chapter_count(stats):
+    '''
+    number of chapters published, from the 'chapters' stat (e.g. '3/?' or '12/12')
+    of a get_stats list
+    '''
+    published = stats[5].split('/')[0].replace(',', '')
+    return int(published) if published.isdigit() else 1
+
+
+class ChapterStore:
+    '''
+    on-disk cache of chapter texts keyed by (work_id, chapter_id), safe to share between fetch threads
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, work_id, chapter_id):
+        return os.path.join(self.root, str(work_id), str(chapter_id) + '.txt.gz')
+
+    def get(self, work_id, chapter_id):
+        '''
+        text of a cached chapter, None if it is not cached
+        '''
+        try:
+            with gzip.open(self._path(work_id, chapter_id), 'rt', encoding='utf-8') as f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+
+    def put(self, work_id, chapter_id, text):
+        path = self._path(work_id, chapter_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp.' + str(threading.get_ident())
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            f.write(text)
+        os.replace(tmp, path)
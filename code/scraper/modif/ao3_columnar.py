@@ -0,0 +1,240 @@
+######
+#
+# Typed, sharded Parquet output for the scraped fanfictions.
+#
+# Instead of one huge csv where every row carries the whole body and the
+# lists are python reprs, rows are written in shards of typed columns:
+#   <root>/metadata-00000.parquet   everything but the body
+#   <root>/bodies-00000.parquet     work_id, body (zstd compressed)
+# Metadata-only reads (filtering on tags, language, kudos...) never open
+# the bodies files, and every read can select the columns it needs.
+#
+# Tags, authors, kudos and bookmarks become lists of strings, dates are
+# dates and the counters (words, comments, kudos, bookmarks, hits) are
+# integers; 'null' becomes a missing value.
+#
+# A shard is written (to a temporary file, synced, then renamed) every
+# shard_rows rows and when the writer is closed, so only complete shards
+# are ever visible.
+#
+# Needs pyarrow (pip install pyarrow). Existing csv files can be converted with
+#   python ao3_columnar.py fanfics.csv fanfics_parquet/
+#
+#######
+import argparse
+import ast
+import csv
+import datetime
+import glob
+import os
+import sys
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pc = None
+    pq = None
+
+from ao3_parse import FANFIC_HEADER
+from ao3_refresh import raise_field_limit
+
+SHARD_ROWS = 5000
+LIST_COLUMNS = ['author', 'rating', 'category', 'fandom', 'relationship', 'character', 'additional tags', 'all_kudos', 'all_bookmarks']
+# columns written as python list reprs by csv.writer
+REPR_COLUMNS = ['author', 'all_kudos', 'all_bookmarks']
+DATE_COLUMNS = ['published', 'status date']
+INT_COLUMNS = ['words', 'comments', 'kudos', 'bookmarks', 'hits']
+
+
+def _schemas():
+    fields = []
+    for name in FANFIC_HEADER[:-1]:
+        if name == 'work_id':
+            fields.append(pa.field(name, pa.int64()))
+        elif name in LIST_COLUMNS:
+            fields.append(pa.field(name, pa.list_(pa.string())))
+        elif name in DATE_COLUMNS:
+            fields.append(pa.field(name, pa.date32()))
+        elif name in INT_COLUMNS:
+            fields.append(pa.field(name, pa.int64()))
+        else:
+            fields.append(pa.field(name, pa.string()))
+    metadata = pa.schema(fields)
+    bodies = pa.schema([pa.field('work_id', pa.int64()), pa.field('body', pa.large_string())])
+    return metadata, bodies
+
+
+def _as_list(name, value):
+    if isinstance(value, list):
+        return value
+    if name in REPR_COLUMNS:
+        return list(ast.literal_eval(value)) if value else []
+    # tags are joined with ', ' in the csv; AO3 tags cannot contain commas
+    return value.split(', ') if value else []
+
+
+def _as_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_int(value):
+    value = str(value).replace(',', '').strip()
+    return int(value) if value.isdigit() else None
+
+
+def typed_row(row):
+    '''
+    converts a row in the order of FANFIC_HEADER (as built by build_row, or read
+    back from a csv) to a dict of typed metadata values, without the body
+    '''
+    record = {}
+    for name, value in zip(FANFIC_HEADER[:-1], row):
+        if name == 'work_id':
+            record[name] = int(value)
+        elif name in LIST_COLUMNS:
+            record[name] = _as_list(name, value)
+        elif name in DATE_COLUMNS:
+            record[name] = _as_date(value)
+        elif name in INT_COLUMNS:
+            record[name] = _as_int(value)
+        else:
+            record[name] = value
+    return record
+
+
+def _next_shard(root):
+    shards = glob.glob(os.path.join(root, 'metadata-*.parquet'))
+    if not shards:
+        return 0
+    return max(int(os.path.basename(path)[len('metadata-'):-len('.parquet')]) for path in shards) + 1
+
+
+def _write_table(table, path):
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    fd = os.open(tmp, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+class ParquetShardWriter:
+    '''
+    drop-in replacement of StreamingCsvWriter writing Parquet shards.
+    flush() returns the work ids whose rows are durable on disk, i.e. those
+    of the shards written since the last call.
+    '''
+
+    def __init__(self, root, shard_rows=SHARD_ROWS):
+        if pa is None:
+            raise RuntimeError("the parquet output needs pyarrow, please install it")
+        self.root = root
+        self.shard_rows = shard_rows
+        self.metadata_schema, self.bodies_schema = _schemas()
+        os.makedirs(root, exist_ok=True)
+        self.shard = _next_shard(root)
+        self.records = []
+        self.bodies = []
+        self.durable = []
+
+    def writerow(self, row):
+        self.records.append(typed_row(row))
+        self.bodies.append({'work_id': int(row[0]), 'body': row[-1]})
+        if len(self.records) >= self.shard_rows:
+            self._write_shard()
+
+    def writerow_streamed(self, row, body):
+        '''
+        row without its body, body a file holding it (see ao3_stream); the body is
+        read back in memory, as a shard is written in one go
+        '''
+        self.writerow(list(row) + [body.read() if body is not None else ''])
+
+    def _write_shard(self):
+        if not self.records:
+            return
+        name = f'{self.shard:05d}.parquet'
+        # bodies first: a metadata shard is only visible once its bodies are
+        _write_table(pa.Table.from_pylist(self.bodies, schema=self.bodies_schema), os.path.join(self.root, 'bodies-' + name))
+        _write_table(pa.Table.from_pylist(self.records, schema=self.metadata_schema), os.path.join(self.root, 'metadata-' + name))
+        self.durable += [str(record['work_id']) for record in self.records]
+        self.records = []
+        self.bodies = []
+        self.shard += 1
+
+    def flush(self):
+        durable = self.durable
+        self.durable = []
+        return durable
+
+    def sync(self):
+        '''
+        writes the rows held so far as a (smaller) shard, returns the work ids made durable
+        '''
+        self._write_shard()
+        return self.flush()
+
+    def close(self):
+        '''
+        writes the last (partial) shard, returns the work ids it made durable
+        '''
+        self._write_shard()
+        return self.flush()
+
+
+def load_corpus(root, columns=None, filters=None, bodies=False, as_table=False):
+    '''
+    reads the metadata shards of root, only the given columns (all by default) and the rows
+    matching filters (pyarrow filters, e.g. [('language', '=', 'Francais'), ('kudos', '>', 100)]).
+    with bodies, the body column is joined on work_id (for the selected rows only).
+    returns a pandas DataFrame, or the pyarrow Table with as_table.
+    '''
+    if pa is None:
+        raise RuntimeError("reading parquet shards needs pyarrow, please install it")
+    if columns is not None and 'work_id' not in columns:
+        columns = ['work_id'] + list(columns)
+    table = pq.read_table(sorted(glob.glob(os.path.join(root, 'metadata-*.parquet'))), columns=columns, filters=filters)
+    if bodies:
+        body_table = pq.read_table(sorted(glob.glob(os.path.join(root, 'bodies-*.parquet'))),
+                                   filters=[('work_id', 'in', table.column('work_id').to_pylist())])
+        # join on work_id (Table.join does not handle the list columns)
+        rows = pc.index_in(table.column('work_id'), value_set=body_table.column('work_id'))
+        table = table.append_column('body', body_table.column('body').take(rows))
+    return table if as_table else table.to_pandas()
+
+
+def convert_csv(csv_path, root, shard_rows=SHARD_ROWS):
+    '''
+    converts a csv written by ao3_get_fanfic_modif.py to parquet shards in root.
+    returns the number of rows converted.
+    '''
+    raise_field_limit()
+    writer = ParquetShardWriter(root, shard_rows)
+    rows = 0
+    with open(csv_path, 'r', newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0] == FANFIC_HEADER[0]:
+                continue
+            writer.writerow(row)
+            rows += 1
+    writer.close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a fanfics csv to sharded parquet files.')
+    parser.add_argument('csv', help='csv written by ao3_get_fanfic_modif.py')
+    parser.add_argument('out', help='output directory of the parquet shards')
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS, help='rows per shard')
+    args = parser.parse_args()
+    if pa is None:
+        sys.exit("pyarrow n'est pas installé (pip install pyarrow)")
+    print(f"{convert_csv(args.csv, args.out, args.shard_rows)} lignes converties dans {args.out}")
@@ -22,9 +22,13 @@
 #
 # --restart is an optional string which when used in combination with a csv input will start
 # the scraping from the given work_id, skipping all previous rows in the csv
+# (rarely needed now: see --journal below)
 #
 # --bookmarks is an optional flag which collects the users who have bookmarked a fic.
 # Because this is a slow operation, it is excluded by default.
+# The bookmark pages of a fic are fetched concurrently (--workers at a time) and the
+# list of each fic is cached in --bookmarks-cache (default bookmarks_<csv> next to the
+# output csv): later runs only fetch the pages added since and merge them with the cache.
 #
 # --firstchap is an optional flag which, when set, only pulls the first chapter instead
 # of all chapters.
@@ -41,19 +45,137 @@
 # jack-debug
 # I added a new argument that only gets fanfics of a certain language
 # --lang
+# (when the id csv comes from ao3_ids_modif.py, its third column gives the language
+# of each work and the other works are dropped before any download; for a complete
+# pre-filter, harvest the ids with ao3_ids_modif.py --language_id / --lang)
+#
+# For metadata alone, ao3_ids_modif.py --metadata is much cheaper than --metadata-only:
+# it saves the metadata of the search pages (20 works per request) in the same columns.
+# Its _metadata.csv can also be given here as the input csv, e.g. to download the text
+# of a subset of the harvested works.
+#
+# --workers is the number of requests kept in flight at the same time (default 4).
+# --rps is the politeness budget in requests per second, shared by every
+# request the script sends (default 1/delay). Parsing and writing happen
+# while the next works are being downloaded. The rate adapts to the server:
+# on 429/5xx it honours Retry-After (or backs off exponentially) and slows
+# down, then slowly climbs back to --rps once requests succeed again.
+#
+# --pool-size is the number of keep-alive connections kept open (default workers + 2).
+# --timings prints the connect/TLS/wait/transfer timings of every request.
+# A summary of those timings is printed at the end of the run.
+#
+# --parser chooses the html parser backend for work pages: lxml (default when
+# installed), selectolax, strained (BeautifulSoup limited to the parts we read)
+# or bs4 (the reference). python ao3_parse.py page.html checks that a backend
+# gives the same rows as bs4.
+# --parse-workers is the number of processes that parse the downloaded pages
+# (default: number of cores - 1, 0 parses in the main process), so that a
+# huge work never stalls the downloads.
+#
+# --normalize chooses how the titles, tags, stats and texts are normalized (see
+# ao3_normalize.py): translit (unidecode to ascii, the default), nfkc (accents kept,
+# as the cleaning notebooks expect) or none. --refresh-stats must use the mode the csv
+# was written with, since it compares the stats.
+#
+# --stream parses each page while it downloads (lxml only) and copies its body
+# to the csv chunk by chunk, so memory stays flat even on works of 500k+ characters.
+#
+# --journal is the checkpoint journal (default journal_<csv> next to the output csv).
+# Every work is recorded there as done/skipped/failed right after its row is written
+# and synced to disk; the next run skips the works already done, so an interrupted
+# run is resumed by simply running the same command again.
+# --skip-failed also skips the works that failed (by default they are retried).
+#
+# --chapters is a directory caching the text of every chapter of multichapter fics.
+# A fic is then fetched as its first chapter page (metadata, chapter 1 and the list
+# of chapters) plus the chapters not cached yet, and its body is rebuilt from the
+# cache: re-scraping works in progress only downloads their new chapters.
+# It cannot be combined with --stream, --firstchap or --metadata-only.
+#
+# --parquet writes the fics as typed, sharded Parquet files in the given directory
+# instead of the csv (needs pyarrow): metadata and bodies go to separate shards, so
+# that metadata-only reads never load the texts (see ao3_columnar.load_corpus).
+# A fic is marked done in the journal once the shard holding it is written.
+#
+# Rows are written by a background writer thread: they are batched and flushed/fsynced
+# every --flush-rows rows or --flush-seconds seconds, and only then marked done in the
+# journal. --shard-rows starts a new csv file (<csv>-00000.csv, -00001.csv...) every
+# that many rows (default 0: a single csv).
+#
+# --refresh-stats updates the stats (language ... hits) of the fics already in --csv
+# instead of scraping them: it only requests the first-chapter page, conditionally
+# (ETag / If-Modified-Since kept in validators_<csv>), and rewrites the stats columns
+# of the rows whose stats changed, in place (in every --shard-rows file of --csv too).
+# Its requests are retried on 429 / 5xx like any page. Bodies are never downloaded nor touched.
+#
+# --queue jobs.sqlite (or redis://host:6379/0) lets several processes share the work:
+# the ids of the input (if any) are added to the job queue (see ao3_jobs.py), then every
+# process leases --workers ids at a time, writes them to its own csv
+# (<csv>_<worker>.csv, with its own journal) and records each result in the queue, so no
+# work is downloaded twice. Ids leased by a process that died go back to the others
+# after --lease-seconds. ao3_ids_modif.py --queue fills the same queue.
+#
+# --log-level debug shows a line per work (the default, info, only every 100 works);
+# --metrics-jsonl / --metrics-prom export the time spent in each stage (rate-limit
+# wait, fetch, parse, unidecode, write), the responses by status, the bytes received,
+# the retries and the works/hour, every --metrics-interval seconds (see ao3_metrics.py).
+#
+# The AO3_BASE_URL environment variable sends the requests to another server than
+# archiveofourown.org, e.g. the local mock of ao3_mock.py (see ao3_bench.py).
+#
+# --archive is an optional directory where every fetched page is stored,
+# compressed and content-addressed, with an index of work_id, url and fetch time.
+# --replay re-runs the whole parse/write pipeline from the --archive directory
+# without sending any request (pages missing from the archive are reported as errors).
 #######
 import requests
-from bs4 import BeautifulSoup
 import argparse
 import time
 import os
 import csv
-import sys
-from unidecode import unidecode
 import random
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from ao3_limiter import AdaptiveLimiter
+from ao3_session import create_session, BASE_URL
+from ao3_archive import HtmlArchive
+from ao3_parse import parse_work, build_row, available_backends, default_backend, FANFIC_HEADER
+from ao3_stream import parse_work_stream, CHUNK_SIZE
+from ao3_journal import Journal, journal_path, DONE, SKIPPED, FAILED
+from ao3_bookmarks import BookmarkCache, bookmark_page_url, parse_bookmark_page, merge_bookmarks
+from ao3_refresh import ValidatorStore, validators_path, scraped_stats, rewrite_stats
+from ao3_columnar import ParquetShardWriter, pa
+from ao3_writer import BackgroundWriter, RotatingCsvWriter, output_files, FLUSH_ROWS, FLUSH_SECONDS
+from ao3_chapters import ChapterStore, chapter_url, navigate_url, chapter_ids, navigate_ids, chapter_count
+from ao3_jobs import open_queue, default_worker, leased_keys, wait_for_others, WORK, LEASE_SECONDS
+from ao3_metrics import metrics, logger, setup_logging, unidecode_seconds, MetricsExporter, LEVELS, INTERVAL
+from ao3_normalize import set_mode, get_mode, same_language, MODES, DEFAULT_MODE
 
 # seconds to wait between page requests
 delay = 5
+# shared adaptive rate limiter, every request to AO3 goes through it (set in main)
+limiter = AdaptiveLimiter(1.0 / delay)
+# shared pooled http session (set in main)
+session = create_session()
+# raw html archive (--archive) and offline replay from it (--replay)
+archive = None
+replay = False
+# html parser backend used on work pages (see ao3_parse.py)
+parser_backend = default_backend()
+# --stream: parse pages while they download and copy bodies to the csv chunk by chunk
+stream_mode = False
+# checkpoint journal of the works already handled (set in main)
+journal = None
+# --bookmarks: cached bookmark lists and the threads fetching bookmark pages (set in main)
+bookmark_cache = None
+bookmark_pool = None
+# --chapters: cache of the chapter texts of multichapter fics (set in main)
+chapter_store = None
+# shared job queue (--queue) and name of this process in its leases
+job_queue = None
+worker_name = ''
 user_agents = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Safari/605.1.15",
@@ -69,234 +191,390 @@ user_agents = [
     "Mozilla/5.0 (Android 14; Mobile; rv:138.0) Gecko/138.0 Firefox/138.0"
 ]
 
+
+class FetchContext:
+    '''
+    state shared by the functions of a run: session, limiter, parser backend, archive,
+    journal, caches and job queue. the module globals above are the context of the
+    command line (see cli_context); ao3_api.Fetcher and ao3_pipeline.py build their
+    own, so that several runs can share a process without touching the globals.
+    '''
+
+    def __init__(self, session=None, limiter=None, parser_backend=None, archive=None, replay=False, stream_mode=False,
+                 journal=None, bookmark_cache=None, bookmark_pool=None, chapter_store=None, job_queue=None, worker_name=''):
+        self.session = session if session is not None else create_session()
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(1.0 / delay)
+        self.parser_backend = parser_backend or default_backend()
+        self.archive = archive
+        self.replay = replay
+        self.stream_mode = stream_mode
+        self.journal = journal
+        self.bookmark_cache = bookmark_cache
+        self.bookmark_pool = bookmark_pool
+        self.chapter_store = chapter_store
+        self.job_queue = job_queue
+        self.worker_name = worker_name
+
+
+def cli_context():
+    '''
+    the context of the command line, made of the module globals (set in main)
+    '''
+    return FetchContext(session, limiter, parser_backend, archive, replay, stream_mode, journal,
+                        bookmark_cache, bookmark_pool, chapter_store, job_queue, worker_name)
+
+
 def get_random_user_agent():
     return random.choice(user_agents)
 
-def get_tag_info(category, meta):
+def get_page(fic_id, url, headers, response_headers=None, context=None):
     '''
-    given a category and a 'work meta group, returns a list of tags (eg, 'rating' -> 'explicit')
+    returns (status, html) for url: read from the archive in replay mode,
+    downloaded otherwise (and then archived, if an archive is set).
+    html is the raw utf-8 bytes of the page, decoding is left to the parser.
+    a network error is returned as (name of the error, None), like a failed status.
+    response_headers, if given, is a dict filled with the headers of the answer.
     '''
+    context = context or cli_context()
+    if context.replay:
+        status, html = context.archive.load(url)
+        if status is None:
+            return 'Not archived', None
+        return status, html
+
+    context.limiter.acquire()
     try:
-        tag_list = meta.find("dd", class_=str(category) + ' tags').find_all(class_="tag")
-    except AttributeError as e:
-        return []
-    return [unidecode(result.text) for result in tag_list]
+        req = context.session.get(url, headers=headers)
+    except requests.exceptions.RequestException as e:
+        context.limiter.record(None)
+        return type(e).__name__, None
+    context.limiter.record(req.status_code, req.headers.get('Retry-After'))
+    if response_headers is not None:
+        response_headers.clear()
+        response_headers.update(req.headers)
+    if context.archive is not None and req.status_code == 200:
+        context.archive.store(fic_id, url, req.status_code, req.content)
+    return req.status_code, req.content
 
 
-def get_stats(meta):
+# get bookmarks by page
+def get_bookmarks(url, header_info, fic_id='', context=None):
     '''
-    returns a list of
-    language, published, status, date status, words, chapters, comments, kudos, bookmarks, hits
+    returns the users who bookmarked a fic, newest first.
+    page 1 gives the number of pages; the other pages are fetched concurrently
+    (each request still paced by the shared limiter and retried like a work page).
+    with a bookmark cache, only the pages added since the cached run are fetched and
+    merged with the cached list. the cache is only updated when every page was read.
     '''
-    categories = ['language', 'published', 'status', 'words', 'chapters', 'comments', 'kudos', 'bookmarks', 'hits']
+    context = context or cli_context()
+    user_agent = header_info if header_info else get_random_user_agent()
+    failed = []
+    downloaded = [1]
+
+    def fetch_pages(numbers):
+        numbers = list(numbers)
+        pages = list(context.bookmark_pool.map(lambda page: fetch_url(fic_id, bookmark_page_url(url, page), user_agent, context=context), numbers))
+        downloaded[0] += len(pages)
+        failed.extend(number for number, (status, src) in zip(numbers, pages) if src is None)
+        return [parse_bookmark_page(src)[0] for status, src in pages]
+
+    cached = context.bookmark_cache.get(fic_id) if context.bookmark_cache is not None else None
+    status, src = fetch_url(fic_id, url, user_agent, context=context)
+    if src is None:
+        logger.warning(f"Erreur {status} sur les bookmarks de {fic_id}, liste {'du cache' if cached is not None else 'vide'} gardée.")
+        return cached['users'] if cached is not None else []
+    bookmarks, max_pages = parse_bookmark_page(src)
+    logger.debug(f"Scraping bookmarks de {fic_id} ({max_pages} pages)...")
+
+    fetched_pages = 1
+    merged = None
+    if cached is not None:
+        # the new bookmarks are on the first pages: fetch as many pages as were added
+        fetched_pages = max(1, min(max_pages, max_pages - cached['pages'] + 1))
+        for users in fetch_pages(range(2, fetched_pages + 1)):
+            bookmarks += users
+        merged = merge_bookmarks(bookmarks, cached['users'])
+
+    if merged is None:
+        for users in fetch_pages(range(fetched_pages + 1, max_pages + 1)):
+            bookmarks += users
+    else:
+        bookmarks = merged
 
-    stats = list(map(lambda category: meta.find("dd", class_=category), categories))
+    if failed:
+        # an incomplete list would be the base of every later merge: the cache keeps the previous one
+        logger.warning(f"{len(failed)} page(s) de bookmarks de {fic_id} en échec, cache non mis à jour.")
+    elif context.bookmark_cache is not None:
+        context.bookmark_cache.put(fic_id, bookmarks, max_pages)
+
+    logger.debug(f"{len(bookmarks)} bookmarks pour {fic_id} : {downloaded[0]}/{max_pages} pages téléchargées"
+                 + (", le reste vient du cache." if merged is not None else "."))
+    return bookmarks
 
-    if not stats[2]:
-        stats[2] = stats[1]  # no explicit completed field -- one shot
-    try:
-        stats = [unidecode(stat.text) for stat in stats]
-    except AttributeError as e:  # for some reason, AO3 sometimes miss stat tags (like hits)
-        new_stats = []
-        for stat in stats:
-            if stat:
-                new_stats.append(unidecode(stat.text))
-            else:
-                new_stats.append('null')
-        stats = new_stats
-
-    stats[0] = stats[0].rstrip().lstrip()  # language has weird whitespace characters
-    # add a custom completed/updated field
-    status = meta.find("dt", class_="status")
-    if not status:
-        status = 'Completed'
-    else:
-        status = status.text.strip(':')
-    stats.insert(2, status)
 
-    return stats
+def work_url(fic_id, only_first_chap, metadata_only):
+    url = f'{BASE_URL}/works/{fic_id}?view_adult=true'
+    if not (only_first_chap or metadata_only):
+        url += '&amp;view_full_work=true'
+    return url
 
 
-def get_tags(meta):
+def fetch_fic(fic_id, only_first_chap, metadata_only, header_info='', context=None):
     '''
-    returns a list of lists, of
-    rating, category, fandom, pairing, characters, additional_tags
+    downloads the page of a fic, retrying on errors.
+    returns (status, html); html is None when every attempt failed.
+    safe to call from several threads: each attempt takes a token from the shared limiter.
+    in replay mode the page is read from the archive and never retried.
     '''
-    tags = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
-    return list(map(lambda tag: get_tag_info(tag, meta), tags))
+    context = context or cli_context()
+    return fetch_url(fic_id, work_url(fic_id, only_first_chap, metadata_only), header_info, context=context)
 
 
-# get kudos
-def get_kudos(meta):
-    if (meta):
-        users = []
-        ## hunt for kudos' contents
-        kudos = meta.contents
+def fetch_url(fic_id, url, header_info='', extra_headers=None, final=(200,), response_headers=None, context=None):
+    '''
+    retry loop of fetch_fic, for any page of a fic.
+    extra_headers are sent with every attempt (e.g. the conditional headers of --refresh-stats),
+    final lists the statuses returned at once (any other one is retried),
+    response_headers is filled as in get_page.
+    '''
+    context = context or cli_context()
+    max_retries = 3
+    for attempt in range(1, max_retries + 1):
+        headers = {'user-agent': header_info}
+        headers.update(extra_headers or {})
+        status, html = get_page(fic_id, url, headers, response_headers, context=context)
 
-        # extract user names
-        for kudo in kudos:
-            if kudo.name == 'a':
-                if 'more users' not in kudo.contents[0] and '(collapse)' not in kudo.contents[0]:
-                    users.append(kudo.contents[0])
+        if status in final:
+            return status, html
+        if context.replay:
+            break
 
-        return users
-    return []
+        # the limiter holds the next requests back for as long as the server asked
+        backoff = context.limiter.state()['backoff_remaining']
+        metrics.count('retries', kind='work')
+        logger.warning(f"Erreur {status} pour {fic_id} : tentative {attempt}/{max_retries}, attente {backoff:.0f} sec...")
 
+    return status, None
 
-# get author(s)
-def get_authors(meta):
-    tags = meta.contents
-    authors = []
 
-    for tag in tags:
-        if tag.name == 'a':
-            authors.append(tag.contents[0])
+def parse_work_timed(html, metadata_only, lang, backend):
+    '''
+    parse_work, also returning the seconds spent parsing and in unidecode (--normalize translit)
+    (top-level, so that the parse worker processes can run it)
+    '''
+    unidecode_seconds()
+    start = time.perf_counter()
+    parsed = parse_work(html, metadata_only, lang, backend=backend)
+    return parsed, time.perf_counter() - start, unidecode_seconds()
 
-    return authors
 
+def record_parse(timed):
+    '''
+    records the timings returned by parse_work_timed, returns the parsed page
+    '''
+    parsed, seconds, unidecoding = timed
+    metrics.observe('parse', seconds)
+    metrics.observe('unidecode', unidecoding)
+    return parsed
 
-# get bookmarks by page
-def get_bookmarks(url, header_info):
-    bookmarks = []
-    headers = {'user-agent': get_random_user_agent()}
-
-    req = requests.get(url, headers=headers)
-    src = req.text
-
-    time.sleep(delay)
-    soup = BeautifulSoup(src, 'html.parser')
-
-    sys.stdout.write('scraping bookmarks ')
-    sys.stdout.flush()
-
-    # find all pages
-    if (soup.find('ol', class_='pagination actions')):
-        pages = soup.find('ol', class_='pagination actions').findChildren("li", recursive=False)
-        max_pages = int(pages[-2].contents[0].contents[0])
-        count = 1
-
-        sys.stdout.write('(' + str(max_pages) + ' pages)')
-        sys.stdout.flush()
-
-        while count <= max_pages:
-            # extract each bookmark per user
-            tags = soup.findAll('h5', class_='byline heading')
-            bookmarks += get_users(tags)
-
-            # next page
-            count += 1
-            req = requests.get(url + '?page=' + str(count), headers=headers)
-            src = req.text
-            soup = BeautifulSoup(src, 'html.parser')
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            time.sleep(delay)
-    else:
-        tags = soup.findAll('h5', class_='byline heading')
-        bookmarks += get_users(tags)
 
-    print('')
-    return bookmarks
+def parse_page(html, metadata_only, lang, context=None):
+    context = context or cli_context()
+    return record_parse(parse_work_timed(html, metadata_only, lang, context.parser_backend))
 
 
-# get users form bookmarks
-def get_users(meta):
-    users = []
-    for tag in meta:
-        user = tag.findChildren("a", recursive=False)[0].contents[0]
-        users.append(user)
+def fetch_fic_chapters(fic_id, lang, header_info='', context=None):
+    '''
+    --chapters: downloads the first chapter page of a fic (metadata, text of chapter 1
+    and list of chapters) and only the chapters missing from the chapter cache, then
+    rebuilds the body from the cached chapters.
+    returns (status, parsed) like fetch_fic followed by parse_work; parsed is None
+    when a page could not be downloaded. when no chapter list can be read from the
+    pages, the whole work is downloaded at once instead, without the cache.
+    '''
+    context = context or cli_context()
+    status, html = fetch_url(fic_id, work_url(fic_id, True, False), header_info, context=context)
+    if html is None:
+        return status, None
+    result, fields = parse_page(html, False, lang, context=context)
+    if result != 'ok' or chapter_count(fields['stats']) <= 1:
+        return status, (result, fields)
+
+    ids = chapter_ids(html)
+    if not ids:
+        status, page = fetch_url(fic_id, navigate_url(fic_id), header_info, context=context)
+        if page is None:
+            return status, None
+        ids = navigate_ids(page)
+    if not ids:
+        # the index page was read but lists no chapter (layout change): fetch the full work
+        logger.warning(f"Aucun chapitre trouvé dans l'index de {fic_id}, téléchargement de l'œuvre complète.")
+        status, html = fetch_url(fic_id, work_url(fic_id, False, False), header_info, context=context)
+        if html is None:
+            return status, None
+        return status, parse_page(html, False, lang, context=context)
+    context.chapter_store.put(fic_id, ids[0], fields['body'])
+
+    bodies = [fields['body']]
+    for chapter_id in ids[1:]:
+        text = context.chapter_store.get(fic_id, chapter_id)
+        if text is None:
+            status, page = fetch_url(fic_id, chapter_url(fic_id, chapter_id), header_info, context=context)
+            if page is None:
+                return status, None
+            chapter_result, chapter_fields = parse_page(page, False, False, context=context)
+            if chapter_result != 'ok':
+                # a refused chapter page (access denied, no metadata) fails the fic like a failed download
+                logger.warning(f"Chapitre {chapter_id} de {fic_id} refusé ({chapter_result}).")
+                return chapter_result, None
+            text = chapter_fields['body']
+            context.chapter_store.put(fic_id, chapter_id, text)
+        bodies.append(text)
+    fields['body'] = '\n\n'.join(bodies)
+    return 200, (result, fields)
+
+
+def stream_fic(fic_id, only_first_chap, metadata_only, lang, header_info='', context=None):
+    '''
+    streaming counterpart of fetch_fic + parse_work: the page is parsed while it
+    is being downloaded (or read from the archive in replay mode) and its body is
+    spooled to a temporary file, so memory stays bounded whatever the length of the work.
+    returns (status, parsed, body); parsed is None when every attempt failed,
+    body is the temporary file holding the text (None unless parsed is 'ok').
+    '''
+    context = context or cli_context()
+    url = work_url(fic_id, only_first_chap, metadata_only)
+    headers = {'user-agent': header_info}
+
+    if context.replay:
+        status, f = context.archive.open(url)
+        if status is None:
+            return 'Not archived', None, None
+        with f:
+            result, fields, body = parse_work_stream(iter(lambda: f.read(CHUNK_SIZE), b''), metadata_only, lang)
+        return status, (result, fields), body
 
-    return users
+    max_retries = 3
+    for attempt in range(1, max_retries + 1):
+        context.limiter.acquire()
+        sink = None
+        try:
+            with context.session.get(url, headers=headers, stream=True) as req:
+                status = req.status_code
+                context.limiter.record(status, req.headers.get('Retry-After'))
+                if status == 200:
+                    sink = context.archive.open_writer(fic_id, url, status) if context.archive is not None else None
+                    complete = []
+
+                    def chunks():
+                        for chunk in req.iter_content(CHUNK_SIZE):
+                            if sink is not None:
+                                sink.write(chunk)
+                            yield chunk
+                        complete.append(True)
+
+                    result, fields, body = parse_work_stream(chunks(), metadata_only, lang)
+                    if sink is not None:
+                        # a page cut short (access denied, other language) is not archived
+                        if complete:
+                            sink.close()
+                        else:
+                            sink.abort()
+                    return status, (result, fields), body
+        except requests.exceptions.RequestException as e:
+            # connection lost before or while the page was read: retried like a failed status
+            if sink is not None:
+                sink.abort()
+            status = type(e).__name__
+            context.limiter.record(None)
 
+        backoff = context.limiter.state()['backoff_remaining']
+        metrics.count('retries', kind='work')
+        logger.warning(f"Erreur {status} pour {fic_id} : tentative {attempt}/{max_retries}, attente {backoff:.0f} sec...")
 
-def access_denied(soup):
-    if (soup.find(class_="flash error")):
-        return True
-    if (not soup.find(class_="work meta group")):
-        return True
-    return False
+    return status, None, None
 
 
-def write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info=''):
+def mark(fic_id, state, detail='', context=None):
+    '''
+    records the outcome of a fic in the checkpoint journal, if there is one
+    '''
+    context = context or cli_context()
+    metrics.count('works', state=state)
+    if context.journal is not None:
+        context.journal.record(fic_id, state, detail)
+    if context.job_queue is not None:
+        context.job_queue.complete(WORK, fic_id, state, detail)
+
+
+def write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info='', fetched=None, parsed=None, body=None, context=None):
     '''
     fic_id is the AO3 ID of a fic, found every URL /works/[id].
-    writer is a csv writer object
+    writer is a csv writer object (see ao3_writer.BackgroundWriter)
     the output of this program is a row in the CSV file containing all metadata
     and the fic content itself (excludes content if metadata_only=True).
     header_info should be the header info to encourage ethical scraping.
+    fetched is the (status, html) pair returned by fetch_fic when the page
+    was already downloaded by the fetch engine, parsed the (result, fields)
+    pair returned by parse_work when it was already parsed by a parse worker.
+    body is the temporary file returned by stream_fic in streaming mode: the body
+    is then copied from it into the csv instead of being read from fields, by the
+    writer, which closes it.
     '''
-    print(f"Scraping {fic_id}...")
-    url = f'http://archiveofourown.org/works/{fic_id}?view_adult=true'
-    if not (only_first_chap or metadata_only):
-        url += '&amp;view_full_work=true'
-
-    max_retries = 3
-    for attempt in range(1, max_retries + 1):
-        headers = {'user-agent': header_info}
-        req = requests.get(url, headers=headers)
-        status = req.status_code
-
-        if status == 200:
-            break
-
-        if status == 429:
-            print(f"Erreur 429 : tentative {attempt}/{max_retries}, attente 60 sec...")
-            time.sleep(60)
-        else:
-            print(f"Erreur {status} : tentative {attempt}/{max_retries}, attente 30 sec...")
-            time.sleep(30)
-
-    if status >= 400:
-        print(f"❌ Échec après {max_retries} tentatives. Fic {fic_id} ignorée.")
-        errorwriter.writerow([fic_id, status])
-        return False  # Signale un échec
-
-    soup = BeautifulSoup(req.text, 'html.parser')
-    if access_denied(soup):
-        print('Access Denied')
+    context = context or cli_context()
+    logger.debug(f"Scraping {fic_id}...")
+    if parsed is None:
+        if fetched is None:
+            fetched = fetch_fic(fic_id, only_first_chap, metadata_only, header_info, context=context)
+        status, html = fetched
+
+        if html is None:
+            logger.warning(f"❌ Échec après plusieurs tentatives. Fic {fic_id} ignorée.")
+            errorwriter.writerow([fic_id, status])
+            mark(fic_id, FAILED, status, context=context)
+            return False  # Signale un échec
+
+        parsed = parse_page(html, metadata_only, lang, context=context)
+
+    result, fields = parsed
+    if result == 'denied':
+        logger.info(f'Access Denied : {fic_id}')
         errorwriter.writerow([fic_id, 'Access Denied'])
+        mark(fic_id, FAILED, 'Access Denied', context=context)
         return False
 
-    meta = soup.find("dl", class_="work meta group")
-    author = get_authors(soup.find("h3", class_="byline heading"))
-    tags = get_tags(meta)
-    stats = get_stats(meta)
-    title = unidecode(soup.find("h2", class_="title heading").string).strip()
-    visible_kudos = get_kudos(soup.find('p', class_='kudos'))
-    hidden_kudos = get_kudos(soup.find('span', class_='kudos_expanded hidden'))
-    all_kudos = visible_kudos + hidden_kudos
-
-    if lang and lang != stats[0]:
-        print(f"Fic non en {lang}, ignorée.")
+    if result == 'lang':
+        logger.debug(f"Fic non en {lang}, ignorée.")
+        mark(fic_id, SKIPPED, 'lang', context=context)
         return False
 
-    all_bookmarks = get_bookmarks(f'http://archiveofourown.org/works/{fic_id}/bookmarks', header_info) if include_bookmarks else []
-
-    if not metadata_only:
-        content = soup.find("div", id="chapters")
-        chapters = content.select('p')
-        chaptertext = '\n\n'.join([unidecode(chapter.text) for chapter in chapters])
-    else:
-        chaptertext = ""
+    all_bookmarks = get_bookmarks(f'{BASE_URL}/works/{fic_id}/bookmarks', header_info, fic_id, context=context) if include_bookmarks else []
 
-    row = [fic_id, title, author] + [', '.join(tag) for tag in tags] + stats + [all_kudos, all_bookmarks, chaptertext]
+    row = build_row(fic_id, fields, all_bookmarks)
 
     try:
-        writer.writerow(row)
-        print("✅ Fic collectée avec succès.")
+        if body is not None:
+            writer.writerow_streamed(row[:-1], body)
+        else:
+            writer.writerow(row)
+        # the journal only records the rows the writer reports on disk
+        for done_id in writer.flush():
+            mark(done_id, DONE, context=context)
+        logger.debug("✅ Fic collectée avec succès.")
         return True  # Signale un succès
     except Exception as e:
-        print(f"❌ Erreur d’écriture pour {fic_id}: {e}")
-        errorwriter.writerow([fic_id, str(e)])
-        return False  # Signale un échec
+        # the writer is broken (disk full...) and refuses every row from now on, the error
+        # rows included: the run stops, and the fic, left out of the journal, is scraped again on resume
+        logger.error(f"❌ Erreur d’écriture pour {fic_id}, arrêt de la collecte : {e}")
+        raise
 
 
 
 def get_args():
     parser = argparse.ArgumentParser(description='Scrape and save some fanfic, given their AO3 IDs.')
     parser.add_argument(
-        'ids', metavar='IDS', nargs='+',
-        help='a single id, a space seperated list of ids, or a csv input filename')
+        'ids', metavar='IDS', nargs='*',
+        help='a single id, a space seperated list of ids, or a csv input filename (optional with --queue)')
     parser.add_argument(
         '--csv', default='fanfics.csv',
         help='csv output file name')
@@ -315,13 +593,108 @@ def get_args():
     parser.add_argument(
         '--bookmarks', action='store_true',
         help='retrieve bookmarks; ')
+    parser.add_argument(
+        '--bookmarks-cache', default='',
+        help='directory caching the bookmarks of each fic (default: bookmarks_<csv> next to the output csv)')
     parser.add_argument(
         '--metadata-only', action='store_true',
         help='only retrieve metadata')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of requests kept in flight at the same time')
+    parser.add_argument(
+        '--rps', type=float, default=1.0 / delay,
+        help='politeness budget, in requests per second, shared by all requests')
+    parser.add_argument(
+        '--pool-size', type=int, default=0,
+        help='number of keep-alive connections to keep open (default: workers + 2)')
+    parser.add_argument(
+        '--timings', action='store_true',
+        help='print connect/TLS/transfer timings for every request')
+    parser.add_argument(
+        '--chapters', default='',
+        help='directory caching the chapters of multichapter fics, so that only new chapters are downloaded')
+    parser.add_argument(
+        '--parquet', default='',
+        help='directory of sharded parquet output, written instead of the csv')
+    parser.add_argument(
+        '--flush-rows', type=int, default=FLUSH_ROWS,
+        help='rows written per batch before the output is synced to disk')
+    parser.add_argument(
+        '--flush-seconds', type=float, default=FLUSH_SECONDS,
+        help='maximum time a row waits before the output is synced to disk')
+    parser.add_argument(
+        '--shard-rows', type=int, default=0,
+        help='start a new csv file every that many rows (default 0: a single csv)')
+    parser.add_argument(
+        '--refresh-stats', action='store_true',
+        help='only refresh the stats of the fics already in --csv, without downloading their text')
+    parser.add_argument(
+        '--archive', default='',
+        help='directory where the raw html of every fetched page is archived')
+    parser.add_argument(
+        '--replay', action='store_true',
+        help='parse the pages stored in --archive instead of downloading them')
+    parser.add_argument(
+        '--parse-workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+        help='number of processes parsing the downloaded pages (0: parse in the main process)')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='parse pages while they download and keep memory bounded on very long works')
+    parser.add_argument(
+        '--journal', default='',
+        help='checkpoint journal file (default: journal_<csv> next to the output csv)')
+    parser.add_argument(
+        '--skip-failed', action='store_true',
+        help='do not retry the fics the journal reports as failed')
+    parser.add_argument(
+        '--parser', default=default_backend(), choices=available_backends(),
+        help='html parser backend for work pages (bs4 is the reference)')
+    parser.add_argument(
+        '--normalize', default=DEFAULT_MODE, choices=MODES,
+        help='normalization of the extracted texts: translit (unidecode, ascii), nfkc (accents kept) or none')
+    parser.add_argument(
+        '--queue', default='',
+        help='job queue shared with other processes (sqlite file or redis:// url)')
+    parser.add_argument(
+        '--worker', default='',
+        help='name of this process in the job queue (default: host-pid)')
+    parser.add_argument(
+        '--lease-seconds', type=float, default=LEASE_SECONDS,
+        help='time after which the ids leased by a stuck process are handed to another one')
+    parser.add_argument(
+        '--log-level', default='info', choices=LEVELS,
+        help='debug shows a line per work')
+    parser.add_argument(
+        '--metrics-jsonl', default='',
+        help='file receiving a json line of metrics every --metrics-interval seconds')
+    parser.add_argument(
+        '--metrics-prom', default='',
+        help='file rewritten with the metrics in the Prometheus text format every --metrics-interval seconds')
+    parser.add_argument(
+        '--metrics-interval', type=float, default=INTERVAL,
+        help='seconds between two metrics exports')
     args = parser.parse_args()
+    if not args.ids and not args.queue:
+        parser.error('give the ids to scrape (or a --queue to take them from)')
+    if args.queue and args.refresh_stats:
+        parser.error('--refresh-stats cannot be combined with --queue')
+    if args.replay and not args.archive:
+        parser.error('--replay needs an --archive directory')
+    if args.stream and 'lxml' not in available_backends():
+        parser.error('--stream needs lxml')
+    if args.parquet and pa is None:
+        parser.error('--parquet needs pyarrow')
+    if args.parquet and args.refresh_stats:
+        parser.error('--refresh-stats only works on csv output')
+    if args.chapters and (args.stream or args.firstchap or args.metadata_only):
+        parser.error('--chapters cannot be combined with --stream, --firstchap or --metadata-only')
     fic_ids = args.ids
     is_csv = (len(fic_ids) == 1 and '.csv' in fic_ids[0])
     csv_out = str(args.csv)
+    if args.queue:
+        # every process writes its own csv
+        csv_out = os.path.splitext(csv_out)[0] + '_' + (args.worker or default_worker()) + '.csv'
     headers = str(args.header)
     restart = str(args.restart)
     ofc = str(args.firstchap)
@@ -334,7 +707,9 @@ def get_args():
         ofc = False
     if lang == "":
         lang = False
-    return fic_ids, csv_out, headers, restart, is_csv, ofc, lang, include_bookmarks, metadata_only
+    workers = max(1, args.workers)
+    pool_size = args.pool_size if args.pool_size > 0 else workers + 2
+    return fic_ids, csv_out, headers, restart, is_csv, ofc, lang, include_bookmarks, metadata_only, workers, args.rps, pool_size, args.timings, args.archive, args.replay, args.parser, max(0, args.parse_workers), args.stream, args.journal, args.skip_failed, args.bookmarks_cache, args.refresh_stats, args.chapters, args.parquet, args.flush_rows, args.flush_seconds, max(0, args.shard_rows), args.queue, args.worker, args.lease_seconds, args.log_level, args.metrics_jsonl, args.metrics_prom, args.metrics_interval, args.normalize
 
 
 '''
@@ -351,75 +726,314 @@ def process_id(fic_id, restart, found):
         return False
 
 
+def load_fic_ids(fic_ids, is_csv, restart, skip_failed=False, lang=False, context=None):
+    '''
+    returns the list of ids to scrape, either from the command line or from the csv input
+    (read once), skipping everything before the restart id and every id the journal
+    already reports as done (or failed, with skip_failed).
+    with lang, the works whose language is known from the id csv (third column
+    written by ao3_ids_modif.py, or language column of a _metadata.csv) and differs
+    are dropped without being downloaded.
+    '''
+    context = context or cli_context()
+    lang_column = 2
+    if is_csv:
+        with open(fic_ids[0], 'r', newline="") as f_in:
+            candidates = [row for row in csv.reader(f_in) if row]
+        # metadata csv written by ao3_ids_modif.py --metadata
+        if candidates and candidates[0] == FANFIC_HEADER:
+            lang_column = FANFIC_HEADER.index('language')
+            candidates = candidates[1:]
+    else:
+        candidates = [[fic_id] for fic_id in fic_ids]
+
+    ids = []
+    found_restart = False if restart else True
+    skipped = 0
+    other_lang = 0
+    for row in candidates:
+        fic_id = row[0]
+        found_restart = process_id(fic_id, restart, found_restart)
+        if not found_restart or (context.journal is not None and (fic_id in context.journal or (skip_failed and fic_id in context.journal.failed))):
+            skipped += 1
+            continue
+        if lang and len(row) > lang_column and row[lang_column] and not same_language(lang, row[lang_column]):
+            other_lang += 1
+            continue
+        ids.append(fic_id)
+
+    if skipped:
+        print(f'Skipping {skipped} already processed fics')
+    if other_lang:
+        print(f'{other_lang} fanfictions non en {lang} ignorées sans être téléchargées.')
+    return ids
+
+
+def leased_fic_ids(batch, lease_seconds, context=None):
+    '''
+    --queue: ids leased from the job queue, batch at a time, until none is left;
+    ids this process already wrote (e.g. before a crash) are only reported done
+    '''
+    context = context or cli_context()
+    for fic_id in leased_keys(context.job_queue, context.worker_name, WORK, batch, lease_seconds):
+        if fic_id in context.journal:
+            context.job_queue.complete(WORK, fic_id, DONE)
+            continue
+        yield fic_id
+
+
+def refresh_fic(fic_id, validators, header_info='', context=None):
+    '''
+    conditional request for the light page of a fic, retried like any page (fetch_url).
+    returns (status, stats): stats is None when the page did not change (304) or could not be read.
+    '''
+    context = context or cli_context()
+    # header names are case-insensitive (ETag, Etag...)
+    received = requests.structures.CaseInsensitiveDict()
+    status, html = fetch_url(fic_id, work_url(fic_id, True, True), header_info,
+                             extra_headers=validators.headers(fic_id), final=(200, 304), response_headers=received, context=context)
+    if status != 200:
+        return status, None
+
+    result, fields = parse_work(html, True, False, backend=context.parser_backend)
+    if result != 'ok':
+        return result, None
+    validators.update(fic_id, received)
+    return status, fields['stats']
+
+
+def refresh_stats(fic_ids, is_csv, csv_out, workers, header_info='', context=None):
+    '''
+    --refresh-stats: refreshes the stats of the fics of csv_out (those of the input only),
+    then rewrites the stats columns of the rows whose stats changed, in csv_out and in
+    its --shard-rows files
+    '''
+    context = context or cli_context()
+    files = output_files(csv_out)
+    if not files:
+        print(f"❌ {csv_out} n'existe pas (ni ses fichiers -00000.csv...) : rien à rafraîchir.")
+        return
+    current = {}
+    for path in files:
+        current.update(scraped_stats(path))
+    ids = [fic_id for fic_id in load_fic_ids(fic_ids, is_csv, '', context=context) if fic_id in current]
+    validators = ValidatorStore(validators_path(csv_out))
+    print(f"Rafraîchissement des statistiques de {len(ids)} fanfictions de {', '.join(files)}...")
+
+    updates = {}
+    unchanged = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for fic_id, (status, stats) in zip(ids, pool.map(lambda fic_id: refresh_fic(fic_id, validators, header_info, context=context), ids)):
+            if status == 304 or (stats is not None and stats == current[fic_id]):
+                unchanged += 1
+            elif stats is None:
+                print(f"❌ Erreur {status} pour {fic_id}, statistiques inchangées.")
+                failed += 1
+            else:
+                updates[fic_id] = stats
+
+    rewritten = sum(rewrite_stats(path, updates) for path in files) if updates else 0
+    validators.save()
+    print(f"\n✅ Statistiques mises à jour : {rewritten} lignes, {unchanged} fanfictions inchangées, {failed} en échec.")
+    print(context.session.stats.summary())
+    print(context.limiter.summary())
+
+
+def scrape_fics(ids, total_fics, workers, parse_workers, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info='', context=None):
+    '''
+    two-stage engine:
+    - fetch stage: up to `workers` downloads run in a thread pool, paced by the shared limiter
+    - parse stage: the raw pages go to `parse_workers` processes which return the parsed
+      fields (with parse_workers=0 the main thread parses them itself)
+    in streaming mode the fetch threads parse the pages as they arrive and there is no parse stage,
+    likewise in chapter mode (--chapters), where the fetch threads assemble the chapters.
+    the main thread writes the rows, in input order.
+    ids may yield None when it has no id for now (see ao3_pipeline.queued_ids): the
+    rows already downloaded are then written and journaled instead of waiting for the next id.
+    returns the number of processed and failed fics.
+    '''
+    context = context or cli_context()
+    processed_fics = 0  # Fanfics traitées
+    failed_fics = 0  # Nombre d'échecs
+
+    ids = iter(ids)
+    in_flight = deque()  # (fic_id, fetch future)
+    parsing = deque()  # (fic_id, fetched, parse future or None)
+    # the parse processes normalize the texts as this one does
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers, initializer=set_mode, initargs=(get_mode(),)) if parse_workers > 0 and not context.stream_mode and context.chapter_store is None else None
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit_next():
+            nonlocal exhausted
+            for fic_id in ids:
+                if fic_id is None:
+                    return False
+                if context.stream_mode:
+                    future = pool.submit(stream_fic, fic_id, only_first_chap, metadata_only, lang, header_info, context=context)
+                elif context.chapter_store is not None:
+                    future = pool.submit(fetch_fic_chapters, fic_id, lang, header_info, context=context)
+                else:
+                    future = pool.submit(fetch_fic, fic_id, only_first_chap, metadata_only, header_info, context=context)
+                in_flight.append((fic_id, future))
+                return True
+            exhausted = True
+            return False
+
+        def start_parsing():
+            fic_id, future = in_flight.popleft()
+            fetched = future.result()
+            parse = None
+            if parse_pool is not None and fetched[1] is not None:
+                parse = parse_pool.submit(parse_work_timed, fetched[1], metadata_only, lang, context.parser_backend)
+            parsing.append((fic_id, fetched, parse))
+
+        try:
+            while in_flight or parsing or not exhausted:
+                # keep a few pages ready in advance so the workers never idle
+                while not exhausted and len(in_flight) < 2 * workers and submit_next():
+                    pass
+                # hand every downloaded page to the parse stage, without letting it pile up
+                while in_flight and len(parsing) < 2 * max(1, parse_workers) and (not parsing or in_flight[0][1].done()):
+                    start_parsing()
+                if not parsing:
+                    # no id for now and nothing left to write: journal the rows the writer synced meanwhile
+                    for done_id in writer.flush():
+                        mark(done_id, DONE, context=context)
+                    continue
+
+                fic_id, fetched, parse = parsing.popleft()
+                processed_fics += 1
+                pending, waited = writer.lag()
+                logger.log(logging.INFO if processed_fics % 100 == 0 else logging.DEBUG,
+                           f"Fanfiction {processed_fics}/{total_fics} en cours... ({pending} lignes en attente d'écriture depuis {waited:.0f} s)")
+                if context.stream_mode:
+                    status, parsed, body = fetched
+                    success = False
+                    try:
+                        success = write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info, fetched=(status, None), parsed=parsed, body=body, context=context)
+                    finally:
+                        # once written, the body belongs to the writer
+                        if body is not None and not success:
+                            body.close()
+                elif context.chapter_store is not None:
+                    status, parsed = fetched
+                    success = write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info, fetched=(status, None), parsed=parsed, context=context)
+                elif parse is not None:
+                    success = write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info, fetched=fetched, parsed=record_parse(parse.result()), context=context)
+                else:
+                    success = write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, header_info, fetched=fetched, context=context)
+                if not success:
+                    failed_fics += 1
+        finally:
+            if parse_pool is not None:
+                parse_pool.shutdown(cancel_futures=True)
+
+    return processed_fics, failed_fics
+
+
 def main():
-    fic_ids, csv_out, headers, restart, is_csv, only_first_chap, lang, include_bookmarks, metadata_only = get_args()
+    global limiter
+    global session
+    global archive
+    global replay
+    global parser_backend
+    global stream_mode
+    global journal
+    global bookmark_cache
+    global bookmark_pool
+    global chapter_store
+    global job_queue
+    global worker_name
+    fic_ids, csv_out, headers, restart, is_csv, only_first_chap, lang, include_bookmarks, metadata_only, workers, rps, pool_size, timings, archive_dir, replay, parser_backend, parse_workers, stream_mode, journal_file, skip_failed, bookmarks_dir, refresh, chapters_dir, parquet_dir, flush_rows, flush_seconds, shard_rows, queue_spec, worker, lease_seconds, log_level, metrics_jsonl, metrics_prom, metrics_interval, normalization = get_args()
     os.chdir(os.getcwd())
+    setup_logging(log_level)
+    set_mode(normalization)
+    limiter = AdaptiveLimiter(rps)
+    metrics.gauge_source(limiter.gauges)
+    exporter = MetricsExporter(metrics_jsonl, metrics_prom, metrics_interval)
+    session = create_session(pool_size, verbose=timings)
+    if archive_dir:
+        archive = HtmlArchive(archive_dir)
+        print(f"Archive HTML : {archive_dir} ({len(archive)} pages déjà archivées)")
+    if replay:
+        print("Mode replay : aucune requête ne sera envoyée.")
+    if chapters_dir:
+        chapter_store = ChapterStore(chapters_dir)
+        print(f"Cache des chapitres : {chapters_dir}")
 
     output_directory = os.path.dirname(csv_out)
     if output_directory and not os.path.isdir(output_directory):
         print("Creating output directory " + output_directory)
         os.mkdir(output_directory)
 
-    with open(csv_out, 'a', newline="") as f_out:
-        writer = csv.writer(f_out)
-        with open(os.path.join(os.path.dirname(csv_out), "errors_" + os.path.basename(csv_out)), 'a', newline="") as e_out:
-            errorwriter = csv.writer(e_out)
-
-            # Vérification si le fichier CSV a une en-tête
-            if os.stat(csv_out).st_size == 0:
-                print('Writing a header row for the csv.')
-                header = ['work_id', 'title', 'author', 'rating', 'category', 'fandom', 'relationship', 'character',
-                          'additional tags', 'language', 'published', 'status', 'status date', 'words', 'chapters',
-                          'comments', 'kudos', 'bookmarks', 'hits', 'all_kudos', 'all_bookmarks', 'body']
-                writer.writerow(header)
-
-            # Compteur pour afficher la progression
-            total_fics = 0
-            if is_csv:
-                with open(fic_ids[0], 'r', newline="") as f_in:
-                    total_fics = sum(1 for _ in csv.reader(f_in))  # Compter le nombre total de lignes
-
-            elif fic_ids:
-                total_fics = len(fic_ids)  # Si on donne une liste d’IDs directement
-
-            processed_fics = 0  # Fanfics traitées
-            failed_fics = 0  # Nombre d'échecs
-
-            if is_csv:
-                csv_fname = fic_ids[0]
-                with open(csv_fname, 'r+', newline="") as f_in:
-                    reader = csv.reader(f_in)
-                    found_restart = False if restart else True
-
-                    for row in reader:
-                        if not row:
-                            continue
-
-                        found_restart = process_id(row[0], restart, found_restart)
-                        if found_restart:
-                            processed_fics += 1
-                            print(f"Fanfiction {processed_fics}/{total_fics} en cours...")
-                            success = write_fic_to_csv(row[0], only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, headers)
-                            if not success:
-                                failed_fics += 1
-
-                            time.sleep(delay)
-                        else:
-                            print('Skipping already processed fic')
-
-            else:
-                for fic_id in fic_ids:
-                    processed_fics += 1
-                    print(f"Fanfiction {processed_fics}/{total_fics} en cours...")
-                    success = write_fic_to_csv(fic_id, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, headers)
-                    if not success:
-                        failed_fics += 1
-
-                    time.sleep(delay)
+    if refresh:
+        refresh_stats(fic_ids, is_csv, csv_out, workers, headers)
+        exporter.stop()
+        return
 
-            print(f"\n✅ Collecte terminée : {processed_fics} fanfictions traitées.")
-            print(f"❌ Nombre de fanfictions échouées : {failed_fics}")
+    journal = Journal(journal_file or journal_path(csv_out))
+    print(f"Journal : {journal.path} ({len(journal)} fanfictions déjà traitées, {len(journal.failed)} en échec)")
 
+    if include_bookmarks:
+        bookmark_cache = BookmarkCache(bookmarks_dir or os.path.join(os.path.dirname(csv_out), "bookmarks_" + os.path.splitext(os.path.basename(csv_out))[0]))
+        bookmark_pool = ThreadPoolExecutor(max_workers=workers)
 
-
-main()
+    with open(os.path.join(os.path.dirname(csv_out), "errors_" + os.path.basename(csv_out)), 'a', newline="") as e_out:
+        if parquet_dir:
+            sink = ParquetShardWriter(parquet_dir)
+            print(f"Sortie Parquet : {parquet_dir}")
+        else:
+            sink = RotatingCsvWriter(csv_out, shard_rows)
+        # the output files are only touched by the writer thread from now on
+        writer = BackgroundWriter(sink, e_out, flush_rows, flush_seconds)
+        errorwriter = writer.errorwriter
+
+        # Compteur pour afficher la progression : les IDs restants, lus en une seule passe
+        ids = load_fic_ids(fic_ids, is_csv, restart, skip_failed, lang) if fic_ids else []
+        total_fics = len(ids)
+
+        try:
+            if queue_spec:
+                job_queue = open_queue(queue_spec)
+                worker_name = worker or default_worker()
+                print(f"File de travail : {queue_spec} ({job_queue.add(WORK, ids)} nouvelles fanfictions ajoutées), processus {worker_name}")
+                processed_fics, failed_fics = 0, 0
+                while True:
+                    processed, failed = scrape_fics(leased_fic_ids(workers, lease_seconds), '?', workers, parse_workers, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, headers)
+                    processed_fics += processed
+                    failed_fics += failed
+                    # the ids still held by the writer are leased to this process until written
+                    for done_id in writer.sync():
+                        mark(done_id, DONE)
+                    # wait for the other processes, whose leases may expire
+                    if not wait_for_others(job_queue, worker_name, WORK):
+                        break
+            else:
+                processed_fics, failed_fics = scrape_fics(ids, total_fics, workers, parse_workers, only_first_chap, lang, include_bookmarks, metadata_only, writer, errorwriter, headers)
+        finally:
+            # the last batch (and parquet shard)
+            for done_id in writer.close():
+                mark(done_id, DONE)
+
+        print(f"\n✅ Collecte terminée : {processed_fics} fanfictions traitées.")
+        print(f"❌ Nombre de fanfictions échouées : {failed_fics}")
+        print(writer.summary())
+        print(session.stats.summary())
+        print(limiter.summary())
+        exporter.stop()
+        print(exporter.summary())
+        if job_queue is not None:
+            print(f"File de travail : {job_queue.counts(WORK)}")
+    journal.close()
+    if job_queue is not None:
+        job_queue.close()
+    if bookmark_pool is not None:
+        bookmark_pool.shutdown()
+
+
+
+# the guard keeps the parse worker processes from re-running main() when they
+# are started with the 'spawn' method (Windows, macOS)
+if __name__ == '__main__':
+    main()
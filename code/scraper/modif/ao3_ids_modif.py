@@ -6,16 +6,55 @@
 # Only retrieve multichapter fics
 # Modify search to include a list of tags
 #      (e.g. you want all fics tagged either "romance" or "fluff")
+# Only retrieve fics of a given language:
+#      --language_id fr adds AO3's own language filter to the search url,
+#      --lang Francais drops every blurb whose language differs.
+# The language of each blurb is saved as the third column of the csv,
+# so ao3_get_fanfic_modif.py --lang can skip works without downloading them.
+# Harvest the metadata shown on the search pages:
+#      --metadata also writes <out_csv>_metadata.csv, one row per work in the
+#      same columns as ao3_get_fanfic_modif.py --metadata-only (without the
+#      publication date and the lists of kudos/bookmarks, which the search
+#      page does not show), at one request per page of 20 works instead of
+#      one request per work.
+# Result pages are downloaded --workers at a time (default 4), for every tag of
+# --tag_csv at once, within the shared --rps budget: the first page of a search
+# gives its number of pages, so the crawl stops at the last page.
+# The ids already collected are kept in <out_csv>.ids, a sorted array memory-mapped
+# at startup (8 bytes per id); --bloom adds a Bloom filter in front of it.
+# AO3 stops paging a search after 5000 pages: --shard splits a bigger search
+# (or each tag) into disjoint sub-searches by word count, then by date of
+# update, until each fits under --page_cap pages (see ao3_shards.py), and
+# crawls them all like tags, sharing the collected ids. Shards start at
+# page 1 and --num_to_retrieve applies to each of them.
+# ao3_pipeline.py runs this crawl and the download of the works together.
+# --queue jobs.sqlite (or redis://host:6379/0) shares the crawl between several
+# processes: every result page of the searches becomes a job of the queue (see
+# ao3_jobs.py), each process leases pages, writes the ids it finds to its own
+# csv (<out_csv>_<worker>.csv) and adds them to the queue as work jobs for
+# ao3_get_fanfic_modif.py --queue. --num_to_retrieve is ignored in that mode.
+# --log_level debug shows a line per id; --metrics_jsonl / --metrics_prom export
+# the request, parse and rate-limit timings (see ao3_metrics.py).
 
 from bs4 import BeautifulSoup
 import re
-import time
 import requests
 import csv
 import sys
 import datetime
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from unidecode import unidecode
+from ao3_session import create_session
+from ao3_limiter import AdaptiveLimiter
+from ao3_parse import FANFIC_HEADER, parse_blurb
+from ao3_idstore import IdStore
+from ao3_shards import PAGE_CAP, ShardPlanError, plan_shards, set_search_param
+from ao3_metrics import metrics, logger, setup_logging, MetricsExporter, LEVELS, INTERVAL
+from ao3_jobs import open_queue, default_worker, wait_for_others, PAGE, WORK, DONE, FAILED, LEASE_SECONDS
+from ao3_normalize import set_mode, MODES, DEFAULT_MODE
 
 page_empty = False
 base_url = ""
@@ -25,11 +64,80 @@ num_recorded_fic = 0
 csv_name = ""
 multichap_only = ""
 tags = []
+lang = ""
+# write the metadata of each blurb to <csv_name>_metadata.csv
+harvest_metadata = False
+# number of result pages downloaded at the same time
+workers = 4
+# split searches over page_cap pages into sub-searches
+shard = False
+page_cap = PAGE_CAP
+# shared pooled http session, keeps the connection to AO3 alive between pages
+session = create_session(1)
+# 5 second delay between requests as per AO3's terms of service;
+# the limiter slows down further when AO3 answers 429 and honours Retry-After
+limiter = AdaptiveLimiter(1.0 / 5)
 
 # keep track of all processed ids to avoid repeats:
 # this is separate from the temporary batch of ids
-# that are written to the csv and then forgotten
+# that are written to the csv and then forgotten.
+# a compact id store persisted next to the csv (see ao3_idstore.py), set in load_existing_ids
 seen_ids = set()
+# front the id store with a Bloom filter
+use_bloom = False
+# called with (id, language) for every id written, e.g. by ao3_pipeline.py,
+# which downloads the works as their ids are found
+on_id = None
+# shared job queue (--queue) and name of this process in its leases
+job_queue = None
+worker_name = ""
+lease_seconds = LEASE_SECONDS
+# periodic export of the metrics, set in get_args
+exporter = None
+
+
+#
+# state of a crawl: session and limiter, options, ids already seen and progress
+# of the search being crawled. the module globals above are the context of the
+# command line (see cli_context); ao3_api.Harvester and ao3_pipeline.py build
+# their own, so that several crawls can share a process without touching the globals
+#
+class HarvestContext:
+    def __init__(self, session=None, limiter=None, workers=4, lang='', harvest_metadata=False, shard=False,
+                 page_cap=PAGE_CAP, base_url='', csv_name='', num_requested_fic=-1, seen_ids=None, on_id=None,
+                 job_queue=None, worker_name='', lease_seconds=LEASE_SECONDS):
+        self.workers = max(1, workers)
+        self.session = session if session is not None else create_session(self.workers)
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(1.0 / 5)
+        self.lang = lang
+        self.harvest_metadata = harvest_metadata
+        self.shard = shard
+        self.page_cap = page_cap
+        # tag_url builds the url of each tag from base_url
+        self.base_url = base_url
+        self.csv_name = csv_name
+        self.num_requested_fic = num_requested_fic
+        self.seen_ids = seen_ids if seen_ids is not None else set()
+        self.on_id = on_id
+        self.job_queue = job_queue
+        self.worker_name = worker_name
+        self.lease_seconds = lease_seconds
+        # page being read and progress of the current search (see reset)
+        self.url = base_url
+        self.page_empty = False
+        self.num_recorded_fic = 0
+
+
+#
+# the context of the command line, made of the module globals (set in get_args)
+#
+def cli_context():
+    context = HarvestContext(session, limiter, workers, lang, harvest_metadata, shard, page_cap, base_url, csv_name,
+                             num_requested_fic, seen_ids, on_id, job_queue, worker_name, lease_seconds)
+    context.url = url
+    context.page_empty = page_empty
+    context.num_recorded_fic = num_recorded_fic
+    return context
 
 
 #
@@ -51,6 +159,18 @@ def get_args():
     global num_requested_fic
     global multichap_only
     global tags
+    global session
+    global limiter
+    global lang
+    global harvest_metadata
+    global workers
+    global use_bloom
+    global shard
+    global page_cap
+    global job_queue
+    global worker_name
+    global lease_seconds
+    global exporter
 
     parser = argparse.ArgumentParser(description='Scrape AO3 work IDs given a search URL')
     parser.add_argument(
@@ -71,10 +191,80 @@ def get_args():
     parser.add_argument(
         '--tag_csv', default='',
         help='provide an optional list of tags; the retrieved fics must have one or more such tags')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of result pages downloaded at the same time (all sharing the --rps budget)')
+    parser.add_argument(
+        '--pool_size', type=int, default=0,
+        help='number of keep-alive connections to keep open')
+    parser.add_argument(
+        '--timings', action='store_true',
+        help='print connect/TLS/transfer timings for every request')
+    parser.add_argument(
+        '--rps', type=float, default=1.0 / 5,
+        help='maximum number of requests per second')
+    parser.add_argument(
+        '--language_id', default='',
+        help='AO3 language code (e.g. fr, en) added to the search url')
+    parser.add_argument(
+        '--lang', default='',
+        help='only keep fics whose language is this one (name as shown by AO3, e.g. Francais, or code, e.g. fr)')
+    parser.add_argument(
+        '--bloom', action='store_true',
+        help='keep a Bloom filter in front of the id store (faster checks of new ids on huge harvests)')
+    parser.add_argument(
+        '--shard', action='store_true',
+        help='split searches with more than --page_cap pages into sub-searches by word count and date')
+    parser.add_argument(
+        '--page_cap', type=int, default=PAGE_CAP,
+        help='number of pages AO3 serves for one search')
+    parser.add_argument(
+        '--metadata', action='store_true',
+        help='also save the metadata shown on the search pages to <out_csv>_metadata.csv')
+    parser.add_argument(
+        '--normalize', default=DEFAULT_MODE, choices=MODES,
+        help='normalization of the --metadata texts: translit (unidecode, ascii), nfkc (accents kept) or none')
+    parser.add_argument(
+        '--queue', default='',
+        help='job queue shared with other processes (sqlite file or redis:// url)')
+    parser.add_argument(
+        '--worker', default='',
+        help='name of this process in the job queue (default: host-pid)')
+    parser.add_argument(
+        '--lease_seconds', type=float, default=LEASE_SECONDS,
+        help='time after which a page leased by a stuck process is handed to another one')
+    parser.add_argument(
+        '--log_level', default='info', choices=LEVELS,
+        help='debug shows a line per id')
+    parser.add_argument(
+        '--metrics_jsonl', default='',
+        help='file receiving a json line of metrics every --metrics_interval seconds')
+    parser.add_argument(
+        '--metrics_prom', default='',
+        help='file rewritten with the metrics in the Prometheus text format every --metrics_interval seconds')
+    parser.add_argument(
+        '--metrics_interval', type=float, default=INTERVAL,
+        help='seconds between two metrics exports')
 
     args = parser.parse_args()
     url = args.url
+    if args.language_id:
+        url = set_language_id(url, args.language_id)
+    # add_tag_to_url builds the url of each tag from base_url
+    base_url = url
+    lang = str(args.lang)
     csv_name = str(args.out_csv)
+    harvest_metadata = args.metadata
+    set_mode(args.normalize)
+    use_bloom = args.bloom
+    shard = args.shard
+    page_cap = max(1, args.page_cap)
+    if args.queue:
+        job_queue = open_queue(args.queue)
+        worker_name = args.worker or default_worker()
+        lease_seconds = args.lease_seconds
+        # every process writes its own csv
+        csv_name = csv_name + "_" + worker_name
 
     # defaults to all
     if (str(args.num_to_retrieve) == 'a'):
@@ -95,123 +285,176 @@ def get_args():
             for row in tags_reader:
                 tags.append(row[0])
 
+    workers = max(1, args.workers)
+    # one keep-alive connection per worker by default
+    session = create_session(args.pool_size if args.pool_size > 0 else workers, verbose=args.timings)
+    limiter = AdaptiveLimiter(args.rps)
+    setup_logging(args.log_level)
+    metrics.gauge_source(limiter.gauges)
+    exporter = MetricsExporter(args.metrics_jsonl, args.metrics_prom, args.metrics_interval)
+
     header_info = str(args.header)
 
     return header_info
 
 
 #
-# navigate to a works listed page,
-# then extract all work ids
+# set AO3's language filter in a search url, so that
+# works in other languages are never listed at all
 #
-def get_ids(header_info='', max_retries=3, delay=2):
-    global page_empty
-    global seen_ids
-
-    page_number = 1
-    page_key = "page="
-    start = url.find(page_key)
-    if start != -1:
-        page_start_index = start + len(page_key)
-        page_end_index = url.find("&", page_start_index)
-        if page_end_index != -1:
-            page_number = int(url[page_start_index:page_end_index])
-        else:
-            page_number = int(url[page_start_index:])
-
-    print(f"\n[INFO] Récupération des fanfictions à partir de la page {page_number} de l'URL : {url}")
-
-    retries = 0
-    works = []
-
-    # Essayer plusieurs fois en cas d'échec
-    while retries < max_retries:
-        try:
-            headers = {'user-agent': header_info}
-            req = requests.get(url, headers=headers)
-
-            # Si le serveur répond par le code 429 (limite de requêtes atteinte), on attend et on réessaie
-            while req.status_code == 429:
-                print("Réponse 429 reçue, réessayer après un délai...")
-                time.sleep(10)  # Attente prolongée pour la réponse 429
-                req = requests.get(url, headers=headers)
-
-            soup = BeautifulSoup(req.text, "lxml")
+def set_language_id(search_url, language_id):
+    return set_search_param(search_url, 'language_id', language_id)
 
-            # Recherche des fanfictions sur la page
-            works = soup.select("li.work.blurb.group")
 
-            print(f"[INFO] Page actuelle : {url} - Nombre de fanfictions récupérées : {len(works)}")
-
-            if len(works) > 0:
-                break
-
-            else:
-                print(f"[INFO] Aucune fanfiction trouvée sur cette page. Essai {retries + 1}/{max_retries}.")
-                retries += 1
-                time.sleep(delay)
-
-        except requests.exceptions.RequestException as e:
-            print(f"[ERROR] Erreur de requête sur la page {url}: {e}")
-            retries += 1
-            time.sleep(delay)
-
-    if retries == max_retries and len(works) == 0:
-        print(f"[INFO] Échec après {max_retries} tentatives. La page {url} semble vide.")
-        page_empty = True
+#
+# language of a work blurb, as shown by AO3 (e.g. 'Francais' once unidecoded)
+# and as its code (the lang attribute, e.g. 'fr')
+#
+def get_blurb_language(blurb):
+    dd = blurb.find("dd", class_="language")
+    if dd is None:
+        return "", ""
+    return unidecode(dd.text).strip(), dd.get("lang", "")
 
-    ids = []
-    for idx, tag in enumerate(works, start=1):
-        t = tag.get('id')[5:]
 
-        print(f"[INFO] Récupération de l'ID {t} (Fanfiction {idx} sur la page {page_number})")
+def language_matches(wanted, name, code):
+    if not wanted:
+        return True
+    return unidecode(wanted).strip().lower() in (name.lower(), code.lower())
 
-        if t not in seen_ids:
-            ids.append(t)
-            seen_ids.add(t)
-            print(f"[SUCCÈS] L'ID {t} a été ajouté à la liste.")
-        else:
-            print(f"[DUPLICATA] L'ID {t} a déjà été collecté, ignoré.")
 
-    return ids
+#
+# page number of a search url (1 when it has no page indicator)
+#
+def page_number(search_url):
+    key = "page="
+    start = search_url.find(key)
+    if start == -1:
+        return 1
+    page_start_index = start + len(key)
+    page_end_index = search_url.find("&", page_start_index)
+    if page_end_index != -1:
+        return int(search_url[page_start_index:page_end_index])
+    return int(search_url[page_start_index:])
 
 
 #
-# update the url to move to the next page
+# url of a given page of a search
 # note that if you go too far, ao3 won't error,
 # but there will be no works listed
 #
-def update_url_to_next_page():
-    global url
+def page_url(search_url, page):
     key = "page="
-    start = url.find(key)
+    start = search_url.find(key)
 
     # there is already a page indicator in the url
     if (start != -1):
         # find where in the url the page indicator starts and ends
         page_start_index = start + len(key)
-        page_end_index = url.find("&", page_start_index)
+        page_end_index = search_url.find("&", page_start_index)
         # if it's in the middle of the url
         if (page_end_index != -1):
-            page = int(url[page_start_index:page_end_index]) + 1
-            url = url[:page_start_index] + str(page) + url[page_end_index:]
+            return search_url[:page_start_index] + str(page) + search_url[page_end_index:]
         # if it's at the end of the url
-        else:
-            page = int(url[page_start_index:]) + 1
-            url = url[:page_start_index] + str(page)
+        return search_url[:page_start_index] + str(page)
 
     # there is no page indicator, so we are on page 1
-    else:
-        # there are other modifiers
-        if (url.find("?") != -1):
-            url = url + "&page=2"
-        # there an no modifiers yet
+    if page == 1:
+        return search_url
+    # there are other modifiers
+    if (search_url.find("?") != -1):
+        return search_url + "&page=" + str(page)
+    # there an no modifiers yet
+    return search_url + "?page=" + str(page)
+
+
+#
+# number of the last page of a search, read from the pagination
+# block of any of its pages (1 when there is no pagination)
+#
+def last_page_number(soup):
+    pagination = soup.find("ol", class_="pagination")
+    if pagination is None:
+        return 1
+    numbers = [int(li.text.strip()) for li in pagination.find_all("li", recursive=False) if li.text.strip().isdigit()]
+    return max(numbers) if numbers else 1
+
+
+#
+# download a works listed page (from any thread: every request takes
+# a token from the shared limiter), then extract the blurbs:
+# returns ([(id, language name, language code, metadata or None)], last page),
+# or (None, None) when the page could not be downloaded in max_retries
+# attempts (429, 5xx answers and network errors all use up an attempt;
+# any other error status fails the page at once)
+#
+def fetch_page(search_page_url, header_info='', max_retries=3, context=None):
+    context = context or cli_context()
+    headers = {'user-agent': header_info}
+    for attempt in range(1, max_retries + 1):
+        try:
+            context.limiter.acquire()
+            req = context.session.get(search_page_url, headers=headers)
+            backoff = context.limiter.record(req.status_code, req.headers.get('Retry-After'))
+
+            # Si le serveur répond par le code 429 (limite de requêtes atteinte) ou par une erreur 5xx,
+            # le limiteur impose l'attente demandée (Retry-After) ou un délai exponentiel avant l'essai suivant
+            if req.status_code == 429 or req.status_code >= 500:
+                metrics.count('retries', kind='page')
+                logger.warning(f"Réponse {req.status_code} reçue pour {search_page_url}, nouvel essai dans {backoff:.0f} sec... (essai {attempt}/{max_retries})")
+                continue
+            # une page d'erreur (404...) n'est pas une page de résultats vide
+            if req.status_code != 200:
+                logger.error(f"[ERROR] Réponse {req.status_code} pour la page {search_page_url}.")
+                return None, None
+
+            with metrics.timer('parse'):
+                soup = BeautifulSoup(req.text, "lxml")
+                blurbs = []
+                for tag in soup.select("li.work.blurb.group"):
+                    language, code = get_blurb_language(tag)
+                    blurbs.append((tag.get('id')[5:], language, code, parse_blurb(tag) if context.harvest_metadata else None))
+                return blurbs, last_page_number(soup)
+
+        except requests.exceptions.RequestException as e:
+            metrics.count('retries', kind='page')
+            logger.error(f"[ERROR] Erreur de requête sur la page {search_page_url}: {e} (essai {attempt}/{max_retries})")
+            context.limiter.record(None)
+
+    return None, None
+
+
+#
+# keep the works of a downloaded page that are in the wanted language
+# and were not collected yet (with the language of each work,
+# and the metadata of its blurb when harvest_metadata is set)
+#
+def get_ids(blurbs, page, context=None):
+    context = context or cli_context()
+    logger.info(f"[INFO] Page actuelle : {context.url} - Nombre de fanfictions récupérées : {len(blurbs)}")
+
+    ids = []
+    for idx, (t, language, code, metadata) in enumerate(blurbs, start=1):
+        logger.debug(f"[INFO] Récupération de l'ID {t} (Fanfiction {idx} sur la page {page})")
+
+        if not language_matches(context.lang, language, code):
+            metrics.count('ids', outcome='lang')
+            logger.debug(f"[LANGUE] L'ID {t} est en {language}, ignoré.")
+        elif t not in context.seen_ids:
+            ids.append((t, language, metadata))
+            context.seen_ids.add(t)
+            metrics.count('ids', outcome='new')
+            logger.debug(f"[SUCCÈS] L'ID {t} a été ajouté à la liste.")
         else:
-            url = url + "?page=2"
+            metrics.count('ids', outcome='duplicate')
+            logger.debug(f"[DUPLICATA] L'ID {t} a déjà été collecté, ignoré.")
+
+    return ids
 
 
-# modify the base_url to include the new tag, and save to global url
-def add_tag_to_url(tag):
+# modify the base_url to include the new tag
+def tag_url(tag, context=None):
+    context = context or cli_context()
     # global url
     # key = "&work_search%5Bother_tag_names%5D="
     # if (base_url.find(key)):
@@ -222,19 +465,17 @@ def add_tag_to_url(tag):
     #     url = base_url + "&work_search%5Bother_tag_names%5D=" + tag
     #
     #
-    global url
     key = "&work_search%5Bother_tag_names%5D="
 
     # Encode le tag pour l'inclure correctement dans l'URL
     tag_encoded = requests.utils.quote(tag)
 
     # Si l'URL contient déjà le paramètre de tag, ajoute le nouveau tag
-    if (base_url.find(key) != -1):
-        start = base_url.find(key) + len(key)
-        new_url = base_url[:start] + tag_encoded + "%2C" + base_url[start:]
-        url = new_url
+    if (context.base_url.find(key) != -1):
+        start = context.base_url.find(key) + len(key)
+        return context.base_url[:start] + tag_encoded + "%2C" + context.base_url[start:]
     else:
-        url = base_url + key + tag_encoded
+        return context.base_url + key + tag_encoded
 
 
 #
@@ -243,16 +484,42 @@ def add_tag_to_url(tag):
 # include the url where it was found,
 # so an interrupted search can be restarted
 #
-def write_ids_to_csv(ids):
-    global num_recorded_fic
-    with open(csv_name + ".csv", 'a', newline="") as csvfile:
+def write_ids_to_csv(ids, context=None):
+    context = context or cli_context()
+    rows = []
+    metadata_rows = []
+    for id, language, metadata in ids:
+        if (not_finished(context=context)):
+            rows.append([id, context.url, language])
+            context.num_recorded_fic = context.num_recorded_fic + 1
+            if metadata is not None:
+                metadata_rows.append(metadata)
+        else:
+            break
+    # without a csv name (ao3_pipeline.py without --ids-csv) the ids are only handed to on_id
+    if context.csv_name:
+        with open(context.csv_name + ".csv", 'a', newline="") as csvfile:
+            wr = csv.writer(csvfile, delimiter=',')
+            wr.writerows(rows)
+        if metadata_rows:
+            write_metadata_to_csv(metadata_rows, context=context)
+    if context.on_id is not None:
+        for id, _, language in rows:
+            context.on_id(id, language)
+
+
+#
+# metadata rows go to their own csv, with the header
+# of ao3_get_fanfic_modif.py so both files read the same way
+#
+def write_metadata_to_csv(rows, context=None):
+    context = context or cli_context()
+    metadata_csv = context.csv_name + "_metadata.csv"
+    with open(metadata_csv, 'a', newline="") as csvfile:
         wr = csv.writer(csvfile, delimiter=',')
-        for id in ids:
-            if (not_finished()):
-                wr.writerow([id, url])
-                num_recorded_fic = num_recorded_fic + 1
-            else:
-                break
+        if csvfile.tell() == 0:
+            wr.writerow(FANFIC_HEADER)
+        wr.writerows(rows)
 
 
 #
@@ -261,14 +528,15 @@ def write_ids_to_csv(ids):
 # recorded doesn't update until it's actually written to the csv.
 # If you've gone too far and there are no more fic, end.
 #
-def not_finished():
-    if (page_empty):
+def not_finished(context=None):
+    context = context or cli_context()
+    if (context.page_empty):
         return False
 
-    if (num_requested_fic == -1):
+    if (context.num_requested_fic == -1):
         return True
     else:
-        if (num_recorded_fic < num_requested_fic):
+        if (context.num_recorded_fic < context.num_requested_fic):
             return True
         else:
             return False
@@ -287,20 +555,172 @@ def make_readme():
 
 # reset flags to run again
 # note: do not reset seen_ids
-def reset():
-    global page_empty
-    global num_recorded_fic
-    page_empty = False
-    num_recorded_fic = 0
+def reset(context=None):
+    context = context or cli_context()
+    context.page_empty = False
+    context.num_recorded_fic = 0
+
+
+#
+# crawl the given searches (one per tag, or just the search url):
+# the first page of each search gives its number of pages, then up to
+# 2 * workers pages (of any search) are downloaded at the same time,
+# paced by the shared limiter. The pages are written in order,
+# one search after the other, so the csv keeps the searched order.
+# A page that fails (after the retries of fetch_page) is reported and
+# skipped; a search whose first page fails is abandoned, since its
+# number of pages is unknown. Returns the urls of the failed pages.
+#
+def process_for_ids(searches, header_info='', context=None):
+    context = context or cli_context()
+    failed = []
+    crawls = [{'url': search, 'next': page_number(search), 'last': None, 'pages': deque(), 'done': False} for search in searches]
+
+    with ThreadPoolExecutor(max_workers=context.workers) as pool:
+        def submit(crawl):
+            page = crawl['next']
+            crawl['pages'].append((page, pool.submit(fetch_page, page_url(crawl['url'], page), header_info, context=context)))
+            crawl['next'] += 1
+
+        def fill():
+            # once the number of pages of a search is known, queue its other pages
+            for crawl in crawls:
+                # (a failed first page gives no number of pages)
+                if crawl['last'] is None and crawl['pages'] and crawl['pages'][0][1].done():
+                    crawl['last'] = crawl['pages'][0][1].result()[1]
+            in_flight = sum(len(crawl['pages']) for crawl in crawls)
+            queued = True
+            while queued and in_flight < 2 * context.workers:
+                queued = False
+                for crawl in crawls:
+                    if not crawl['done'] and crawl['last'] is not None and crawl['next'] <= crawl['last'] and in_flight < 2 * context.workers:
+                        submit(crawl)
+                        in_flight += 1
+                        queued = True
+
+        for crawl in crawls:
+            submit(crawl)
+
+        for crawl in crawls:
+            if len(searches) > 1:
+                print(f"[INFO] Récupération des fanfictions pour la recherche : {crawl['url']}")
+            reset(context=context)  # Réinitialise les variables de collecte pour chaque tag
+            while not_finished(context=context):
+                if not crawl['pages']:
+                    # fill() found every slot taken (e.g. by the first pages of many searches)
+                    if crawl['last'] is None or crawl['next'] > crawl['last']:
+                        break
+                    submit(crawl)
+                page, future = crawl['pages'].popleft()
+                blurbs, last = future.result()
+                context.url = page_url(crawl['url'], page)
+                if blurbs is None:
+                    failed.append(context.url)
+                    if crawl['last'] is None:
+                        # the pages of the search are only known from its first page
+                        logger.warning(f"[ATTENTION] Échec de la première page {context.url} : nombre de pages inconnu, recherche abandonnée.")
+                        break
+                    logger.warning(f"[ATTENTION] Échec de la page {context.url}, ignorée.")
+                else:
+                    if crawl['last'] is None:
+                        crawl['last'] = last
+                    if page == page_number(crawl['url']):
+                        print(f"[INFO] {crawl['last']} pages de résultats pour {crawl['url']}")
+                    write_ids_to_csv(get_ids(blurbs, page, context=context), context=context)
+                # the known number of pages tells when the search is over
+                if page >= crawl['last']:
+                    context.page_empty = True
+                fill()
+
+            crawl['done'] = True
+            for page, future in crawl['pages']:
+                future.cancel()
+            crawl['pages'].clear()
+
+    if failed:
+        print(f"[ATTENTION] {len(failed)} page(s) en échec (relancer la même commande les reprend, les IDs déjà collectés sont ignorés) :")
+        for page_key in failed:
+            print(f"    {page_key}")
+    return failed
+
+
+#
+# split each search over page_cap pages into shards that fit under it;
+# the probes (one first page per candidate shard) run workers at a time.
+# a probe that keeps failing raises ShardPlanError (see ao3_shards.py)
+#
+def plan_searches(searches, header_info='', context=None):
+    context = context or cli_context()
+    def probe(search_url):
+        # None when the page could not be read, never a guessed number of pages
+        return fetch_page(search_url, header_info, context=context)[1]
+
+    planned = []
+    with ThreadPoolExecutor(max_workers=context.workers) as pool:
+        for search in searches:
+            shards = plan_shards(page_url(search, 1), probe, context.page_cap, pool.map)
+            print(f"[INFO] {len(shards)} sous-recherche(s) pour {search}")
+            planned += shards
+    return planned
+
+
+#
+# --queue: add every result page of the searches to the job queue
+# (pages already known to the queue are left as they are).
+# a search whose first page fails is not queued at all, since its number
+# of pages is unknown; returns those searches
+#
+def enqueue_pages(searches, header_info='', context=None):
+    context = context or cli_context()
+    failed = []
+    with ThreadPoolExecutor(max_workers=context.workers) as pool:
+        for search, (blurbs, last) in zip(searches, pool.map(lambda search: fetch_page(search, header_info, context=context), searches)):
+            if blurbs is None:
+                logger.warning(f"[ATTENTION] Échec de la première page {search} : recherche non ajoutée à la file.")
+                failed.append(search)
+                continue
+            first = page_number(search)
+            added = context.job_queue.add(PAGE, [page_url(search, page) for page in range(first, max(first, last) + 1)])
+            print(f"[INFO] {added} nouvelles pages ajoutées à la file pour {search}")
+    if failed:
+        print(f"[ATTENTION] {len(failed)} recherche(s) non ajoutée(s) à la file (relancer la même commande les ajoute) :")
+        for search in failed:
+            print(f"    {search}")
+    return failed
 
 
-def process_for_ids(header_info=''):
-    while (not_finished()):
-        # 5 second delay between requests as per AO3's terms of service
-        time.sleep(5)
-        ids = get_ids(header_info)
-        write_ids_to_csv(ids)
-        update_url_to_next_page()
+#
+# --queue: lease result pages (workers at a time) until none is left,
+# write their ids to the csv of this process and queue them as works.
+# a page that could not be downloaded is recorded as failed in the queue,
+# never as done
+#
+def process_queued_pages(header_info='', context=None):
+    context = context or cli_context()
+    pages = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=context.workers) as pool:
+        while True:
+            leased = context.job_queue.lease(context.worker_name, PAGE, context.workers, context.lease_seconds)
+            if not leased:
+                # other processes may still hold pages, whose leases can expire
+                if not wait_for_others(context.job_queue, context.worker_name, PAGE):
+                    break
+                continue
+            for page_key, (blurbs, last) in zip(leased, pool.map(lambda key: fetch_page(key, header_info, context=context), leased)):
+                context.url = page_key
+                reset(context=context)
+                if blurbs is None:
+                    logger.warning(f"[ATTENTION] Échec de la page {context.url}, notée en échec dans la file.")
+                    context.job_queue.complete(PAGE, page_key, FAILED, 'download')
+                    failed += 1
+                    continue
+                ids = get_ids(blurbs, page_number(page_key), context=context)
+                write_ids_to_csv(ids, context=context)
+                context.job_queue.add(WORK, [id for id, _, _ in ids])
+                context.job_queue.complete(PAGE, page_key, DONE, len(ids))
+                pages += 1
+    print(f"[INFO] {pages} pages traitées par {context.worker_name}, {failed} en échec ; file : {context.job_queue.counts(PAGE)}")
 
 
 def load_existing_ids():
@@ -308,12 +728,11 @@ def load_existing_ids():
 
     if (os.path.exists(csv_name + ".csv")):
         print("skipping existing IDs...\n")
-        with open(csv_name + ".csv", 'r') as csvfile:
-            id_reader = csv.reader(csvfile)
-            for row in id_reader:
-                seen_ids.add(row[0])
     else:
         print("no existing file; creating new file...\n")
+    # memory-mapped sorted ids; only the rows written since the last run are read from the csv
+    seen_ids = IdStore(csv_name + ".ids", csv_name + ".csv", bloom=use_bloom)
+    print(f"{len(seen_ids)} IDs déjà collectés.\n")
 
 
 def main():
@@ -325,18 +744,27 @@ def main():
 
     print("Démarrage de la collecte des fanfictions...\n")
 
-    # Si des tags sont fournis, récupérer les fanfictions pour chaque tag
-    if len(tags):
-        for t in tags:
-            print(f"[INFO] Récupération des fanfictions pour le tag : {t}")
-            reset()  # Réinitialise les variables de collecte pour chaque tag
-            add_tag_to_url(t)  # Modifie l'URL pour inclure le tag
-            process_for_ids(header_info)  # Collecte des fanfictions avec la nouvelle URL
+    # Si des tags sont fournis, récupérer les fanfictions pour chaque tag (en parallèle)
+    searches = [tag_url(t) for t in tags] if len(tags) else [url]
+    if shard:
+        try:
+            searches = plan_searches(searches, header_info)
+        except ShardPlanError as e:
+            seen_ids.close()
+            sys.exit(f"❌ Découpage des recherches impossible, collecte non lancée : {e}")
+    if job_queue is not None:
+        enqueue_pages(searches, header_info)
+        process_queued_pages(header_info)
+        job_queue.close()
     else:
-        process_for_ids(header_info)
+        process_for_ids(searches, header_info)
 
+    seen_ids.close()
     print("Collecte terminée.")
+    print(session.stats.summary())
+    print(limiter.summary())
+    exporter.stop()
 
 
-
-main()
+if __name__ == '__main__':
+    main()
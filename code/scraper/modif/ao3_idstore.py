@@ -0,0 +1,194 @@
+######
+#
+# Compact persistent set of the work ids already collected.
+#
+# Instead of a python set of strings rebuilt from the whole id csv on
+# every start (about 100 bytes per id), the ids are kept in a sorted
+# array of unsigned 64-bit integers, <csv_name>.ids, next to the csv:
+#   8 bytes  magic (AO3IDS1)
+#   8 bytes  size of the csv covered by the array
+#   8 bytes per id, sorted (native byte order)
+# The file is memory-mapped on load and looked up by binary search, so
+# startup costs no parsing and memory is 8 bytes per id, paged in lazily.
+#
+# Ids added during a run are kept in a small set; on close the part of
+# the csv written since the covered size is read back and merged into
+# a new sorted file (written aside, then renamed). After a crash, the
+# next start reads that tail of the csv again, so the array always
+# matches the csv, which stays the reference.
+#
+# An optional Bloom filter (<csv_name>.ids.bloom, ~1.2 bytes per id)
+# answers most lookups of new ids without touching the array.
+#
+#######
+import array
+import bisect
+import csv
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+
+MAGIC = b'AO3IDS1\0'
+HEADER = struct.Struct('=8sQ')
+# merged ids are written this many at a time
+WRITE_CHUNK = 1 << 16
+
+
+def _csv_ids(csv_path, offset=0):
+    '''
+    integer ids of the first column of csv_path, from byte offset on
+    '''
+    with open(csv_path, 'r', newline="") as f:
+        f.seek(offset)
+        for row in csv.reader(f):
+            if row and row[0].isdigit():
+                yield int(row[0])
+
+
+class BloomFilter:
+    '''
+    bit array with k hash functions (slices of one blake2b digest)
+    '''
+
+    def __init__(self, bits, hashes=7, data=None):
+        self.bits = max(8, bits)
+        self.hashes = hashes
+        self.data = data if data is not None else bytearray((self.bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, bits_per_id=10):
+        return cls(max(1, capacity) * bits_per_id)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(struct.pack('=Q', value), digest_size=4 * self.hashes).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack('=QQ', self.bits, self.hashes))
+            f.write(self.data)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            bits, hashes = struct.unpack('=QQ', f.read(16))
+            return cls(bits, hashes, bytearray(f.read()))
+
+
+class IdStore:
+    '''
+    set of integer work ids backed by a sorted, memory-mapped array.
+    accepts ids as ints or digit strings.
+    '''
+
+    def __init__(self, path, csv_path, bloom=False):
+        self.path = path
+        self.csv_path = csv_path
+        self.bloom_path = path + '.bloom'
+        self.added = set()
+        self.file = None
+        self.map = None
+        self.ids = ()
+        self.covered = 0
+        self.bloom = None
+        self._open()
+
+        csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+        if csv_size < self.covered:
+            # the csv was replaced or truncated: rebuild from scratch
+            self._close_map()
+            self.covered = 0
+            self.ids = ()
+        # rows written after the last close (or all of them the first time)
+        if csv_size > self.covered:
+            self.added.update(_csv_ids(csv_path, self.covered))
+
+        if bloom:
+            if os.path.exists(self.bloom_path) and self.ids:
+                self.bloom = BloomFilter.load(self.bloom_path)
+            else:
+                self.bloom = BloomFilter.for_capacity(len(self.ids) + len(self.added) + 100000)
+                for value in self.ids:
+                    self.bloom.add(value)
+            for value in self.added:
+                self.bloom.add(value)
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            return
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.covered = HEADER.unpack(self.map[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not an id store")
+        self.ids = memoryview(self.map)[HEADER.size:].cast('Q')
+
+    def _close_map(self):
+        if isinstance(self.ids, memoryview):
+            self.ids.release()
+        self.ids = ()
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    def __contains__(self, work_id):
+        value = int(work_id)
+        if value in self.added:
+            return True
+        if self.bloom is not None and value not in self.bloom:
+            return False
+        return self._in_array(value)
+
+    def add(self, work_id):
+        value = int(work_id)
+        if value not in self:
+            self.added.add(value)
+            if self.bloom is not None:
+                self.bloom.add(value)
+
+    def close(self):
+        '''
+        merges the ids written to the csv since the last close into the array file
+        '''
+        csv_size = os.path.getsize(self.csv_path) if os.path.exists(self.csv_path) else 0
+        new = set(_csv_ids(self.csv_path, self.covered)) if csv_size > self.covered else set()
+        new = sorted(value for value in new if not self._in_array(value))
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, csv_size))
+            chunk = array.array('Q')
+            for value in heapq.merge(self.ids, new):
+                chunk.append(value)
+                if len(chunk) >= WRITE_CHUNK:
+                    chunk.tofile(f)
+                    chunk = array.array('Q')
+            chunk.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_map()
+        os.replace(tmp, self.path)
+        if self.bloom is not None:
+            self.bloom.save(self.bloom_path)
+        self.added = set()
+        self._open()
+
+    def _in_array(self, value):
+        i = bisect.bisect_left(self.ids, value)
+        return i < len(self.ids) and self.ids[i] == value
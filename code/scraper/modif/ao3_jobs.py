@@ -0,0 +1,243 @@
+######
+#
+# Job queue shared by several scraper processes.
+#
+# Each job is a (kind, key) pair: a result page of a search ('page', its
+# url) or a work ('work', its id). A worker leases a few pending jobs at a
+# time; a lease is exclusive until it expires (lease_seconds), so the jobs
+# of a worker that crashed or got stuck go back to the others. When a job
+# is handled the worker records its result (done, skipped or failed, with
+# a detail), and it is never handed out again. Adding a job that is already
+# known (pending, leased or finished) does nothing, so every worker can
+# enqueue the same input safely.
+#
+# Two backends with the same methods:
+#   SqliteJobQueue  one SQLite file (WAL mode) shared by the processes of a machine
+#   RedisJobQueue   any client speaking the Redis sorted set / hash commands
+#                   (redis-py, or a local stand-in such as fakeredis), for
+#                   workers spread over several machines
+# open_queue('jobs.sqlite') or open_queue('redis://host:6379/0') picks one.
+#
+#######
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+PAGE = 'page'
+WORK = 'work'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+LEASE_SECONDS = 600
+
+
+class SqliteJobQueue:
+    '''
+    job queue in a SQLite file; safe to share between threads and processes
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            kind TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT, leased_until REAL, attempts INTEGER NOT NULL DEFAULT 0, detail TEXT,
+            PRIMARY KEY (kind, key))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (kind, state, leased_until)')
+
+    def add(self, kind, keys):
+        '''
+        enqueues the keys not known yet, returns how many were added
+        '''
+        with self.lock:
+            before = self.db.total_changes
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany('INSERT OR IGNORE INTO jobs (kind, key) VALUES (?, ?)', [(kind, str(key)) for key in keys])
+            self.db.execute('COMMIT')
+            return self.db.total_changes - before
+
+    def lease(self, worker, kind, n=1, lease_seconds=LEASE_SECONDS):
+        '''
+        up to n pending (or expired) jobs of kind, leased to worker for lease_seconds, oldest first
+        '''
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                keys = [row[0] for row in self.db.execute(
+                    "SELECT key FROM jobs WHERE kind = ? AND (state = 'pending' OR (state = 'leased' AND leased_until < ?)) "
+                    "ORDER BY rowid LIMIT ?", (kind, now, n))]
+                self.db.executemany(
+                    "UPDATE jobs SET state = 'leased', worker = ?, leased_until = ?, attempts = attempts + 1 WHERE kind = ? AND key = ?",
+                    [(worker, now + lease_seconds, kind, key) for key in keys])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return keys
+
+    def complete(self, kind, key, state=DONE, detail=''):
+        '''
+        records the result of a job, which is never leased again
+        '''
+        with self.lock:
+            self.db.execute('UPDATE jobs SET state = ?, detail = ?, leased_until = NULL WHERE kind = ? AND key = ?',
+                            (state, str(detail), kind, str(key)))
+
+    def active(self, kind, exclude_worker=None):
+        '''
+        number of jobs of kind still to do: pending, or under a lease that has not expired
+        (not counting those of exclude_worker)
+        '''
+        with self.lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND (state = 'pending' OR "
+                "(state = 'leased' AND leased_until >= ? AND worker IS NOT ?))",
+                (kind, time.time(), exclude_worker)).fetchone()[0]
+
+    def leasable(self, kind):
+        '''
+        number of jobs of kind that lease() would hand out now
+        '''
+        with self.lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND (state = 'pending' OR (state = 'leased' AND leased_until < ?))",
+                (kind, time.time())).fetchone()[0]
+
+    def counts(self, kind):
+        '''
+        number of jobs of kind in each state
+        '''
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs WHERE kind = ? GROUP BY state', (kind,)))
+
+    def close(self):
+        self.db.close()
+
+
+class RedisJobQueue:
+    '''
+    job queue on a Redis-compatible server. per kind:
+      <prefix>:<kind>:pending   sorted set of the keys to do, by order of addition
+      <prefix>:<kind>:leased    sorted set of the leased keys, by lease expiry
+      <prefix>:<kind>:workers   hash key -> worker holding the lease
+      <prefix>:<kind>:results   hash key -> 'state detail' of the finished jobs
+    ZPOPMIN hands each pending key to one worker only; an expired lease goes back
+    to pending for the worker whose ZREM removes it.
+    '''
+
+    def __init__(self, client, prefix='ao3jobs'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, kind, name):
+        return f'{self.prefix}:{kind}:{name}'
+
+    def add(self, kind, keys):
+        added = 0
+        for key in keys:
+            key = str(key)
+            if self.client.hexists(self._key(kind, 'results'), key) or self.client.zscore(self._key(kind, 'leased'), key) is not None:
+                continue
+            added += self.client.zadd(self._key(kind, 'pending'), {key: self.client.incr(self._key(kind, 'seq'))}, nx=True)
+        return added
+
+    def _requeue_expired(self, kind):
+        leased = self._key(kind, 'leased')
+        for key in self.client.zrangebyscore(leased, '-inf', time.time()):
+            if self.client.zrem(leased, key):
+                self.client.zadd(self._key(kind, 'pending'), {key: 0}, nx=True)
+
+    def lease(self, worker, kind, n=1, lease_seconds=LEASE_SECONDS):
+        self._requeue_expired(kind)
+        keys = []
+        for key, _ in self.client.zpopmin(self._key(kind, 'pending'), n):
+            key = key.decode() if isinstance(key, bytes) else key
+            self.client.zadd(self._key(kind, 'leased'), {key: time.time() + lease_seconds})
+            self.client.hset(self._key(kind, 'workers'), key, worker)
+            keys.append(key)
+        return keys
+
+    def complete(self, kind, key, state=DONE, detail=''):
+        key = str(key)
+        self.client.hset(self._key(kind, 'results'), key, f'{state} {detail}'.strip())
+        self.client.zrem(self._key(kind, 'leased'), key)
+        # the lease may have expired and put the key back in pending meanwhile
+        self.client.zrem(self._key(kind, 'pending'), key)
+        self.client.hdel(self._key(kind, 'workers'), key)
+
+    def active(self, kind, exclude_worker=None):
+        count = self.client.zcard(self._key(kind, 'pending'))
+        workers = self._key(kind, 'workers')
+        for key in self.client.zrangebyscore(self._key(kind, 'leased'), time.time(), '+inf'):
+            holder = self.client.hget(workers, key)
+            holder = holder.decode() if isinstance(holder, bytes) else holder
+            if exclude_worker is None or holder != exclude_worker:
+                count += 1
+        return count
+
+    def leasable(self, kind):
+        return self.client.zcard(self._key(kind, 'pending')) + self.client.zcount(self._key(kind, 'leased'), '-inf', time.time())
+
+    def counts(self, kind):
+        counts = {'pending': self.client.zcard(self._key(kind, 'pending')),
+                  'leased': self.client.zcard(self._key(kind, 'leased'))}
+        for result in self.client.hvals(self._key(kind, 'results')):
+            state = (result.decode() if isinstance(result, bytes) else result).split(' ')[0]
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def close(self):
+        pass
+
+
+def open_queue(spec):
+    '''
+    RedisJobQueue for a redis:// (or rediss://) url, SqliteJobQueue for a file path
+    '''
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise RuntimeError("a redis job queue needs the redis package (pip install redis)")
+        return RedisJobQueue(redis.Redis.from_url(spec))
+    directory = os.path.dirname(spec)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return SqliteJobQueue(spec)
+
+
+def default_worker():
+    '''
+    name of this worker in the leases, unique per process
+    '''
+    return f'{os.uname().nodename}-{os.getpid()}' if hasattr(os, 'uname') else f'worker-{os.getpid()}'
+
+
+def leased_keys(queue, worker, kind, batch, lease_seconds=LEASE_SECONDS):
+    '''
+    yields the keys leased to worker, batch at a time, until no job of kind is left to lease
+    '''
+    while True:
+        keys = queue.lease(worker, kind, batch, lease_seconds)
+        if not keys:
+            return
+        yield from keys
+
+
+def wait_for_others(queue, worker, kind, poll_seconds=1.0):
+    '''
+    after a pass over the queue, waits while other workers still hold leases (which may expire).
+    returns True when jobs can be leased again (a new pass is needed), False when all is done.
+    '''
+    while not queue.leasable(kind):
+        if not queue.active(kind, exclude_worker=worker):
+            return False
+        time.sleep(poll_seconds)
+    return True
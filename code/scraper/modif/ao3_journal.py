@@ -0,0 +1,75 @@
+######
+#
+# Checkpoint journal of the works already handled by the scraper.
+#
+# One append-only csv line per work: work_id, state, detail, time, where
+# state is 'done' (row written), 'skipped' (e.g. not in the wanted language)
+# or 'failed'. Each line is flushed and fsynced right after the output row
+# it reports, so after a crash every work marked done really is in the csv.
+#
+# On startup the journal is loaded into sets: works already done are
+# skipped without scanning the input for a --restart id.
+#
+#######
+import csv
+import datetime
+import os
+import threading
+
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def journal_path(csv_out):
+    '''
+    default journal file for an output csv, next to it (like the errors_ file)
+    '''
+    return os.path.join(os.path.dirname(csv_out), "journal_" + os.path.basename(csv_out))
+
+
+class Journal:
+    '''
+    append-only journal; membership tests are O(1) set lookups
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path, 'r', newline="") as f:
+                for row in csv.reader(f):
+                    # a line cut by a crash is simply ignored
+                    if len(row) != 4:
+                        continue
+                    self._apply(row[0], row[1], row[2])
+        self.f = open(path, 'a', newline="")
+        self.writer = csv.writer(self.f)
+
+    def _apply(self, work_id, state, detail):
+        if state in (DONE, SKIPPED):
+            self.done.add(work_id)
+            self.failed.pop(work_id, None)
+        elif state == FAILED:
+            self.failed[work_id] = detail
+
+    def __contains__(self, work_id):
+        return work_id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def record(self, work_id, state, detail=''):
+        '''
+        appends a line and makes it durable before returning
+        '''
+        with self.lock:
+            self.writer.writerow([work_id, state, detail, datetime.datetime.now().isoformat(timespec='seconds')])
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._apply(work_id, state, str(detail))
+
+    def close(self):
+        self.f.close()
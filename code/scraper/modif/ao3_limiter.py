@@ -0,0 +1,171 @@
+######
+#
+# Shared politeness budget for the AO3 scrapers.
+#
+# Every request sent to archiveofourown.org, whatever the thread
+# it comes from, first takes a token from the same bucket. The
+# configured requests-per-second rate is therefore the only limit
+# on throughput, no matter how many requests are in flight.
+#
+# AdaptiveLimiter adds the reaction to the server: on 429/5xx it
+# honours Retry-After (or backs off exponentially with jitter) and
+# halves the rate; after a clean streak it adds a little rate back
+# (AIMD), up to the configured budget.
+#
+#######
+import email.utils
+import random
+import threading
+import time
+
+from ao3_metrics import metrics
+
+
+class TokenBucket:
+    '''
+    thread-safe token bucket.
+    rate is the number of requests allowed per second,
+    burst is how many tokens can pile up while the scraper is idle.
+    '''
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be a positive number of requests per second")
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        '''
+        blocks until a token is available, then consumes it.
+        returns the number of seconds spent waiting.
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def parse_retry_after(value):
+    '''
+    returns the delay in seconds asked by a Retry-After header
+    (either a number of seconds or an http date), or None
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class AdaptiveLimiter(TokenBucket):
+    '''
+    token bucket whose rate follows the server's answers (AIMD):
+    - 429, 5xx and network errors (status None): the rate is multiplied by `decrease` and every thread waits
+      for Retry-After, or for an exponential backoff with jitter when there is none
+    - after `clean_streak` successful requests in a row the rate grows by
+      `increase` requests per second, never above max_rate
+    '''
+
+    def __init__(self, rate, min_rate=None, decrease=0.5, increase=None, clean_streak=20,
+                 base_backoff=30, max_backoff=600):
+        super().__init__(rate)
+        self.max_rate = self.rate
+        self.min_rate = min_rate if min_rate else self.rate / 16
+        self.decrease = decrease
+        self.increase = increase if increase else self.max_rate / 10
+        self.clean_streak = clean_streak
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.backoff_until = 0.0
+        self.failures = 0
+        self.streak = 0
+        self.throttled = 0
+        self.backoff_total = 0.0
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                pause = self.backoff_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+            waited += pause
+        waited += super().acquire()
+        metrics.observe('queue_wait', waited)
+        return waited
+
+    def record(self, status, retry_after=None):
+        '''
+        feeds the status code (and Retry-After header) of a response to the controller.
+        returns the backoff delay in seconds, 0 when the server is healthy.
+        '''
+        with self.lock:
+            if status is not None and status != 429 and not (isinstance(status, int) and status >= 500):
+                self.failures = 0
+                self.streak += 1
+                if self.streak >= self.clean_streak:
+                    self.rate = min(self.max_rate, self.rate + self.increase)
+                    self.streak = 0
+                return 0.0
+
+            self.failures += 1
+            self.throttled += 1
+            self.streak = 0
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+            delay = parse_retry_after(retry_after)
+            if delay is None:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+                delay = random.uniform(delay / 2, delay)
+            now = time.monotonic()
+            if now + delay > self.backoff_until:
+                self.backoff_total += now + delay - max(now, self.backoff_until)
+                self.backoff_until = now + delay
+            return delay
+
+    def state(self):
+        '''
+        returns the current rate and backoff state
+        '''
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'max_rate': self.max_rate,
+                'backoff_remaining': max(0.0, self.backoff_until - time.monotonic()),
+                'consecutive_failures': self.failures,
+                'clean_streak': self.streak,
+                'throttled_responses': self.throttled,
+                'backoff_total': self.backoff_total,
+            }
+
+    def gauges(self):
+        '''
+        the state exported as metrics gauges (see ao3_metrics)
+        '''
+        state = self.state()
+        return {'rate_rps': state['rate'], 'backoff_seconds': state['backoff_total'], 'throttled_responses': state['throttled_responses']}
+
+    def summary(self):
+        state = self.state()
+        return (f"[DÉBIT] {state['rate']:.3f} req/s (max {state['max_rate']:.3f}) | "
+                f"{state['throttled_responses']} réponses 429/5xx, {state['backoff_total']:.0f} s de pause au total")
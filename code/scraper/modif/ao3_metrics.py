@@ -0,0 +1,222 @@
+######
+#
+# Metrics and logging of the scrapers.
+#
+# One Metrics object per process (`metrics`) records:
+#   - the time spent in each stage (rate-limit queue wait, fetch, parse,
+#     unidecode, write...), as a count, a total and a maximum
+#   - counters with labels: responses by status code, response bytes,
+#     retries, works by outcome, ids found...
+#   - gauges read when exporting (rate and backoff of the limiter...)
+# and exports them:
+#   - as JSON lines (one snapshot per line, --metrics-jsonl FILE), every
+#     --metrics-interval seconds and at the end of the run
+#   - in the Prometheus text exposition format (--metrics-prom FILE, rewritten
+#     atomically, e.g. for the textfile collector of node_exporter)
+# The works/hour rate is derived from the 'works' counter of the works written
+# (state done, not the skipped or failed ones) and the uptime.
+#
+# The per-work and per-id messages go through the 'ao3' logger: they are
+# only shown with --log-level debug, warnings and errors always are.
+#
+#######
+import json
+import logging
+import os
+import threading
+import time
+
+from unidecode import unidecode
+
+from ao3_journal import DONE
+
+LEVELS = ['debug', 'info', 'warning', 'error']
+INTERVAL = 60.0
+
+logger = logging.getLogger('ao3')
+
+
+def setup_logging(level='info'):
+    '''
+    plain messages on stdout, like the prints they replace, from the given level on
+    '''
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(getattr(logging, level.upper()))
+
+
+_local = threading.local()
+
+
+def timed_unidecode(text):
+    '''
+    unidecode, adding its duration to a per-thread total (see unidecode_seconds)
+    '''
+    start = time.perf_counter()
+    result = unidecode(text)
+    _local.unidecode = getattr(_local, 'unidecode', 0.0) + time.perf_counter() - start
+    return result
+
+
+def unidecode_seconds(reset=True):
+    '''
+    time spent in timed_unidecode by the calling thread (since the last reset)
+    '''
+    spent = getattr(_local, 'unidecode', 0.0)
+    if reset:
+        _local.unidecode = 0.0
+    return spent
+
+
+def _label_text(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics:
+    '''
+    thread-safe stage timings, labelled counters and gauges of one process
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = []
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            count, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds, max(longest, seconds))
+
+    def timer(self, stage):
+        '''
+        context manager timing its block as one observation of stage
+        '''
+        return _Timer(self, stage)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge_source(self, source):
+        '''
+        source() returns a dict of gauge values, read at every export
+        '''
+        self.gauges.append(source)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def snapshot(self):
+        '''
+        every metric as a json-serialisable dict
+        '''
+        now = time.time()
+        gauges = {}
+        for source in self.gauges:
+            gauges.update(source())
+        with self.lock:
+            uptime = now - self.started
+            works = self.counters.get(('works', (('state', DONE),)), 0)
+            return {
+                'time': round(now, 3),
+                'uptime_seconds': round(uptime, 3),
+                'works_per_hour': round(3600 * works / uptime, 1) if uptime > 0 else 0.0,
+                'stages': {stage: {'count': count, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                           for stage, (count, total, longest) in sorted(self.stages.items())},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'gauges': gauges,
+            }
+
+    def prometheus(self):
+        '''
+        every metric in the Prometheus text exposition format
+        '''
+        snap = self.snapshot()
+        lines = ['# TYPE ao3_uptime_seconds gauge', f"ao3_uptime_seconds {snap['uptime_seconds']}",
+                 '# TYPE ao3_works_per_hour gauge', f"ao3_works_per_hour {snap['works_per_hour']}",
+                 '# TYPE ao3_stage_seconds summary']
+        for stage, values in snap['stages'].items():
+            lines.append(f'ao3_stage_seconds_sum{{stage="{stage}"}} {values["seconds"]}')
+            lines.append(f'ao3_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+        lines.append('# TYPE ao3_stage_max_seconds gauge')
+        for stage, values in snap['stages'].items():
+            lines.append(f'ao3_stage_max_seconds{{stage="{stage}"}} {values["max_seconds"]}')
+        typed = set()
+        for counter in snap['counters']:
+            name = f"ao3_{counter['name']}_total"
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            labels = _label_text(sorted(counter['labels'].items()))
+            lines.append(f"{name}{{{labels}}} {counter['value']}" if labels else f"{name} {counter['value']}")
+        for name, value in sorted(snap['gauges'].items()):
+            lines.append(f'# TYPE ao3_{name} gauge')
+            lines.append(f'ao3_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsExporter:
+    '''
+    writes a snapshot of metrics to jsonl_path (appended) and prom_path (replaced)
+    every interval seconds from a background thread, and once more on stop()
+    '''
+
+    def __init__(self, jsonl_path='', prom_path='', interval=INTERVAL, source=metrics):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self.source = source
+        self.stopped = threading.Event()
+        self.thread = None
+        if (jsonl_path or prom_path) and interval > 0:
+            self.thread = threading.Thread(target=self._run, name='ao3-metrics', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(self.source.snapshot(), ensure_ascii=False) + '\n')
+        if self.prom_path:
+            tmp = self.prom_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(self.source.prometheus())
+            os.replace(tmp, self.prom_path)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+
+    def summary(self):
+        snap = self.source.snapshot()
+        stages = ', '.join(f"{stage} {values['seconds']:.1f} s" for stage, values in snap['stages'].items())
+        return f"[MÉTRIQUES] {snap['works_per_hour']:.0f} fanfictions/heure | {stages}"
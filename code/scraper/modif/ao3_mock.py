@@ -0,0 +1,301 @@
+######
+#
+# Local stand-in for AO3, to run and benchmark the scrapers offline.
+#
+# Usage - python ao3_mock.py [--port 8000] [--works 1000] [--words 2000] [--chapters 3] [options]
+#
+# Serves synthetic pages with the structure the scrapers read:
+#   /works?...  /tags/<tag>/works?...   search result pages (li.work.blurb.group,
+#                                       20 per page, ol.pagination), honouring
+#                                       page=, work_search[word_count] and the
+#                                       revised_at:[a TO b] of work_search[query]
+#   /works/<id>                          work page (dl.work.meta.group, div#chapters:
+#                                       first chapter and chapter menu, or every
+#                                       chapter with view_full_work=true)
+#   /works/<id>/chapters/<chapter id>    one chapter
+#   /works/<id>/navigate                 chapter index
+#   /works/<id>/bookmarks?page=N         bookmarks (--bookmarks per work, 20 per page)
+# Every work has --words words (French text, with accents) split over --chapters
+# chapters. --error-rate is the share of requests answered by an injected error,
+# half 429 with a Retry-After of --retry-after seconds, half 503; --latency
+# delays every response. The error draws are seeded (--seed), so two runs with
+# the same options see the same errors in the same order of requests.
+#
+# Point the scrapers at it with AO3_BASE_URL=http://127.0.0.1:8000 (work, chapter
+# and bookmark urls) and a search url of the mock, e.g.
+#   http://127.0.0.1:8000/tags/Fluff/works?page=1
+# ao3_bench.py starts it in-process and runs the scrapers against it.
+#
+#######
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+PER_PAGE = 20
+WORDS = ['le', 'la', 'les', 'un', 'une', 'et', 'mais', 'donc', 'élève', 'château', 'forêt', 'cœur', 'été',
+         'hiver', 'lumière', 'ombre', 'regard', 'silence', 'fenêtre', 'peut-être', 'déjà', 'très', 'où',
+         'garçon', 'fille', 'baguette', 'sortilège', 'dragon', 'rêve', 'noël', 'à', 'ça', 'même', 'près']
+FIRST_CHAPTER_ID = 1000
+
+
+def _text(n_words, rng):
+    '''
+    n_words of French text in paragraphs of about 100 words
+    '''
+    paragraphs = []
+    while n_words > 0:
+        size = min(n_words, rng.randint(60, 140))
+        paragraphs.append('<p>' + ' '.join(rng.choice(WORDS) for _ in range(size)).capitalize() + '.</p>')
+        n_words -= size
+    return '\n'.join(paragraphs)
+
+
+def pagination(page, pages):
+    '''
+    AO3 pagination block: previous, first pages, gap, last pages, next (empty for a single page)
+    '''
+    if pages <= 1:
+        return ''
+    numbers = sorted(set(range(1, min(pages, 9) + 1)) | {pages - 1, pages, page})
+    items, previous = ['<li class="previous">&larr; Previous</li>'], 0
+    for number in numbers:
+        if number - previous > 1:
+            items.append('<li class="gap">&hellip;</li>')
+        items.append(f'<li><span class="current">{number}</span></li>' if number == page
+                     else f'<li><a href="?page={number}">{number}</a></li>')
+        previous = number
+    items.append('<li class="next">Next &rarr;</li>')
+    return '<ol class="pagination actions" role="navigation">' + ''.join(items) + '</ol>'
+
+
+class MockAO3:
+    '''
+    the synthetic archive: builds the pages and decides which requests get an injected error
+    '''
+
+    def __init__(self, works=1000, words=2000, chapters=3, bookmarks=45, error_rate=0.0, retry_after=1, latency=0.0, seed=0):
+        self.words = words
+        self.chapters = max(1, chapters)
+        self.bookmarks = bookmarks
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.stats = {'requests': 0, 'bytes': 0, 'statuses': {}, 'kinds': {}}
+        # (id, word count, last update) of every work, spread like the sharding needs
+        start = datetime.date(2009, 1, 1)
+        self.works = [(i, (i * 7919) % 20000 if i % 10 else 1234, start + datetime.timedelta(days=(i * 37) % 5000))
+                      for i in range(1, works + 1)]
+        # the chapter texts are the same for every work (only the work pages differ), built once
+        rng = random.Random(seed)
+        per_chapter = max(1, words // self.chapters)
+        self.texts = [_text(per_chapter, rng) for _ in range(self.chapters)]
+
+    def _count(self, kind, status, size):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+            self.stats['statuses'][str(status)] = self.stats['statuses'].get(str(status), 0) + 1
+            self.stats['kinds'][kind] = self.stats['kinds'].get(kind, 0) + 1
+
+    def injected_error(self):
+        '''
+        None, or the (status, headers) of the error this request gets
+        '''
+        with self.lock:
+            if self.error_rate <= 0 or self.rng.random() >= self.error_rate:
+                return None
+            if self.rng.random() < 0.5:
+                return 429, {'Retry-After': str(self.retry_after)}
+            return 503, {}
+
+    def respond(self, target):
+        '''
+        (kind, status, headers, body) of the response to a request target (path?query)
+        '''
+        parts = urlsplit(target)
+        query = parse_qs(parts.query)
+        path = parts.path.rstrip('/')
+        if path == '/works' or re.fullmatch(r'/tags/[^/]+/works', path):
+            kind, build = 'search', lambda: self.search_page(query)
+        elif m := re.fullmatch(r'/works/(\d+)', path):
+            kind, build = 'work', lambda: self.work_page(int(m.group(1)), 'view_full_work' in parts.query)
+        elif m := re.fullmatch(r'/works/(\d+)/chapters/(\d+)', path):
+            kind, build = 'chapter', lambda: self.chapter_page(int(m.group(1)), int(m.group(2)) - FIRST_CHAPTER_ID + 1)
+        elif m := re.fullmatch(r'/works/(\d+)/navigate', path):
+            kind, build = 'navigate', lambda: self.navigate_page(int(m.group(1)))
+        elif m := re.fullmatch(r'/works/(\d+)/bookmarks', path):
+            kind, build = 'bookmarks', lambda: self.bookmark_page(int(m.group(1)), int(query.get('page', ['1'])[0]))
+        else:
+            return 'other', 404, {}, b'<html><body><p class="flash error">Not found</p></body></html>'
+
+        error = self.injected_error()
+        if error is not None:
+            status, headers = error
+            return kind, status, headers, f'<html><body><h2>{status}</h2></body></html>'.encode()
+        body = build()
+        if body is None:
+            return kind, 404, {}, b'<html><body><p class="flash error">Not found</p></body></html>'
+        return kind, 200, {}, body.encode()
+
+    # pages
+
+    def search_page(self, query):
+        def param(name):
+            return query.get(f'work_search[{name}]', [''])[0]
+
+        works = self.works
+        word_count = param('word_count')
+        if word_count.startswith('>'):
+            works = [w for w in works if w[1] > int(word_count[1:])]
+        elif '-' in word_count:
+            lo, hi = map(int, word_count.split('-'))
+            works = [w for w in works if lo <= w[1] <= hi]
+        dates = re.search(r'revised_at:\[(\S+) TO (\S+)\]', param('query'))
+        if dates:
+            lo, hi = (datetime.date.fromisoformat(d) for d in dates.groups())
+            works = [w for w in works if lo <= w[2] <= hi]
+        page = max(1, int(query.get('page', ['1'])[0]))
+        pages = max(1, (len(works) + PER_PAGE - 1) // PER_PAGE)
+        blurbs = ''.join(self.blurb(*work) for work in works[(page - 1) * PER_PAGE:page * PER_PAGE])
+        return (f'<html><body><h2 class="heading">{len(works)} Works</h2>{pagination(page, pages)}'
+                f'<ol class="work index group">{blurbs}</ol>{pagination(page, pages)}</body></html>')
+
+    def blurb(self, i, words, date):
+        return f'''<li id="work_{i}" class="work blurb group work-{i}" role="article">
+<div class="header module"><h4 class="heading"><a href="/works/{i}">Titre {i}</a> by <a rel="author" href="/users/u{i}/pseuds/u{i}">auteur{i}</a></h4>
+<h5 class="fandoms heading"><span class="landmark">Fandoms:</span> <a class="tag" href="/tags/x">Fandom É</a></h5>
+<ul class="required-tags"><li><span class="rating-teen rating" title="Teen And Up Audiences"><span class="text">Teen And Up Audiences</span></span></li><li><span class="category-slash category" title="M/M"><span class="text">M/M</span></span></li><li><span class="complete-no iswip" title="Work in Progress"><span class="text">Work in Progress</span></span></li></ul>
+<p class="datetime">{date.strftime('%d %b %Y')}</p></div>
+<h6 class="landmark heading">Tags</h6>
+<ul class="tags commas"><li class="relationships"><a class="tag" href="/t">A/B</a></li><li class="characters"><a class="tag" href="/t">A</a></li><li class="freeforms"><a class="tag" href="/t">Fluff</a></li><li class="freeforms"><a class="tag" href="/t">Café</a></li></ul>
+<h6 class="landmark heading">Summary</h6><blockquote class="userstuff summary"><p>Résumé {i}</p></blockquote>
+<dl class="stats"><dt class="language">Language:</dt><dd class="language" lang="fr">Français</dd><dt class="words">Words:</dt><dd class="words">{words:,}</dd><dt class="chapters">Chapters:</dt><dd class="chapters"><a href="/works/{i}/chapters/{FIRST_CHAPTER_ID}">{self.chapters}</a>/?</dd><dt class="kudos">Kudos:</dt><dd class="kudos"><a href="/k">{i % 97}</a></dd><dt class="bookmarks">Bookmarks:</dt><dd class="bookmarks"><a href="/b">{self.bookmarks}</a></dd><dt class="hits">Hits:</dt><dd class="hits">{i * 13 % 5000}</dd></dl></li>'''
+
+    def chapter_menu(self, current):
+        if self.chapters < 2:
+            return ''
+        options = ''.join(f'<option value="{FIRST_CHAPTER_ID + n - 1}"{" selected" if n == current else ""}>{n}. Chapitre {n}</option>'
+                          for n in range(1, self.chapters + 1))
+        return f'<ul class="work navigation actions"><li class="chapter"><form><select name="selected_id" id="selected_id">{options}</select></form></li></ul>'
+
+    def chapter(self, n):
+        return (f'<div class="chapter" id="chapter-{n}"><div class="chapter preface group"><h3 class="title">Chapitre {n}</h3></div>'
+                f'<div class="userstuff module" role="article">{self.texts[n - 1]}</div></div>')
+
+    def work_page(self, work_id, full, current=1):
+        if not 1 <= work_id <= len(self.works):
+            return None
+        _, words, date = self.works[work_id - 1]
+        shown = range(1, self.chapters + 1) if full else [current]
+        return f'''<html><body>{'' if full else self.chapter_menu(current)}
+<dl class="work meta group"><dt class="rating tags">Rating:</dt><dd class="rating tags"><ul class="commas"><li><a class="tag" href="/t">Teen And Up Audiences</a></li></ul></dd>
+<dt class="freeform tags">Additional Tags:</dt><dd class="freeform tags"><ul class="commas"><li><a class="tag" href="/t">Fluff</a></li><li><a class="tag" href="/t">Café</a></li></ul></dd>
+<dt class="language">Language:</dt><dd class="language" lang="fr">
+ Français </dd><dt class="stats">Stats:</dt><dd class="stats"><dl class="stats"><dt class="published">Published:</dt><dd class="published">2020-01-01</dd><dt class="status">Updated:</dt><dd class="status">{date.isoformat()}</dd><dt class="words">Words:</dt><dd class="words">{words:,}</dd><dt class="chapters">Chapters:</dt><dd class="chapters">{self.chapters}/?</dd><dt class="kudos">Kudos:</dt><dd class="kudos">{work_id % 97}</dd><dt class="bookmarks">Bookmarks:</dt><dd class="bookmarks"><a href="/works/{work_id}/bookmarks">{self.bookmarks}</a></dd><dt class="hits">Hits:</dt><dd class="hits">{work_id * 13 % 5000}</dd></dl></dd></dl>
+<div id="workskin"><div class="preface group"><h2 class="title heading">Titre {work_id}</h2><h3 class="byline heading"><a rel="author" href="/users/u{work_id}">auteur{work_id}</a></h3></div>
+<div id="chapters" role="article">{''.join(self.chapter(n) for n in shown)}</div></div>
+<div id="feedback"><p class="kudos"><a href="/users/a">alice</a>, <a href="/users/b">bob</a> and <a href="#">3 more users</a> left kudos on this work!</p></div></body></html>'''
+
+    def chapter_page(self, work_id, n):
+        if not 1 <= n <= self.chapters:
+            return None
+        return self.work_page(work_id, False, n)
+
+    def navigate_page(self, work_id):
+        if not 1 <= work_id <= len(self.works):
+            return None
+        items = ''.join(f'<li><a href="/works/{work_id}/chapters/{FIRST_CHAPTER_ID + n - 1}">{n}. Chapitre {n}</a></li>'
+                        for n in range(1, self.chapters + 1))
+        return f'<html><body><ol class="chapter index group" role="navigation">{items}</ol></body></html>'
+
+    def bookmark_page(self, work_id, page):
+        if not 1 <= work_id <= len(self.works):
+            return None
+        users = [f'lecteur{n}' for n in range(self.bookmarks, 0, -1)][(page - 1) * PER_PAGE:page * PER_PAGE]
+        pages = max(1, (self.bookmarks + PER_PAGE - 1) // PER_PAGE)
+        items = ''.join(f'<li class="user short blurb group"><h5 class="byline heading"><a href="/users/{user}">{user}</a></h5></li>' for user in users)
+        return f'<html><body><ol class="bookmark index group">{items}</ol>{pagination(page, pages)}</body></html>'
+
+    # server
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if self.path == '/__stats':
+                    kind, status, headers, body = 'stats', 200, {}, json.dumps(mock.stats).encode()
+                else:
+                    kind, status, headers, body = mock.respond(self.path)
+                    mock._count(kind, status, len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host='127.0.0.1', port=0):
+        '''
+        starts the server in a daemon thread, returns it (server.server_address gives the port)
+        '''
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='ao3-mock', daemon=True).start()
+        return server
+
+
+def add_mock_args(parser):
+    '''
+    the options of the synthetic archive (shared with ao3_bench.py)
+    '''
+    parser.add_argument('--works', type=int, default=1000, help='number of works in the archive')
+    parser.add_argument('--words', type=int, default=2000, help='words per work')
+    parser.add_argument('--chapters', type=int, default=3, help='chapters per work')
+    parser.add_argument('--bookmarks', type=int, default=45, help='bookmarks per work')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered by a 429 or a 503')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the injected 429s, in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds waited before every response')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the texts and of the error draws')
+
+
+def mock_from_args(args):
+    return MockAO3(args.works, args.words, args.chapters, args.bookmarks, args.error_rate, args.retry_after, args.latency, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic AO3 archive on localhost.')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    add_mock_args(parser)
+    args = parser.parse_args()
+    server = mock_from_args(args).serve(port=args.port)
+    host, port = server.server_address
+    print(f"Faux AO3 sur http://{host}:{port} ({args.works} fanfictions) : AO3_BASE_URL=http://{host}:{port}")
+    print(f"Recherche : http://{host}:{port}/tags/Fluff/works")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+######
+#
+# Normalization of the texts extracted from AO3 pages.
+#
+# Every title, tag, stat and paragraph used to go through unidecode, which
+# turns the French corpus into ASCII (élève -> eleve) and is a visible share
+# of the parse time on long works. The mode is now chosen (--normalize):
+#   translit  unidecode, as before (the default, the csvs keep their format)
+#   nfkc      Unicode NFKC: accents kept, compatibility characters folded
+#             (ligatures, non-breaking spaces...), as the cleaning notebooks expect
+#   none      the text as AO3 serves it
+# Texts that are pure ASCII have nothing to change in any mode and are
+# returned as they are. Short, repeated strings (tags, stats, languages) go
+# through a cache. The body of a work is normalized in one call on the
+# joined paragraphs rather than paragraph by paragraph: unidecode and NFKC
+# work character by character, so the result is the same. For the same
+# reason translit first maps the Latin letters and the punctuation with a
+# str.translate table built from unidecode, which is a few times faster;
+# unidecode itself only sees the texts with other characters left.
+#
+#######
+import unicodedata
+from functools import lru_cache
+
+from unidecode import unidecode as plain_unidecode
+
+# unidecode timed per thread, see ao3_metrics
+from ao3_metrics import timed_unidecode as unidecode
+
+MODES = ['translit', 'nfkc', 'none']
+DEFAULT_MODE = 'translit'
+CACHE_SIZE = 1 << 16
+# Latin-1 and Latin Extended letters, general punctuation (quotes, dashes, spaces...)
+TABLE_RANGES = [(0x80, 0x250), (0x2000, 0x2070)]
+
+mode = DEFAULT_MODE
+
+
+def set_mode(name):
+    '''
+    chooses the normalization of every text extracted from now on (in this process)
+    '''
+    global mode
+    if name not in MODES:
+        raise ValueError(f"unknown normalization '{name}' (choose among {', '.join(MODES)})")
+    mode = name
+
+
+def get_mode():
+    return mode
+
+
+@lru_cache(maxsize=1)
+def _table():
+    return {cp: plain_unidecode(chr(cp)) for start, end in TABLE_RANGES for cp in range(start, end)}
+
+
+def _normalize(text, name):
+    if text.isascii() or name == 'none':
+        return text
+    if name == 'nfkc':
+        return unicodedata.normalize('NFKC', text)
+    text = text.translate(_table())
+    return text if text.isascii() else unidecode(text)
+
+
+def normalize(text):
+    '''
+    text normalized with the current mode
+    '''
+    return _normalize(text, mode)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached(text, name):
+    return _normalize(text, name)
+
+
+def normalize_short(text):
+    '''
+    normalize for short strings that repeat from page to page (tags, stats, titles)
+    '''
+    return _cached(text, mode)
+
+
+def normalize_body(paragraphs, separator='\n\n'):
+    '''
+    the paragraphs joined by separator and normalized in a single pass
+    '''
+    return normalize(separator.join(paragraphs))
+
+
+@lru_cache(maxsize=1024)
+def fold(text):
+    '''
+    ascii, lower-case form of a language name, to compare --lang with the page in any mode
+    '''
+    return _normalize(text, 'translit').strip().lower()
+
+
+def same_language(wanted, shown):
+    return fold(wanted) == fold(shown)
@@ -0,0 +1,468 @@
+######
+#
+# Parsing of AO3 work pages.
+#
+# write_fic_to_csv only reads a few parts of a work page:
+# dl.work.meta.group, h2.title, h3.byline, the kudos nodes and div#chapters.
+# Several interchangeable backends extract them:
+#   bs4        - BeautifulSoup + html.parser on the whole page (the reference)
+#   strained   - BeautifulSoup restricted to those subtrees with a SoupStrainer
+#   lxml       - lxml.html + XPath, the fast path
+#   selectolax - selectolax (optional) + CSS selectors
+#
+# Every backend returns the same fields, so their rows can be compared:
+#   python ao3_parse.py page.html [page2.html | archive_dir ...] [--backends lxml strained]
+# parses each page with the reference and the chosen backends and reports
+# every field that differs.
+# test_ao3_parse.py runs the same comparison automatically (python -m pytest
+# test_ao3_parse.py), on fixture pages and for the streaming parser of ao3_stream.py too.
+#
+#######
+import argparse
+import datetime
+import os
+import sys
+
+from bs4 import BeautifulSoup, SoupStrainer
+from ao3_normalize import normalize, normalize_short, normalize_body, same_language
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+    except ImportError:
+        SelectolaxParser = None
+
+FANFIC_HEADER = ['work_id', 'title', 'author', 'rating', 'category', 'fandom', 'relationship', 'character',
+                 'additional tags', 'language', 'published', 'status', 'status date', 'words', 'chapters',
+                 'comments', 'kudos', 'bookmarks', 'hits', 'all_kudos', 'all_bookmarks', 'body']
+
+TAG_CATEGORIES = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
+STAT_CATEGORIES = ['language', 'published', 'status', 'words', 'chapters', 'comments', 'kudos', 'bookmarks', 'hits']
+
+
+def get_tag_info(category, meta):
+    '''
+    given a category and a 'work meta group, returns a list of tags (eg, 'rating' -> 'explicit')
+    '''
+    try:
+        tag_list = meta.find("dd", class_=str(category) + ' tags').find_all(class_="tag")
+    except AttributeError as e:
+        return []
+    return [normalize_short(result.text) for result in tag_list]
+
+
+def finish_stats(texts, status):
+    '''
+    given the raw texts of the stat categories (None when missing) and the
+    text of the status label, returns the list written in the csv
+    '''
+    texts = list(texts)
+    if texts[2] is None:
+        texts[2] = texts[1]  # no explicit completed field -- one shot
+    # for some reason, AO3 sometimes miss stat tags (like hits)
+    stats = [normalize_short(text) if text is not None else 'null' for text in texts]
+
+    stats[0] = stats[0].rstrip().lstrip()  # language has weird whitespace characters
+    # add a custom completed/updated field
+    stats.insert(2, status.strip(':') if status is not None else 'Completed')
+    return stats
+
+
+def get_stats(meta):
+    '''
+    returns a list of
+    language, published, status, date status, words, chapters, comments, kudos, bookmarks, hits
+    '''
+    stats = list(map(lambda category: meta.find("dd", class_=category), STAT_CATEGORIES))
+    status = meta.find("dt", class_="status")
+    return finish_stats([stat.text if stat else None for stat in stats], status.text if status else None)
+
+
+def get_tags(meta):
+    '''
+    returns a list of lists, of
+    rating, category, fandom, pairing, characters, additional_tags
+    '''
+    return list(map(lambda tag: get_tag_info(tag, meta), TAG_CATEGORIES))
+
+
+# get kudos
+def get_kudos(meta):
+    if (meta):
+        users = []
+        ## hunt for kudos' contents
+        kudos = meta.contents
+
+        # extract user names
+        for kudo in kudos:
+            if kudo.name == 'a':
+                if 'more users' not in kudo.contents[0] and '(collapse)' not in kudo.contents[0]:
+                    users.append(kudo.contents[0])
+
+        return users
+    return []
+
+
+# get author(s)
+def get_authors(meta):
+    tags = meta.contents
+    authors = []
+
+    for tag in tags:
+        if tag.name == 'a':
+            authors.append(tag.contents[0])
+
+    return authors
+
+
+def access_denied(soup):
+    if (soup.find(class_="flash error")):
+        return True
+    if (not soup.find(class_="work meta group")):
+        return True
+    return False
+
+
+def _soup_fields(soup, metadata_only, lang):
+    if access_denied(soup):
+        return 'denied', None
+
+    meta = soup.find("dl", class_="work meta group")
+    stats = get_stats(meta)
+    fields = {'stats': stats}
+    if lang and not same_language(lang, stats[0]):
+        return 'lang', fields
+
+    fields['author'] = [str(author) for author in get_authors(soup.find("h3", class_="byline heading"))]
+    fields['tags'] = get_tags(meta)
+    fields['title'] = normalize(soup.find("h2", class_="title heading").string).strip()
+    visible_kudos = get_kudos(soup.find('p', class_='kudos'))
+    hidden_kudos = get_kudos(soup.find('span', class_='kudos_expanded hidden'))
+    fields['kudos'] = [str(user) for user in visible_kudos + hidden_kudos]
+
+    if not metadata_only:
+        content = soup.find("div", id="chapters")
+        chapters = content.select('p')
+        fields['body'] = normalize_body([chapter.text for chapter in chapters])
+    else:
+        fields['body'] = ""
+    return 'ok', fields
+
+
+def _parse_bs4(html, metadata_only, lang):
+    return _soup_fields(BeautifulSoup(html, 'html.parser'), metadata_only, lang)
+
+
+# (tag, class attribute) of the subtrees kept by the strained parser
+_STRAINED = {('dl', 'work meta group'), ('h2', 'title heading'), ('h3', 'byline heading'),
+             ('p', 'kudos'), ('span', 'kudos_expanded hidden')}
+
+
+def _wanted(name, attrs):
+    classes = attrs.get('class') or ''
+    if isinstance(classes, (list, tuple)):
+        classes = ' '.join(classes)
+    classes = ' '.join(classes.split())
+    if name == 'div' and attrs.get('id') == 'chapters':
+        return True
+    return classes == 'flash error' or (name, classes) in _STRAINED
+
+
+class WorkStrainer(SoupStrainer):
+    '''
+    SoupStrainer that only lets through the subtrees read by write_fic_to_csv
+    '''
+
+    # bs4 >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return _wanted(name, attrs or {})
+
+    # bs4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        if isinstance(markup_name, str):
+            return markup_name if _wanted(markup_name, dict(markup_attrs or {})) else None
+        return super().search_tag(markup_name, markup_attrs)
+
+
+def _parse_strained(html, metadata_only, lang):
+    features = 'lxml' if lxml is not None else 'html.parser'
+    return _soup_fields(BeautifulSoup(html, features, parse_only=WorkStrainer()), metadata_only, lang)
+
+
+def _collapse(text):
+    '''
+    BeautifulSoup turns every whitespace-only string into a single ' ' (or '\n'),
+    the fast backends do the same so that bodies stay identical
+    '''
+    if text and not text.strip(' \t\n\r\f'):
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+def _exact_class(value):
+    return f"normalize-space(@class)='{value}'"
+
+
+def _has_class(token):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {token} ')"
+
+
+def _first(nodes):
+    return nodes[0] if nodes else None
+
+
+def _lxml_names(node):
+    '''
+    text of the <a> children of node, as get_kudos/get_authors read them
+    '''
+    if node is None:
+        return []
+    return [a.text for a in node.iterchildren('a') if a.text is not None]
+
+
+def _parse_lxml(html, metadata_only, lang):
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    doc = lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    meta = _first(doc.xpath(f"//dl[{_exact_class('work meta group')}]"))
+    if meta is None or doc.xpath(f"//*[{_exact_class('flash error')}]"):
+        return 'denied', None
+
+    texts = [_first(meta.xpath(f".//dd[{_has_class(category)}]")) for category in STAT_CATEGORIES]
+    status = _first(meta.xpath(f".//dt[{_has_class('status')}]"))
+    stats = finish_stats([node.text_content() if node is not None else None for node in texts],
+                         status.text_content() if status is not None else None)
+    fields = {'stats': stats}
+    if lang and not same_language(lang, stats[0]):
+        return 'lang', fields
+
+    fields['author'] = _lxml_names(_first(doc.xpath(f"//h3[{_exact_class('byline heading')}]")))
+    tags = []
+    for category in TAG_CATEGORIES:
+        dd = _first(meta.xpath(f".//dd[{_exact_class(category + ' tags')}]"))
+        tags.append([] if dd is None else [normalize_short(tag.text_content()) for tag in dd.xpath(f".//*[{_has_class('tag')}]")])
+    fields['tags'] = tags
+    fields['title'] = normalize(doc.xpath(f"//h2[{_exact_class('title heading')}]")[0].text_content()).strip()
+
+    kudos = [user for user in _lxml_names(_first(doc.xpath(f"//p[{_has_class('kudos')}]")))
+             + _lxml_names(_first(doc.xpath(f"//span[{_exact_class('kudos_expanded hidden')}]")))
+             if 'more users' not in user and '(collapse)' not in user]
+    fields['kudos'] = kudos
+
+    if not metadata_only:
+        content = doc.xpath("//div[@id='chapters']")[0]
+        fields['body'] = normalize_body([''.join(map(_collapse, p.itertext())) for p in content.iter('p')])
+    else:
+        fields['body'] = ""
+    return 'ok', fields
+
+
+def _selectolax_names(node):
+    if node is None:
+        return []
+    return [child.text(deep=True) for child in node.iter() if child.tag == 'a']
+
+
+def _parse_selectolax(html, metadata_only, lang):
+    doc = SelectolaxParser(html)
+
+    meta = doc.css_first('dl[class="work meta group"]')
+    if meta is None or doc.css_first('[class="flash error"]') is not None:
+        return 'denied', None
+
+    texts = [meta.css_first('dd.' + category) for category in STAT_CATEGORIES]
+    status = meta.css_first('dt.status')
+    stats = finish_stats([node.text(deep=True) if node is not None else None for node in texts],
+                         status.text(deep=True) if status is not None else None)
+    fields = {'stats': stats}
+    if lang and not same_language(lang, stats[0]):
+        return 'lang', fields
+
+    fields['author'] = _selectolax_names(doc.css_first('h3[class="byline heading"]'))
+    tags = []
+    for category in TAG_CATEGORIES:
+        dd = meta.css_first(f'dd[class="{category} tags"]')
+        tags.append([] if dd is None else [normalize_short(tag.text(deep=True)) for tag in dd.css('.tag')])
+    fields['tags'] = tags
+    fields['title'] = normalize(doc.css_first('h2[class="title heading"]').text(deep=True)).strip()
+
+    fields['kudos'] = [user for user in _selectolax_names(doc.css_first('p.kudos'))
+                       + _selectolax_names(doc.css_first('span[class="kudos_expanded hidden"]'))
+                       if 'more users' not in user and '(collapse)' not in user]
+
+    if not metadata_only:
+        content = doc.css_first('div#chapters')
+        fields['body'] = normalize_body([''.join([_collapse(node.text_content) for node in p.traverse(include_text=True)
+                                                  if node.tag == '-text'])
+                                         for p in content.css('p')])
+    else:
+        fields['body'] = ""
+    return 'ok', fields
+
+
+BACKENDS = {
+    'bs4': _parse_bs4,
+    'strained': _parse_strained,
+    'lxml': _parse_lxml,
+    'selectolax': _parse_selectolax,
+}
+
+
+def available_backends():
+    '''
+    names of the backends whose dependencies are installed
+    '''
+    names = ['bs4', 'strained']
+    if lxml is not None:
+        names.append('lxml')
+    if SelectolaxParser is not None:
+        names.append('selectolax')
+    return names
+
+
+def default_backend():
+    return 'lxml' if lxml is not None else 'bs4'
+
+
+def parse_work(html, metadata_only=False, lang=False, backend='bs4'):
+    '''
+    parses a work page with the chosen backend.
+    returns (status, fields): status is 'ok', 'denied' (access denied or no metadata)
+    or 'lang' (the work is not in lang, only fields['stats'] is filled).
+    fields has title, author, tags, stats, kudos and body.
+    html can be str or the raw utf-8 bytes of the page; as a top-level function
+    it can run in a ProcessPoolExecutor worker.
+    '''
+    if backend not in available_backends():
+        raise ValueError(f"parser backend '{backend}' is not available (installed: {', '.join(available_backends())})")
+    if isinstance(html, bytes) and backend != 'lxml':
+        html = html.decode('utf-8', errors='replace')
+    return BACKENDS[backend](html, metadata_only, lang)
+
+
+def build_row(fic_id, fields, all_bookmarks):
+    '''
+    returns the csv row of a work, in the order of FANFIC_HEADER
+    '''
+    return [fic_id, fields['title'], fields['author']] + [', '.join(tag) for tag in fields['tags']] \
+        + fields['stats'] + [fields['kudos'], all_bookmarks, fields['body']]
+
+
+def _blurb_tags(blurb, li_class):
+    return [normalize_short(a.text) for li in blurb.find_all("li", class_=li_class) for a in li.find_all("a", class_="tag")]
+
+
+def _blurb_symbol(blurb, span_class):
+    span = blurb.find("span", class_=span_class)
+    return normalize_short(span.get("title", "")) if span else ""
+
+
+def parse_blurb(blurb):
+    '''
+    given a li.work.blurb.group of a search/tag listing (a BeautifulSoup tag), returns
+    its metadata as a csv row in the order of FANFIC_HEADER, like write_fic_to_csv with
+    metadata_only. the listing does not show the publication date nor who left kudos or
+    bookmarks: published is 'null', all_kudos and all_bookmarks are empty.
+    status date is the date shown on the blurb (last update).
+    '''
+    work_id = blurb.get('id')[5:]
+    heading = blurb.find(class_="heading")
+    title_link = heading.find("a", href=True) if heading else None
+    title = normalize(title_link.text).strip() if title_link else ""
+    author = [a.text for a in heading.find_all("a", rel="author")] if heading else []
+
+    rating = _blurb_symbol(blurb, "rating")
+    category = _blurb_symbol(blurb, "category")
+    fandoms = blurb.find(class_="fandoms")
+    tags = [
+        [rating] if rating else [],
+        [c.strip() for c in category.split(',')] if category else [],
+        [normalize_short(a.text) for a in fandoms.find_all("a", class_="tag")] if fandoms else [],
+        _blurb_tags(blurb, "relationships"),
+        _blurb_tags(blurb, "characters"),
+        _blurb_tags(blurb, "freeforms"),
+    ]
+
+    stats_dl = blurb.find("dl", class_="stats")
+    texts = []
+    for category in STAT_CATEGORIES:
+        dd = stats_dl.find("dd", class_=category) if stats_dl else None
+        texts.append(dd.text if dd is not None else None)
+
+    date = blurb.find("p", class_="datetime")
+    if date is not None:
+        try:
+            texts[2] = datetime.datetime.strptime(date.text.strip(), '%d %b %Y').strftime('%Y-%m-%d')
+        except ValueError:
+            texts[2] = date.text.strip()
+    complete = blurb.find("span", class_="complete-yes") is not None
+    stats = finish_stats(texts, 'Completed' if complete else 'Updated')
+
+    fields = {'title': title, 'author': author, 'tags': tags, 'stats': stats, 'kudos': [], 'body': ""}
+    return build_row(work_id, fields, [])
+
+
+def compare_backends(html, backends, metadata_only=False):
+    '''
+    parses html with the reference bs4 backend and each of the given backends.
+    returns {backend: [(field, reference value, backend value), ...]} with only the differing fields.
+    '''
+    reference = parse_work(html, metadata_only, backend='bs4')
+    differences = {}
+    for backend in backends:
+        other = parse_work(html, metadata_only, backend=backend)
+        diff = []
+        if reference[0] != other[0]:
+            diff.append(('status', reference[0], other[0]))
+        elif reference[1] is not None:
+            for key in reference[1]:
+                if reference[1][key] != other[1].get(key):
+                    diff.append((key, reference[1][key], other[1].get(key)))
+        differences[backend] = diff
+    return differences
+
+
+def _iter_pages(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            from ao3_archive import HtmlArchive
+            archive = HtmlArchive(path)
+            for url in list(archive.latest):
+                status, html = archive.load(url)
+                if '/bookmarks' not in url:
+                    yield url, html
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                yield path, f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the parser backends give the same rows as the bs4 reference.')
+    parser.add_argument('pages', nargs='+', help='html files or --archive directories')
+    parser.add_argument('--backends', nargs='+', default=[b for b in available_backends() if b != 'bs4'],
+                        help='backends to compare with bs4')
+    parser.add_argument('--metadata-only', action='store_true', help='do not compare the bodies')
+    args = parser.parse_args()
+
+    pages = 0
+    mismatches = 0
+    for name, html in _iter_pages(args.pages):
+        pages += 1
+        for backend, diff in compare_backends(html, args.backends, args.metadata_only).items():
+            for field, expected, got in diff:
+                mismatches += 1
+                print(f"[DIFF] {name} | {backend} | {field} : {str(expected)[:80]!r} != {str(got)[:80]!r}")
+    print(f"{pages} pages comparées, {mismatches} différences.")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
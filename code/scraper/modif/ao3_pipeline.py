@@ -0,0 +1,261 @@
+######
+#
+# One-run collection: from an AO3 search to the fanfics csv.
+#
+# Usage - python ao3_pipeline.py URL [--csv fanfics.csv] [--ids-csv work_ids] [options]
+#
+# Instead of running ao3_ids_modif.py to the end and then ao3_get_fanfic_modif.py
+# on its csv, the two stages run at the same time: every id found on a result
+# page goes into a bounded queue (--queue-size) from which the work downloader
+# takes it at once. When the downloader falls behind the queue fills up and the
+# id crawl waits, so neither stage runs ahead of the other.
+#
+# Both stages send their requests through the same session and the same rate
+# limiter (--rps is the budget of the whole run), held by the contexts of the two
+# scripts (HarvestContext, FetchContext), and share one checkpoint: the
+# journal of the fics csv (default journal_<csv>). Works already done there are
+# neither queued nor downloaded again, so an interrupted run is resumed by
+# running the same command again (the result pages are crawled again, at 20
+# works per request).
+#
+# --ids-csv also writes the ids found to <ids-csv>.csv, as ao3_ids_modif.py
+# would (optional: the journal is the checkpoint). --tag_csv, --language_id,
+# --lang, --shard and --page_cap are those of ao3_ids_modif.py; --workers,
+# --parquet, --firstchap, --metadata-only, --flush-rows/--flush-seconds,
+# --shard-rows, --normalize and --skip-failed those of ao3_get_fanfic_modif.py,
+# like --log-level and the --metrics-* exports, which cover both stages.
+#
+#######
+import argparse
+import csv
+import os
+import queue
+import threading
+import time
+
+import ao3_ids_modif as harvest
+import ao3_get_fanfic_modif as fetch
+from ao3_limiter import AdaptiveLimiter
+from ao3_session import create_session
+from ao3_journal import Journal, journal_path, DONE
+from ao3_shards import PAGE_CAP
+from ao3_columnar import ParquetShardWriter, pa
+from ao3_writer import BackgroundWriter, RotatingCsvWriter, FLUSH_ROWS, FLUSH_SECONDS
+from ao3_metrics import metrics, setup_logging, MetricsExporter, LEVELS, INTERVAL
+from ao3_normalize import set_mode, MODES, DEFAULT_MODE
+
+QUEUE_SIZE = 200
+# longest wait for an id before the downloader writes the works it holds
+WAIT_SECONDS = 0.5
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Harvest the work ids of an AO3 search and download the works in the same run.')
+    parser.add_argument(
+        'url', metavar='URL',
+        help='a single URL pointing to an AO3 search page')
+    parser.add_argument(
+        '--csv', default='fanfics.csv',
+        help='csv output file name of the fics')
+    parser.add_argument(
+        '--ids-csv', default='',
+        help='also write the ids found to this csv (name without .csv, as ao3_ids_modif.py --out_csv)')
+    parser.add_argument(
+        '--header', default='',
+        help='user http header')
+    parser.add_argument(
+        '--tag_csv', default='',
+        help='provide an optional list of tags; the retrieved fics must have one or more such tags')
+    parser.add_argument(
+        '--language_id', default='',
+        help='AO3 language code (e.g. fr, en) added to the search url')
+    parser.add_argument(
+        '--lang', default='',
+        help='only keep fics whose language is this one (name as shown by AO3, e.g. Francais, or code, e.g. fr)')
+    parser.add_argument(
+        '--shard', action='store_true',
+        help='split searches with more than --page_cap pages into sub-searches by word count and date')
+    parser.add_argument(
+        '--page_cap', type=int, default=PAGE_CAP,
+        help='number of pages AO3 serves for one search')
+    parser.add_argument(
+        '--page-workers', type=int, default=2,
+        help='number of result pages downloaded at the same time')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of works downloaded at the same time')
+    parser.add_argument(
+        '--queue-size', type=int, default=QUEUE_SIZE,
+        help='number of ids found but not downloaded yet before the id crawl waits')
+    parser.add_argument(
+        '--rps', type=float, default=1.0 / fetch.delay,
+        help='politeness budget, in requests per second, shared by both stages')
+    parser.add_argument(
+        '--pool-size', type=int, default=0,
+        help='number of keep-alive connections to keep open (default: page workers + workers + 2)')
+    parser.add_argument(
+        '--timings', action='store_true',
+        help='print connect/TLS/transfer timings for every request')
+    parser.add_argument(
+        '--firstchap', action='store_true',
+        help='only retrieve first chapter of multichapter fics')
+    parser.add_argument(
+        '--metadata-only', action='store_true',
+        help='only retrieve metadata')
+    parser.add_argument(
+        '--parquet', default='',
+        help='directory of sharded parquet output, written instead of the csv')
+    parser.add_argument(
+        '--flush-rows', type=int, default=FLUSH_ROWS,
+        help='rows written per batch before the output is synced to disk')
+    parser.add_argument(
+        '--flush-seconds', type=float, default=FLUSH_SECONDS,
+        help='maximum time a row waits before the output is synced to disk')
+    parser.add_argument(
+        '--shard-rows', type=int, default=0,
+        help='start a new csv file every that many rows (default 0: a single csv)')
+    # the downloads are paced by the rate limit, so parsing in the main process keeps up
+    parser.add_argument(
+        '--parse-workers', type=int, default=0,
+        help='number of processes parsing the downloaded pages (0: parse in the main process)')
+    parser.add_argument(
+        '--normalize', default=DEFAULT_MODE, choices=MODES,
+        help='normalization of the extracted texts: translit (unidecode, ascii), nfkc (accents kept) or none')
+    parser.add_argument(
+        '--journal', default='',
+        help='checkpoint journal file (default: journal_<csv> next to the output csv)')
+    parser.add_argument(
+        '--skip-failed', action='store_true',
+        help='do not retry the fics the journal reports as failed')
+    parser.add_argument(
+        '--log-level', default='info', choices=LEVELS,
+        help='debug shows a line per id and per work')
+    parser.add_argument(
+        '--metrics-jsonl', default='',
+        help='file receiving a json line of metrics every --metrics-interval seconds')
+    parser.add_argument(
+        '--metrics-prom', default='',
+        help='file rewritten with the metrics in the Prometheus text format every --metrics-interval seconds')
+    parser.add_argument(
+        '--metrics-interval', type=float, default=INTERVAL,
+        help='seconds between two metrics exports')
+    args = parser.parse_args()
+    if args.parquet and pa is None:
+        parser.error('--parquet needs pyarrow')
+    return args
+
+
+def setup_harvest(args, journal, session, limiter, on_id):
+    '''
+    the context of the id crawl, with the options ao3_ids_modif.py would take from
+    the command line, and the searches to crawl
+    '''
+    url = args.url
+    if args.language_id:
+        url = harvest.set_language_id(url, args.language_id)
+    # the journal is the checkpoint: the works it reports as done are never queued again
+    context = harvest.HarvestContext(session, limiter, args.page_workers, args.lang, shard=args.shard,
+                                     page_cap=max(1, args.page_cap), base_url=url, csv_name=args.ids_csv,
+                                     seen_ids=set(journal.done), on_id=on_id)
+    tags = []
+    if args.tag_csv:
+        with open(args.tag_csv, "r") as tags_f:
+            tags = [row[0] for row in csv.reader(tags_f) if row]
+    return context, [harvest.tag_url(t, context=context) for t in tags] if tags else [url]
+
+
+def crawl_ids(searches, id_queue, header_info, failure, context):
+    '''
+    producer thread: crawls the searches, each id written goes to id_queue, then None
+    '''
+    try:
+        if context.shard:
+            searches = harvest.plan_searches(searches, header_info, context=context)
+        harvest.process_for_ids(searches, header_info, context=context)
+    except BaseException as e:
+        failure.append(e)
+    finally:
+        id_queue.put(None)
+
+
+def queued_ids(id_queue, journal, skip_failed=False):
+    '''
+    ids of the queue as the downloader asks for them, until the crawl is over.
+    yields None when no id came within WAIT_SECONDS (e.g. during a result page download),
+    so that the downloader writes the works already downloaded meanwhile.
+    '''
+    while True:
+        try:
+            fic_id = id_queue.get(timeout=WAIT_SECONDS)
+        except queue.Empty:
+            yield None
+            continue
+        if fic_id is None:
+            return
+        if skip_failed and fic_id in journal.failed:
+            continue
+        yield fic_id
+
+
+def main():
+    args = get_args()
+    start = time.monotonic()
+
+    # one session and one limiter for the whole run
+    workers = max(1, args.workers)
+    pool_size = args.pool_size if args.pool_size > 0 else max(1, args.page_workers) + workers + 2
+    session = create_session(pool_size, verbose=args.timings)
+    limiter = AdaptiveLimiter(args.rps)
+    setup_logging(args.log_level)
+    set_mode(args.normalize)
+    metrics.gauge_source(limiter.gauges)
+    exporter = MetricsExporter(args.metrics_jsonl, args.metrics_prom, args.metrics_interval)
+
+    output_directory = os.path.dirname(args.csv)
+    if output_directory and not os.path.isdir(output_directory):
+        print("Creating output directory " + output_directory)
+        os.mkdir(output_directory)
+
+    journal = Journal(args.journal or journal_path(args.csv))
+    print(f"Journal : {journal.path} ({len(journal)} fanfictions déjà traitées, {len(journal.failed)} en échec)")
+    context = fetch.FetchContext(session, limiter, journal=journal)
+
+    id_queue = queue.Queue(maxsize=max(1, args.queue_size))
+    harvest_context, searches = setup_harvest(args, journal, session, limiter, lambda fic_id, language: id_queue.put(fic_id))
+    failure = []
+    crawler = threading.Thread(target=crawl_ids, args=(searches, id_queue, args.header, failure, harvest_context), name='ao3-ids', daemon=True)
+
+    with open(os.path.join(os.path.dirname(args.csv), "errors_" + os.path.basename(args.csv)), 'a', newline="") as e_out:
+        if args.parquet:
+            sink = ParquetShardWriter(args.parquet)
+            print(f"Sortie Parquet : {args.parquet}")
+        else:
+            sink = RotatingCsvWriter(args.csv, max(0, args.shard_rows))
+        writer = BackgroundWriter(sink, e_out, args.flush_rows, args.flush_seconds)
+
+        print("Démarrage de la collecte des identifiants et des fanfictions...\n")
+        crawler.start()
+        try:
+            # the language was already checked on the result pages
+            processed_fics, failed_fics = fetch.scrape_fics(queued_ids(id_queue, journal, args.skip_failed), '?', workers, max(0, args.parse_workers),
+                                                            args.firstchap, False, False, args.metadata_only, writer, writer.errorwriter, args.header,
+                                                            context=context)
+        finally:
+            for done_id in writer.close():
+                fetch.mark(done_id, DONE, context=context)
+        crawler.join()
+
+        print(f"\n✅ Collecte terminée en {time.monotonic() - start:.0f} s : {processed_fics} fanfictions traitées.")
+        print(f"❌ Nombre de fanfictions échouées : {failed_fics}")
+        print(writer.summary())
+        print(session.stats.summary())
+        print(limiter.summary())
+        exporter.stop()
+        print(exporter.summary())
+    journal.close()
+    if failure:
+        raise failure[0]
+
+
+if __name__ == '__main__':
+    main()
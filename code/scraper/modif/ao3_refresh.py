@@ -0,0 +1,125 @@
+######
+#
+# Refresh of the stats (kudos, hits, comments...) of works already scraped.
+#
+# Instead of downloading the whole work again and appending a duplicate
+# row, the refresh sends a conditional request for the light work page
+# (first chapter only) with the ETag / Last-Modified validators of the
+# previous refresh: a 304 costs no body at all, a 200 is parsed with
+# metadata_only. Only the stats columns of the rows whose stats changed
+# are then rewritten, keyed by work_id; every other column, the body
+# included, is copied as it is. The csv is rewritten to a temporary file
+# next to it and swapped in with os.replace, so a crash never leaves a
+# half-written csv behind.
+#
+#######
+import csv
+import os
+import sys
+import threading
+
+from ao3_parse import FANFIC_HEADER
+
+# the stats columns of FANFIC_HEADER, in the order of get_stats
+STATS_START = FANFIC_HEADER.index('language')
+STATS_END = FANFIC_HEADER.index('hits') + 1
+VALIDATORS_HEADER = ['work_id', 'etag', 'last_modified']
+
+
+def validators_path(csv_out):
+    '''
+    default validators file for an output csv, next to it (like the journal)
+    '''
+    return os.path.join(os.path.dirname(csv_out), "validators_" + os.path.basename(csv_out))
+
+
+def raise_field_limit():
+    # bodies are far longer than the default field limit of the csv module
+    limit = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(limit)
+            return
+        except OverflowError:
+            limit //= 10
+
+
+class ValidatorStore:
+    '''
+    ETag / Last-Modified of the last 200 answer for each work
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.validators = {}
+        if os.path.exists(path):
+            with open(path, 'r', newline="") as f:
+                for row in csv.DictReader(f):
+                    self.validators[row['work_id']] = (row['etag'], row['last_modified'])
+
+    def headers(self, work_id):
+        '''
+        conditional request headers for a work (empty if it was never refreshed)
+        '''
+        etag, last_modified = self.validators.get(work_id, ('', ''))
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def update(self, work_id, response_headers):
+        etag = response_headers.get('ETag', '')
+        last_modified = response_headers.get('Last-Modified', '')
+        with self.lock:
+            if etag or last_modified:
+                self.validators[work_id] = (etag, last_modified)
+            else:
+                self.validators.pop(work_id, None)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(VALIDATORS_HEADER)
+            for work_id, (etag, last_modified) in self.validators.items():
+                writer.writerow([work_id, etag, last_modified])
+        os.replace(tmp, self.path)
+
+
+def scraped_stats(csv_out):
+    '''
+    stats columns of the rows of an output csv, by work_id (the last row wins)
+    '''
+    raise_field_limit()
+    stats = {}
+    with open(csv_out, 'r', newline="") as f:
+        for row in csv.reader(f):
+            if row and row[0] != FANFIC_HEADER[0] and len(row) >= STATS_END:
+                stats[row[0]] = row[STATS_START:STATS_END]
+    return stats
+
+
+def rewrite_stats(csv_out, updates):
+    '''
+    replaces the stats columns of the rows of csv_out whose work_id is in updates
+    (work_id -> list returned by get_stats); the other columns and rows
+    are copied unchanged. returns the number of rows rewritten.
+    '''
+    raise_field_limit()
+    tmp = csv_out + '.refresh.tmp'
+    rewritten = 0
+    with open(csv_out, 'r', newline="") as f_in, open(tmp, 'w', newline="") as f_out:
+        writer = csv.writer(f_out)
+        for row in csv.reader(f_in):
+            stats = updates.get(row[0]) if row else None
+            if stats is not None and len(row) >= STATS_END:
+                row[STATS_START:STATS_END] = stats
+                rewritten += 1
+            writer.writerow(row)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(tmp, csv_out)
+    return rewritten
@@ -0,0 +1,189 @@
+######
+#
+# Shared HTTP session layer for the AO3 scrapers.
+#
+# Both scripts used to call requests.get directly, which opens a new
+# TCP+TLS connection to archiveofourown.org for every page. A single
+# TimedSession keeps a pool of keep-alive connections, asks for
+# compressed responses and records, for every request, how long the
+# TCP connect, the TLS handshake, the wait for the first byte and the
+# body transfer took.
+#
+#######
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from ao3_metrics import metrics
+
+# brotli is optional: urllib3 only decodes 'br' when one of these is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+# root of the work urls; AO3_BASE_URL points the scrapers at another server
+# (e.g. the local mock AO3 of ao3_mock.py)
+BASE_URL = os.environ.get('AO3_BASE_URL', 'http://archiveofourown.org').rstrip('/')
+
+# connect/TLS timings of the connection opened by the current thread, if any
+_conn_timings = threading.local()
+
+
+class _TimedConnectionMixin:
+    '''
+    records how long opening the socket and the whole connect() took,
+    the difference being the TLS handshake for https connections
+    '''
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        _conn_timings.connect = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        start = time.perf_counter()
+        _conn_timings.connect = 0.0
+        super().connect()
+        _conn_timings.tls = max(0.0, time.perf_counter() - start - _conn_timings.connect)
+        _conn_timings.new = True
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''
+    pooled adapter whose connections report their connect/TLS timings
+    '''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+class SessionStats:
+    '''
+    running totals of the timings of every request sent through a session
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.wait = 0.0
+        self.transfer = 0.0
+        self.body_bytes = 0
+        self.wire_bytes = 0
+
+    def add(self, timings):
+        with self.lock:
+            self.requests += 1
+            self.new_connections += timings['new_connection']
+            self.connect += timings['connect']
+            self.tls += timings['tls']
+            self.wait += timings['wait']
+            self.transfer += timings['transfer']
+            self.body_bytes += timings['body_bytes']
+            self.wire_bytes += timings['wire_bytes']
+
+    def summary(self):
+        with self.lock:
+            if not self.requests:
+                return "[HTTP] aucune requête envoyée"
+            n = self.requests
+            return (f"[HTTP] {n} requêtes, {self.new_connections} connexions ouvertes "
+                    f"({n - self.new_connections} réutilisées) | moyenne connect {1000 * self.connect / n:.0f} ms, "
+                    f"TLS {1000 * self.tls / n:.0f} ms, attente {1000 * self.wait / n:.0f} ms, "
+                    f"transfert {1000 * self.transfer / n:.0f} ms | "
+                    f"{self.body_bytes / 1e6:.1f} Mo décodés, {self.wire_bytes / 1e6:.1f} Mo reçus")
+
+
+class TimedSession(requests.Session):
+    '''
+    requests.Session with connection pooling, keep-alive and compression,
+    which attaches a `timings` dict to every response:
+    connect, tls, wait (time to first byte) and transfer are in seconds.
+    '''
+
+    def __init__(self, pool_connections=2, pool_maxsize=10, timeout=60, verbose=False):
+        super().__init__()
+        self.timeout = timeout
+        self.verbose = verbose
+        self.stats = SessionStats()
+        adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.headers['Connection'] = 'keep-alive'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        _conn_timings.connect = 0.0
+        _conn_timings.tls = 0.0
+        _conn_timings.new = False
+
+        start = time.perf_counter()
+        resp = super().request(method, url, **kwargs)
+        total = time.perf_counter() - start
+
+        # elapsed stops when the headers are parsed, the rest is the body download
+        headers_at = resp.elapsed.total_seconds()
+        connect = _conn_timings.connect
+        tls = _conn_timings.tls
+        body_bytes = len(resp.content) if not kwargs.get('stream') else 0
+        resp.timings = {
+            'new_connection': _conn_timings.new,
+            'connect': connect,
+            'tls': tls,
+            'wait': max(0.0, headers_at - connect - tls),
+            'transfer': max(0.0, total - headers_at),
+            'body_bytes': body_bytes,
+            'wire_bytes': int(resp.headers.get('Content-Length') or body_bytes),
+        }
+        self.stats.add(resp.timings)
+        metrics.observe('fetch', total)
+        metrics.count('responses', status=resp.status_code)
+        metrics.count('response_bytes', resp.timings['wire_bytes'])
+        if self.verbose:
+            t = resp.timings
+            print(f"[HTTP] {resp.status_code} {url} | connect {1000 * t['connect']:.0f} ms, "
+                  f"TLS {1000 * t['tls']:.0f} ms, attente {1000 * t['wait']:.0f} ms, "
+                  f"transfert {1000 * t['transfer']:.0f} ms, {t['wire_bytes']} octets")
+        return resp
+
+
+def create_session(pool_size=10, verbose=False):
+    '''
+    returns a TimedSession able to keep pool_size connections alive
+    '''
+    return TimedSession(pool_maxsize=max(1, pool_size), verbose=verbose)
@@ -0,0 +1,165 @@
+######
+#
+# Sharding of AO3 searches too big for the search pagination.
+#
+# AO3 stops paging a search after a fixed number of pages (PAGE_CAP),
+# so the works of a big tag (Fluff, Angst...) past that page are never
+# listed. The planner splits such a search into disjoint sub-searches:
+#   - by word count (work_search[word_count] = "lo-hi" or ">n"), halving
+#     the ranges, which partition the works exactly;
+#   - by date of last update (revised_at:[a TO b] added to the
+#     work_search[query]) once a word-count range cannot be split any
+#     further (a single word count with too many works).
+# Each candidate is probed (one request for its first page, whose
+# pagination gives its number of pages) until every shard fits under
+# the cap. The shards are then crawled like any other search.
+# A probe that fails is sent again (PROBE_ROUNDS rounds in all); if it
+# still fails the plan is abandoned (ShardPlanError) rather than taking
+# the shard for a small one, whose works past the cap would be lost.
+#
+#######
+import datetime
+from urllib.parse import quote, unquote_plus
+
+# pages AO3 serves for one search (20 works per page)
+PAGE_CAP = 5000
+# first day of the archive, lower bound of the date shards
+ARCHIVE_START = datetime.date(2008, 9, 1)
+# first split of the open-ended word count range
+FIRST_WORD_SPLIT = 5000
+# rounds of probes before a search whose number of pages cannot be read fails the plan
+PROBE_ROUNDS = 3
+
+
+class ShardPlanError(RuntimeError):
+    '''
+    the number of pages of a search could not be read, so it cannot be planned
+    '''
+
+
+def _param_key(search_url, name):
+    for key in (f"work_search%5B{name}%5D=", f"work_search[{name}]="):
+        if search_url.find(key) != -1:
+            return key
+    return None
+
+
+def get_search_param(search_url, name):
+    '''
+    decoded value of the work_search[name] parameter of a search url ('' if absent)
+    '''
+    key = _param_key(search_url, name)
+    if key is None:
+        return ""
+    value_start = search_url.find(key) + len(key)
+    value_end = search_url.find("&", value_start)
+    return unquote_plus(search_url[value_start:] if value_end == -1 else search_url[value_start:value_end])
+
+
+def set_search_param(search_url, name, value):
+    '''
+    sets the work_search[name] parameter of a search url; value must already be url-encoded
+    '''
+    key = _param_key(search_url, name)
+    if key is not None:
+        value_start = search_url.find(key) + len(key)
+        value_end = search_url.find("&", value_start)
+        if value_end == -1:
+            return search_url[:value_start] + value
+        return search_url[:value_start] + value + search_url[value_end:]
+
+    separator = "&" if search_url.find("?") != -1 else "?"
+    return search_url + separator + f"work_search%5B{name}%5D=" + value
+
+
+class Shard:
+    '''
+    a sub-search: a word count range [words_lo, words_hi] (words_hi None: no upper bound)
+    and optionally a date range [date_lo, date_hi] of last update
+    '''
+
+    def __init__(self, words_lo=0, words_hi=None, date_lo=None, date_hi=None):
+        self.words_lo = words_lo
+        self.words_hi = words_hi
+        self.date_lo = date_lo
+        self.date_hi = date_hi
+
+    def __repr__(self):
+        words = f"{self.words_lo}-{self.words_hi if self.words_hi is not None else ''}"
+        dates = f" {self.date_lo}..{self.date_hi}" if self.date_lo is not None else ""
+        return f"Shard(words {words}{dates})"
+
+    def url(self, search_url):
+        if self.words_hi is not None:
+            search_url = set_search_param(search_url, 'word_count', f"{self.words_lo}-{self.words_hi}")
+        elif self.words_lo > 0:
+            search_url = set_search_param(search_url, 'word_count', quote(f">{self.words_lo - 1}", safe=''))
+        if self.date_lo is not None:
+            query = get_search_param(search_url, 'query')
+            query = (query + " " if query else "") + f"revised_at:[{self.date_lo.isoformat()} TO {self.date_hi.isoformat()}]"
+            search_url = set_search_param(search_url, 'query', quote(query, safe=''))
+        return search_url
+
+    def split(self, today=None):
+        '''
+        returns two disjoint shards covering this one, or None if it cannot be split
+        '''
+        if self.date_lo is None:
+            if self.words_hi is None:
+                middle = max(FIRST_WORD_SPLIT, 2 * self.words_lo)
+                return Shard(self.words_lo, middle - 1), Shard(middle, None)
+            if self.words_hi > self.words_lo:
+                middle = (self.words_lo + self.words_hi) // 2
+                return Shard(self.words_lo, middle), Shard(middle + 1, self.words_hi)
+            # a single word count: split by date instead
+            return Shard(self.words_lo, self.words_hi, ARCHIVE_START, today or datetime.date.today()).split()
+        if self.date_hi > self.date_lo:
+            middle = self.date_lo + (self.date_hi - self.date_lo) // 2
+            return (Shard(self.words_lo, self.words_hi, self.date_lo, middle),
+                    Shard(self.words_lo, self.words_hi, middle + datetime.timedelta(days=1), self.date_hi))
+        return None
+
+
+def probe_all(urls, probe, map_=map, rounds=PROBE_ROUNDS):
+    '''
+    number of pages of each url, probing again the ones that failed.
+    raises ShardPlanError when a url still fails after the given rounds.
+    '''
+    pages = [None] * len(urls)
+    for _ in range(rounds):
+        missing = [i for i, count in enumerate(pages) if count is None]
+        if not missing:
+            break
+        for i, count in zip(missing, map_(probe, [urls[i] for i in missing])):
+            pages[i] = count
+    failed = [url for url, count in zip(urls, pages) if count is None]
+    if failed:
+        raise ShardPlanError(f"could not read the number of pages of {len(failed)} search(es), e.g. {failed[0]}")
+    return pages
+
+
+def plan_shards(search_url, probe, cap=PAGE_CAP, map_=map):
+    '''
+    splits search_url into shard urls of at most cap pages each.
+    probe(url) returns the number of pages of a search (None if it could not be read);
+    map_ runs the probes of a round (e.g. the map of a thread pool, to probe in parallel).
+    a search already under the cap is returned as it is.
+    raises ShardPlanError when a probe keeps failing.
+    '''
+    if probe_all([search_url], probe)[0] < cap:
+        return [search_url]
+
+    planned = []
+    pending = list(Shard().split())
+    while pending:
+        urls = [shard.url(search_url) for shard in pending]
+        next_round = []
+        for shard, url, pages in zip(pending, urls, probe_all(urls, probe, map_)):
+            if pages >= cap:
+                halves = shard.split()
+                if halves is not None:
+                    next_round += halves
+                    continue
+            planned.append(url)
+        pending = next_round
+    return planned
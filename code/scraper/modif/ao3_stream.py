@@ -0,0 +1,269 @@
+######
+#
+# Streaming, bounded-memory extraction of AO3 work pages.
+#
+# The page is fed chunk by chunk (as read by iter_content) to an lxml
+# HTMLParser whose target only keeps the fields write_fic_to_csv needs.
+# Paragraphs of div#chapters are normalized one by one and written to a
+# spooled temporary file (on disk past a small threshold), and the csv
+# row is then written with its body copied from that file chunk by chunk.
+# Neither the page, nor a tree, nor the whole body is ever held in memory,
+# so peak memory does not depend on the length of the work.
+#
+#######
+import csv
+import io
+import os
+import tempfile
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from ao3_normalize import normalize, normalize_short, same_language
+from ao3_parse import TAG_CATEGORIES, STAT_CATEGORIES, finish_stats
+
+# bodies bigger than this are spooled to disk
+SPOOL_SIZE = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def _collapse(text):
+    # same whitespace handling as BeautifulSoup, see ao3_parse._collapse
+    if text and not text.strip(' \t\n\r\f'):
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+class WorkStreamTarget:
+    '''
+    lxml parser target collecting the metadata, kudos and paragraphs of a work page.
+    body is a writable text file receiving the paragraphs ('\n\n' separated),
+    None when only the metadata is needed.
+    '''
+
+    def __init__(self, body=None, lang=False):
+        self.body = body
+        self.lang = lang
+        self.stack = []  # [tag, role, buffer or None]
+        self.pending = []
+        self.denied = False
+        self.wrong_lang = False
+        self.seen = set()
+        self.tags = {category: [] for category in TAG_CATEGORIES}
+        self.stats = {}
+        self.status = None
+        self.title = None
+        self.authors = []
+        self.kudos = []
+        self.paragraphs = 0
+
+    def done(self):
+        '''
+        True once the rest of the page cannot change the outcome (access denied, wrong language)
+        '''
+        return self.denied or self.wrong_lang
+
+    def _first(self, key):
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def _inside(self, role):
+        return any(entry[1] == role for entry in self.stack)
+
+    def _parent_role(self):
+        return self.stack[-1][1] if self.stack else None
+
+    def _flush(self):
+        if not self.pending:
+            return
+        text = _collapse(''.join(self.pending))
+        self.pending = []
+        for entry in self.stack:
+            if entry[2] is not None:
+                entry[2].append(text)
+
+    def _role(self, tag, attrib):
+        classes = ' '.join((attrib.get('class') or '').split())
+        tokens = classes.split()
+        if classes == 'flash error':
+            self.denied = True
+
+        if tag == 'dl' and classes == 'work meta group' and self._first('meta'):
+            return 'meta', False
+        if self._inside('meta'):
+            if tag == 'dd' and classes.endswith(' tags') and classes[:-5] in self.tags and self._first(classes):
+                return 'tags:' + classes[:-5], False
+            parent_tags = next((entry[1] for entry in reversed(self.stack) if entry[1].startswith('tags:')), None)
+            if parent_tags and 'tag' in tokens:
+                return 'tag:' + parent_tags[5:], True
+            if tag == 'dd':
+                for category in STAT_CATEGORIES:
+                    if category in tokens and self._first('stat:' + category):
+                        return 'stat:' + category, True
+            if tag == 'dt' and 'status' in tokens and self._first('dt.status'):
+                return 'status', True
+            return '', False
+
+        if tag == 'h2' and classes == 'title heading' and self._first('title'):
+            return 'title', True
+        if tag == 'h3' and classes == 'byline heading' and self._first('byline'):
+            return 'byline', False
+        if tag == 'p' and 'kudos' in tokens and self._first('kudos'):
+            return 'kudos', False
+        if tag == 'span' and classes == 'kudos_expanded hidden' and self._first('kudos_hidden'):
+            return 'kudos', False
+        if tag == 'a' and self._parent_role() in ('byline', 'kudos'):
+            return self._parent_role() + ':a', True
+        if tag == 'div' and attrib.get('id') == 'chapters' and self._first('chapters'):
+            self._check_lang()
+            return 'chapters', False
+        if tag == 'p' and self.body is not None and self._inside('chapters'):
+            return 'p', True
+        return '', False
+
+    def _check_lang(self):
+        # the metadata block comes before the chapters: the language is known now
+        if self.lang and not same_language(self.lang, self.stats_list()[0]):
+            self.wrong_lang = True
+
+    def start(self, tag, attrib):
+        self._flush()
+        role, buffered = self._role(tag, attrib)
+        self.stack.append([tag, role, [] if buffered else None])
+
+    def end(self, tag):
+        self._flush()
+        if not self.stack:
+            return
+        tag, role, buffer = self.stack.pop()
+        if buffer is None:
+            return
+        text = ''.join(buffer)
+        if role.startswith('tag:'):
+            self.tags[role[4:]].append(normalize_short(text))
+        elif role.startswith('stat:'):
+            self.stats[role[5:]] = text
+        elif role == 'status':
+            self.status = text
+        elif role == 'title':
+            self.title = normalize(text).strip()
+        elif role == 'byline:a':
+            self.authors.append(text)
+        elif role == 'kudos:a':
+            if 'more users' not in text and '(collapse)' not in text:
+                self.kudos.append(text)
+        elif role == 'p':
+            if self.paragraphs:
+                self.body.write('\n\n')
+            self.body.write(normalize(text))
+            self.paragraphs += 1
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def close(self):
+        self._flush()
+        return self
+
+    def stats_list(self):
+        return finish_stats([self.stats.get(category) for category in STAT_CATEGORIES], self.status)
+
+    def result(self):
+        '''
+        returns (status, fields) like ao3_parse.parse_work, except that the body
+        stays in the body file
+        '''
+        if self.denied or 'meta' not in self.seen:
+            return 'denied', None
+        fields = {'stats': self.stats_list()}
+        if self.lang and not same_language(self.lang, fields['stats'][0]):
+            return 'lang', fields
+        fields['author'] = self.authors
+        fields['tags'] = [self.tags[category] for category in TAG_CATEGORIES]
+        fields['title'] = self.title
+        fields['kudos'] = self.kudos
+        fields['body'] = ''
+        return 'ok', fields
+
+
+def parse_work_stream(chunks, metadata_only=False, lang=False):
+    '''
+    parses a work page given as an iterable of byte chunks.
+    returns (status, fields, body) where body is a spooled temporary file holding
+    the text of the work (rewound, to be closed by the caller), None if metadata_only.
+    stops reading the chunks as soon as the work turns out to be denied or in another language.
+    '''
+    if etree is None:
+        raise RuntimeError("streaming mode needs lxml, please install it")
+    body = None if metadata_only else tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+', encoding='utf-8')
+    target = WorkStreamTarget(body, lang)
+    parser = etree.HTMLParser(target=target, encoding='utf-8')
+    for chunk in chunks:
+        if chunk:
+            parser.feed(chunk)
+        if target.done():
+            break
+    parser.close()
+
+    result, fields = target.result()
+    if body is not None:
+        if result == 'ok':
+            body.seek(0)
+        else:
+            body.close()
+            body = None
+    return result, fields, body
+
+
+class StreamingCsvWriter:
+    '''
+    csv writer whose rows may end with a body read from a file, so that
+    the body is copied to the output chunk by chunk instead of being built in memory
+    '''
+
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.writer = csv.writer(f_out)
+        self.pending = []
+
+    def writerow(self, row):
+        self.pending.append(row[0])
+        return self.writer.writerow(row)
+
+    def flush(self):
+        '''
+        makes the rows written so far durable, returns their work ids
+        '''
+        self.f_out.flush()
+        os.fsync(self.f_out.fileno())
+        durable = self.pending
+        self.pending = []
+        return durable
+
+    def close(self):
+        return self.flush()
+
+    def writerow_streamed(self, row, body):
+        '''
+        writes row + [content of body] as one csv record.
+        the body field is always quoted, which any csv reader parses like csv.writer's output.
+        '''
+        prefix = io.StringIO()
+        csv.writer(prefix).writerow(list(row) + [''])
+        line = prefix.getvalue()
+        self.f_out.write(line[:-len('\r\n')] + '"')
+        if body is not None:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.f_out.write(chunk.replace('"', '""'))
+        self.f_out.write('"\r\n')
+        self.pending.append(row[0])
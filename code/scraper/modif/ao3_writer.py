@@ -0,0 +1,274 @@
+######
+#
+# Background writer stage of the scraper.
+#
+# The scraping side only puts rows (and error rows) in a bounded queue;
+# a single thread owns the output files. It gathers the rows in batches
+# and writes a batch when it holds flush_rows rows or when its oldest row
+# has waited flush_seconds, then flushes and fsyncs the output and the
+# errors file. Only then are the work ids of the batch handed back (by
+# flush() and close()) to be marked done in the journal, so the journal
+# never gets ahead of what is on disk.
+#
+# RotatingCsvWriter starts a new csv file (with its header) every
+# shard_rows rows; Parquet output is sharded by ao3_columnar.
+#
+#######
+import csv
+import os
+import queue
+import threading
+import time
+
+from ao3_parse import FANFIC_HEADER
+from ao3_stream import StreamingCsvWriter
+from ao3_metrics import metrics
+
+FLUSH_ROWS = 50
+FLUSH_SECONDS = 5.0
+QUEUE_SIZE = 256
+
+
+def shard_path(csv_out, shard):
+    '''
+    name of the shard-th csv file written for csv_out with --shard-rows
+    '''
+    return os.path.splitext(csv_out)[0] + f'-{shard:05d}.csv'
+
+
+def output_files(csv_out):
+    '''
+    the csv files holding the rows written for csv_out, those that exist:
+    csv_out itself, then its --shard-rows files in order
+    '''
+    files = [csv_out] if os.path.exists(csv_out) else []
+    shard = 0
+    while os.path.exists(shard_path(csv_out, shard)):
+        files.append(shard_path(csv_out, shard))
+        shard += 1
+    return files
+
+
+class RotatingCsvWriter:
+    '''
+    StreamingCsvWriter over csv_out, or, with shard_rows, over csv files of at most
+    shard_rows rows named <csv_out without .csv>-00000.csv, -00001.csv...
+    '''
+
+    def __init__(self, csv_out, shard_rows=0):
+        self.csv_out = csv_out
+        self.shard_rows = shard_rows
+        self.shard = self._first_shard() if shard_rows else 0
+        self.rows = 0
+        self.durable = []
+        self.f_out = None
+        self.writer = None
+        self._open()
+
+    def _path(self):
+        if not self.shard_rows:
+            return self.csv_out
+        return shard_path(self.csv_out, self.shard)
+
+    def _first_shard(self):
+        # a new run starts a new shard after the existing ones
+        shard = 0
+        while os.path.exists(shard_path(self.csv_out, shard)):
+            shard += 1
+        return shard
+
+    def _open(self):
+        self.f_out = open(self._path(), 'a', newline="")
+        if self.f_out.tell() == 0:
+            print('Writing a header row for the csv.')
+            csv.writer(self.f_out).writerow(FANFIC_HEADER)
+        self.writer = StreamingCsvWriter(self.f_out)
+
+    def _rotate(self):
+        self.rows += 1
+        if self.shard_rows and self.rows >= self.shard_rows:
+            self.durable += self.writer.flush()
+            self.f_out.close()
+            self.shard += 1
+            self.rows = 0
+            self._open()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self._rotate()
+
+    def writerow_streamed(self, row, body):
+        self.writer.writerow_streamed(row, body)
+        self._rotate()
+
+    def flush(self):
+        durable = self.durable + self.writer.flush()
+        self.durable = []
+        return durable
+
+    def sync(self):
+        return self.flush()
+
+    def close(self):
+        durable = self.flush()
+        self.f_out.close()
+        return durable
+
+
+class _ErrorProxy:
+    '''
+    csv-writer-like object queueing error rows to the background writer
+    '''
+
+    def __init__(self, background):
+        self.background = background
+
+    def writerow(self, row):
+        self.background._put(('error', row, None))
+
+
+class BackgroundWriter:
+    '''
+    queue-fed writer thread in front of a RotatingCsvWriter or a ParquetShardWriter (the sink).
+    writerow / writerow_streamed / errorwriter.writerow only queue the row; writerow_streamed
+    takes ownership of the body file and closes it once written.
+    flush() returns the work ids made durable since the last call, close() the remaining ones.
+    '''
+
+    def __init__(self, sink, errors_out, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS, queue_size=QUEUE_SIZE):
+        self.sink = sink
+        self.errors_out = errors_out
+        self.errors = csv.writer(errors_out)
+        self.errorwriter = _ErrorProxy(self)
+        self.flush_rows = max(1, flush_rows)
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.durable = []
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.oldest = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='ao3-writer', daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            self.queued += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+        self.queue.put(item)
+
+    def writerow(self, row):
+        self._put(('row', row, None))
+
+    def writerow_streamed(self, row, body):
+        self._put(('streamed', row, body))
+
+    def _write(self, batch, sync=False):
+        start = time.perf_counter()
+        for kind, row, body in batch:
+            if kind == 'error':
+                self.errors.writerow(row)
+            elif kind == 'streamed':
+                try:
+                    self.sink.writerow_streamed(row, body)
+                finally:
+                    if body is not None:
+                        body.close()
+            else:
+                self.sink.writerow(row)
+        durable = self.sink.sync() if sync else self.sink.flush()
+        self.errors_out.flush()
+        os.fsync(self.errors_out.fileno())
+        metrics.observe('write', time.perf_counter() - start)
+        with self.lock:
+            self.durable += durable
+            self.queued -= len(batch)
+            self.written += len(batch)
+            self.batches += 1 if batch else 0
+            self.oldest = time.monotonic() if self.queued else None
+
+    def _discard(self, batch):
+        for kind, row, body in batch:
+            if body is not None:
+                body.close()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = 'flush'
+            if isinstance(item, tuple) and item[0] == 'sync':
+                # write the batch, and whatever the sink holds back, now
+                try:
+                    self._write(batch, sync=True)
+                except Exception as e:
+                    self.error = e
+                    self._discard(batch)
+                batch = []
+                deadline = None
+                item[1].set()
+                continue
+            try:
+                if item is not None and item != 'flush':
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_seconds
+                if batch and (item is None or item == 'flush' or len(batch) >= self.flush_rows
+                              or time.monotonic() >= deadline):
+                    self._write(batch)
+                    batch = []
+                    deadline = None
+            except Exception as e:
+                self.error = e
+                self._discard(batch)
+                batch = []
+                deadline = None
+            if item is None:
+                return
+
+    def lag(self):
+        '''
+        returns (rows queued or batched but not on disk yet, seconds the oldest of them has waited)
+        '''
+        with self.lock:
+            return self.queued, (time.monotonic() - self.oldest) if self.oldest is not None else 0.0
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            durable = self.durable
+            self.durable = []
+        return durable
+
+    def sync(self):
+        '''
+        writes everything queued so far (and the partial shard of a parquet sink) and
+        returns the work ids made durable since the last call
+        '''
+        done = threading.Event()
+        self.queue.put(('sync', done, None))
+        done.wait()
+        return self.flush()
+
+    def close(self):
+        '''
+        writes everything still queued, closes the sink and returns the last durable work ids
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        durable = self.flush()
+        return durable + self.sink.close()
+
+    def summary(self):
+        pending, _ = self.lag()
+        return f"[ÉCRITURE] {self.written} lignes écrites en {self.batches} lots, {pending} en attente"
@@ -0,0 +1,148 @@
+######
+#
+# Equivalence of the parser backends of ao3_parse.py (and of the streaming
+# parser of ao3_stream.py) with the bs4 reference.
+#
+# Usage - python -m pytest test_ao3_parse.py
+#
+# Every page below is parsed with bs4 and with each installed backend, in
+# every --normalize mode, with and without metadata_only and --lang, and the
+# fields must be identical. The pages are those of the mock AO3 (ao3_mock.py)
+# plus a hand-written work page closer to the real ones: several authors,
+# entities, inline markup in the paragraphs, hidden kudos, a missing stat.
+#
+#######
+import pytest
+
+import ao3_normalize
+from ao3_mock import MockAO3
+from ao3_parse import parse_work, available_backends
+from ao3_stream import parse_work_stream, etree
+
+WORK_PAGE = '''<!DOCTYPE html>
+<html lang="en"><head><meta charset="utf-8"><title>Un été &amp; un hiver</title></head>
+<body><div id="main" class="works-show region">
+<ul class="work navigation actions"><li class="chapter"><a href="/works/42/chapters/7">Chapter Index</a></li></ul>
+<div class="wrapper"><dl class="work meta group">
+  <dt class="rating tags">Rating:</dt>
+  <dd class="rating tags"><ul class="commas"><li><a class="tag" href="/tags/Mature/works">Mature</a></li></ul></dd>
+  <dt class="warning tags">Archive Warning:</dt>
+  <dd class="warning tags"><ul class="commas"><li><a class="tag" href="/tags/x">No Archive Warnings Apply</a></li></ul></dd>
+  <dt class="category tags">Category:</dt>
+  <dd class="category tags"><ul class="commas"><li><a class="tag" href="/t">F/M</a></li><li><a class="tag" href="/t">Gen</a></li></ul></dd>
+  <dt class="fandom tags">Fandom:</dt>
+  <dd class="fandom tags"><ul class="commas"><li><a class="tag" href="/t">Harry Potter - J. K. Rowling</a></li></ul></dd>
+  <dt class="relationship tags">Relationship:</dt>
+  <dd class="relationship tags"><ul class="commas"><li><a class="tag" href="/t">Hermione Granger/Ron Weasley</a></li></ul></dd>
+  <dt class="character tags">Characters:</dt>
+  <dd class="character tags"><ul class="commas"><li><a class="tag" href="/t">Hermione Granger</a></li><li><a class="tag" href="/t">Ron Weasley</a></li></ul></dd>
+  <dt class="freeform tags">Additional Tags:</dt>
+  <dd class="freeform tags"><ul class="commas"><li><a class="tag" href="/t">Angst &amp; Fluff</a></li><li><a class="tag" href="/t">Post-Deathly Hallows</a></li><li><a class="tag" href="/t">Noël</a></li></ul></dd>
+  <dt class="language">Language:</dt>
+  <dd class="language" lang="fr">
+    Français
+  </dd>
+  <dt class="stats">Stats:</dt>
+  <dd class="stats"><dl class="stats">
+    <dt class="published">Published:</dt><dd class="published">2019-12-24</dd>
+    <dt class="status">Completed:</dt><dd class="status">2020-01-06</dd>
+    <dt class="words">Words:</dt><dd class="words">12,345</dd>
+    <dt class="chapters">Chapters:</dt><dd class="chapters">2/2</dd>
+    <dt class="comments">Comments:</dt><dd class="comments">17</dd>
+    <dt class="kudos">Kudos:</dt><dd class="kudos">250</dd>
+    <dt class="bookmarks">Bookmarks:</dt><dd class="bookmarks"><a href="/works/42/bookmarks">31</a></dd>
+  </dl></dd>
+</dl>
+<div id="workskin"><div class="preface group">
+  <h2 class="title heading">
+    Un été &amp; un hiver
+  </h2>
+  <h3 class="byline heading"><a rel="author" href="/users/plume/pseuds/plume">plume</a>, <a rel="author" href="/users/encre/pseuds/encre">encre_noire</a></h3>
+  <div class="summary module"><h3 class="heading">Summary:</h3><blockquote class="userstuff"><p>Ce résumé n'est pas dans le texte.</p></blockquote></div>
+</div>
+<div id="chapters" role="article">
+  <div class="chapter" id="chapter-1"><div class="chapter preface group"><h3 class="title"><a href="/works/42/chapters/7">Chapter 1</a>: Décembre</h3></div>
+  <div class="userstuff module" role="article"><h3 class="landmark heading" id="work">Chapter Text</h3>
+    <p>« Déjà ? » demanda-t-elle, les yeux <em>grands</em> ouverts.</p>
+    <p>Il haussa les épaules&nbsp;: <strong>peut-être</strong>… ou peut-être pas.</p>
+    <p> </p>
+    <p>Le château était silencieux,<br/>la forêt aussi.</p>
+  </div></div>
+  <div class="chapter" id="chapter-2"><div class="chapter preface group"><h3 class="title"><a href="/works/42/chapters/8">Chapter 2</a>: Janvier</h3></div>
+  <div class="userstuff module" role="article">
+    <p>Cœur &lt;brisé&gt; &amp; réparé — fin.</p>
+  </div></div>
+</div></div></div>
+<div id="feedback" class="feedback"><div id="kudos">
+  <p class="kudos"><a href="/users/alice">alice</a>, <a href="/users/bob">bob</a>, and <a id="kudos_summary" href="/works/42/kudos">2 more users</a> left kudos on this work!</p>
+  <span class="kudos_expanded hidden"><a href="/users/chloe">chloé</a>, <a href="/users/dan">dan</a> <a id="kudos_collapser" href="#">(collapse)</a></span>
+</div></div>
+</div></body></html>'''
+
+DENIED_PAGE = '''<html><body><div id="main"><div class="flash error">Sorry, you don't have permission to access the page you were trying to reach.</div></div></body></html>'''
+
+
+def _mock_pages():
+    mock = MockAO3(works=3, words=800, chapters=3, bookmarks=25, seed=3)
+    return {'mock_full': mock.work_page(2, True), 'mock_first_chapter': mock.work_page(3, False)}
+
+
+PAGES = dict(_mock_pages(), work=WORK_PAGE, denied=DENIED_PAGE)
+BACKENDS = [backend for backend in available_backends() if backend != 'bs4'] + (['stream'] if etree is not None else [])
+
+
+def _parse_stream(html, metadata_only, lang, chunk_size=97):
+    '''
+    parse_work_stream on the page cut in small chunks, with the body put back in the fields
+    '''
+    data = html.encode('utf-8')
+    result, fields, body = parse_work_stream((data[i:i + chunk_size] for i in range(0, len(data), chunk_size)), metadata_only, lang)
+    if body is not None:
+        with body:
+            fields['body'] = body.read()
+    return result, fields
+
+
+def _parse(html, backend, metadata_only, lang):
+    if backend == 'stream':
+        return _parse_stream(html, metadata_only, lang)
+    return parse_work(html, metadata_only, lang, backend=backend)
+
+
+@pytest.fixture(params=ao3_normalize.MODES)
+def mode(request):
+    saved = ao3_normalize.get_mode()
+    ao3_normalize.set_mode(request.param)
+    yield request.param
+    ao3_normalize.set_mode(saved)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('page', sorted(PAGES))
+@pytest.mark.parametrize('metadata_only', [False, True])
+@pytest.mark.parametrize('lang', [False, 'Francais', 'English'])
+def test_backend_matches_bs4(backend, page, metadata_only, lang, mode):
+    reference = parse_work(PAGES[page], metadata_only, lang, backend='bs4')
+    assert _parse(PAGES[page], backend, metadata_only, lang) == reference
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_bytes_input(backend, mode):
+    # the fetch engine hands the raw bytes of the page to the parser
+    html = WORK_PAGE.encode('utf-8')
+    reference = parse_work(WORK_PAGE, backend='bs4')
+    if backend == 'stream':
+        assert _parse_stream(WORK_PAGE, False, False, chunk_size=len(html)) == reference
+    else:
+        assert parse_work(html, backend=backend) == reference
+
+
+def test_reference_fields():
+    # the fixture exercises what the backends must agree on
+    result, fields = parse_work(WORK_PAGE, backend='bs4')
+    assert result == 'ok'
+    assert fields['author'] == ['plume', 'encre_noire']
+    assert fields['kudos'] == ['alice', 'bob', 'chloé', 'dan']
+    assert fields['stats'][2] == 'Completed'
+    assert fields['stats'][-1] == 'null'
+    assert parse_work(DENIED_PAGE, backend='bs4') == ('denied', None)